@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+# File: AccumGradOptimizer.py
+
+import tensorflow as tf
+
+__all__ = ['AccumGradOptimizer']
+
+class AccumGradOptimizer(tf.train.Optimizer):
+    """
+    Accumulate the gradients of `niter` micro-batches and apply their average
+    with the wrapped optimizer once, so that `niter` steps of batch B update
+    the model like one step of batch niter * B.
+
+    The global step still increases at every micro-batch, so the number of
+    steps per epoch has to be multiplied by `niter` to keep the epoch-based
+    schedules.
+
+    Example:
+        .. code-block:: python
+        opt = tf.train.MomentumOptimizer(lr, 0.9, use_nesterov=True)
+        opt = AccumGradOptimizer(opt, 4)
+    """
+    def __init__(self, opt, niter):
+        """
+        Args:
+            opt (tf.train.Optimizer): the optimizer applying the averaged gradients.
+            niter (int): number of micro-batches per update.
+        """
+        assert isinstance(opt, tf.train.Optimizer), opt
+        assert niter >= 1, niter
+        super(AccumGradOptimizer, self).__init__(False, 'AccumGradOptimizer')
+        self._opt = opt
+        self._niter = int(niter)
+
+    def compute_gradients(self, *args, **kwargs):
+        return self._opt.compute_gradients(*args, **kwargs)
+
+    def get_slot(self, *args, **kwargs):
+        return self._opt.get_slot(*args, **kwargs)
+
+    def get_slot_names(self, *args, **kwargs):
+        return self._opt.get_slot_names(*args, **kwargs)
+
+    def apply_gradients(self, grads_and_vars, global_step=None, name=None):
+        grads_and_vars = [(g, v) for g, v in grads_and_vars if g is not None]
+        if self._niter == 1:
+            return self._opt.apply_gradients(grads_and_vars, global_step, name)
+        # slots are created outside of tf.cond
+        slots = [self._zeros_slot(v, 'accum_grad', self._name) for _, v in grads_and_vars]
+        with tf.variable_scope(self._name):
+            counter = tf.Variable(0, name='counter', trainable=False, dtype=tf.int32)
+
+        with tf.name_scope('AccumGradOptimizer'):
+            ops = [tf.assign_add(s, tf.convert_to_tensor(g))
+                   for s, (g, _) in zip(slots, grads_and_vars)]
+            update_counter = tf.assign_add(counter, 1, name='update_counter')
+            update_slot_op = tf.group(update_counter, *ops, name='update_slot')
+
+            def update_grad():
+                update_op = self._opt.apply_gradients(
+                    [(s / float(self._niter), v) for s, (_, v) in zip(slots, grads_and_vars)])
+                with tf.control_dependencies([update_op]):
+                    clear_ops = [tf.assign(s, tf.zeros_like(s)) for s in slots]
+                return tf.group(*clear_ops, name='update_grad')
+
+            with tf.control_dependencies([update_slot_op]):
+                pred = tf.equal(tf.mod(counter, self._niter), 0)
+                op = tf.cond(pred, update_grad, tf.no_op, name=name or 'cond_update_grad')
+            if global_step is not None:
+                # count micro-batches, as the trainer does
+                with tf.control_dependencies([op]):
+                    op = tf.assign_add(global_step, 1).op
+        return op
@@ -3,11 +3,18 @@
 # File: EpsilonResnetBase.py
 # Author: Xin Yu <yuxwind@gmail.com>
 
+import math
+import multiprocessing
 import sys
+from contextlib import contextmanager
+from six.moves.queue import Empty
 sys.path.append('../../tensorpack')
 from tensorpack import *
+import tensorpack.models
+from tensorpack.tfutils.argscope import get_arg_scope
 from tensorpack.tfutils.symbolic_functions import *
 from tensorpack.tfutils.summary import *
+from tensorpack.tfutils.tower import get_current_tower_context
 
 import tensorflow as tf
 
@@ -16,15 +23,99 @@ Implementation of strict identity and side output in the following paper:
     Learning Strict Identity Mappings in Deep Residual Networks
     (https://arxiv.org/pdf/1804.01661.pdf)
 """
+_GPU_AVAILABLE = None
+# seconds between the checks that a child process is alive
+POLL_SECONDS = 5
+
+def _check_gpu(queue):
+    queue.put(tf.test.is_gpu_available())
+
+# whether TensorFlow sees a GPU, checked once in a child process: the CUDA
+#   runtime is not started in this one, which can still fork workers, e.g.
+#   parallelEval.parallel_counts. A child which dies without an answer, e.g.
+#   on a failure of CUDA, counts as no GPU.
+def gpu_available():
+    global _GPU_AVAILABLE
+    if _GPU_AVAILABLE is None and multiprocessing.current_process().daemon:
+        # a daemonic process can't have children
+        _GPU_AVAILABLE = tf.test.is_gpu_available()
+    if _GPU_AVAILABLE is None:
+        queue = multiprocessing.Queue()
+        p = multiprocessing.Process(target=_check_gpu, args=(queue,))
+        p.start()
+        while _GPU_AVAILABLE is None:
+            try:
+                _GPU_AVAILABLE = queue.get(timeout=POLL_SECONDS)
+            except Empty:
+                if p.is_alive():
+                    continue
+                # the answer may have been put just before the exit
+                try:
+                    _GPU_AVAILABLE = queue.get(timeout=1)
+                except Empty:
+                    logger.warn('the GPU check died with exit code {}, '
+                                'assuming no GPU'.format(p.exitcode))
+                    _GPU_AVAILABLE = False
+        p.join()
+    return _GPU_AVAILABLE
+
+# NCHW is faster on GPU, NHWC is the layout supported by the CPU kernels of TensorFlow
+def default_data_format():
+    return 'NCHW' if gpu_available() else 'NHWC'
+
+def check_data_format(data_format):
+    assert data_format in ['NCHW', 'NHWC'], data_format
+    if data_format == 'NCHW' and not gpu_available():
+        logger.warn('NCHW without GPU is only supported by TensorFlow built with MKL')
+
+def channel_axis(data_format):
+    return 1 if data_format == 'NCHW' else 3
+
+# zero-pad the channels of l on both sides, e.g. in the shortcut increasing dimension
+def pad_channel(l, pad, data_format):
+    paddings = [[0, 0]] * 4
+    paddings[channel_axis(data_format)] = [pad, pad]
+    return tf.pad(l, paddings)
+
+# put the channels of l back at the indices `kept` of `channels` channels,
+#   the others are 0, e.g. the output of a conv whose channels are pruned
+def scatter_channels(l, kept, channels, data_format):
+    ch_axis = channel_axis(data_format)
+    if len(kept) == channels:
+        return l
+    # the index of a pruned channel is that of an extra channel of zeros
+    index = [len(kept)] * channels
+    for k, c in enumerate(kept):
+        index[c] = k
+    zero = tf.zeros_like(tf.reduce_sum(l, ch_axis, keep_dims=True))
+    return tf.gather(tf.concat([l, zero], ch_axis), index, axis=ch_axis)
+
+# reduce the gate statistic of strict_identity across data-parallel replicas
+#   during training, see set_gate_reducer()
+_GATE_REDUCER = None
+
+# fn(s) returns the statistic s of the ε-gate reduced over the global batch,
+#   e.g. by dataParallel.py. None to disable.
+def set_gate_reducer(fn):
+    global _GATE_REDUCER
+    _GATE_REDUCER = fn
+
 # implement sparsity promting function with 4 ReLUs
 #   Usually, l is a 4 dimension tensor: Batch_size X Width X Height X Channel
 #   return 0.0 only if the absolute values of all elemenents in l are smaller than EPSILON
-def strict_identity(l, EPSILON):
-    add_moving_summary(tf.reduce_max(tf.abs(l), name='response_abs_max'))
-    add_moving_summary(tf.reduce_mean(tf.abs(l), name='response_mean_max'))
+#   summary=False skips the response summaries, e.g. inside a recomputed segment
+def strict_identity(l, EPSILON, summary=True):
+    if summary:
+        add_moving_summary(tf.reduce_max(tf.abs(l), name='response_abs_max'))
+        add_moving_summary(tf.reduce_mean(tf.abs(l), name='response_mean_max'))
     l = tf.to_float(l)
     s = tf.reduce_max(tf.nn.relu(l - EPSILON) +\
             tf.nn.relu(-l - EPSILON))
+    if _GATE_REDUCER is not None:
+        # the backward pass of a recomputed segment may be built outside of the tower
+        ctx = get_current_tower_context()
+        if ctx is None or ctx.is_training:
+            s = _GATE_REDUCER(s)
     identity_w = tf.nn.relu(tf.nn.relu(s * (-1000000) + 1.0) * (-1000000) + 1.0)
     return identity_w
 
@@ -43,3 +134,96 @@ def side_output(name, l, label, outdim):
         # monitor training error
         add_moving_summary(tf.reduce_mean(wrong, name='train_error'))
     return cost
+
+# re-enter a tensorpack argscope captured by get_arg_scope()
+#   The backward pass of a recomputed segment is built by tf.gradients, outside
+#   of the argscope used in _build_graph, so the layer defaults are restored here.
+@contextmanager
+def reenter_argscope(scope):
+    layers = [k for k in scope if scope[k]]
+    if len(layers) == 0:
+        yield
+        return
+    with argscope([getattr(tensorpack.models, layers[0])], **scope[layers[0]]):
+        rest = dict((k, scope[k]) for k in layers[1:])
+        with reenter_argscope(rest):
+            yield
+
+# the default decay of the moving statistics of tensorpack BatchNorm
+BN_DECAY = 0.9
+
+# raise if this TensorFlow has no tf.contrib.layers.recompute_grad (< 1.5)
+def check_recompute_grad():
+    if not hasattr(tf.contrib.layers, 'recompute_grad'):
+        raise RuntimeError('recomputation needs tf.contrib.layers.recompute_grad of '
+                           'TensorFlow >= 1.5, found {}'.format(tf.__version__))
+
+# implement gradient checkpointing on a segment of consecutive residual blocks
+#   Only the input of the segment is kept for backprop. The activations inside
+#   the segment, i.e. those of residual_convs, are recomputed in the backward pass.
+#   With n blocks cut into segments of s blocks, activation memory is about
+#   n/s + s blocks, which is minimal for s = sqrt(n).
+#
+#   blocks: a list of (name, fn). fn(l) is called under variable scope name and
+#       returns the residual F(l) and the shortcut of the block.
+#   return: the output of the segment and a list of
+#       (name_scope, identity_w, response_abs_max, response_mean_max) per block.
+#       Summaries can't be added inside the recomputed function; add them under
+#       name_scope to keep the usual names, e.g. res1.3/is_discarded.
+#   Note: the moving statistics of BatchNorm are updated by the forward pass and
+#       again by the recomputation, with the same batch statistics. Their decay
+#       in the segment is sqrt(BN_DECAY), so that the two updates of a step
+#       decay them by BN_DECAY as without recomputation.
+#   Requires tf.contrib.layers.recompute_grad, i.e. TensorFlow >= 1.5, and the
+#   variables of the segment are resource variables as it needs.
+def recompute_segment(blocks, l, EPSILON):
+    check_recompute_grad()
+    scope = get_arg_scope()
+    name_scopes = []
+
+    def segment(x):
+        stats = []
+        with reenter_argscope(scope), \
+                argscope(BatchNorm, decay=math.sqrt(BN_DECAY)):
+            for name, fn in blocks:
+                with tf.variable_scope(name, use_resource=True):
+                    # only record the name scope of the forward pass
+                    if len(name_scopes) < len(blocks):
+                        name_scopes.append(
+                                tf.get_default_graph().get_name_scope() + '/')
+                    c, short_cut = fn(x)
+                    identity_w = strict_identity(c, EPSILON, summary=False)
+                    x = identity_w * c + short_cut
+                    stats += [identity_w,
+                              tf.reduce_max(tf.abs(c)), tf.reduce_mean(tf.abs(c))]
+        return [x] + stats
+
+    outputs = tf.contrib.layers.recompute_grad(segment)(l)
+    gates = [(name_scopes[i],) + tuple(outputs[1 + 3 * i: 4 + 3 * i])
+             for i in range(len(blocks))]
+    return outputs[0], gates
+
+# add the response summaries of a block built by recompute_segment
+def add_response_summary(name_scope, abs_max, abs_mean):
+    with tf.name_scope(name_scope):
+        add_moving_summary(tf.identity(abs_max, name='response_abs_max'))
+        add_moving_summary(tf.identity(abs_mean, name='response_mean_max'))
+
+# aggregate is_discarded over the micro-batches of gradient accumulation
+#   A block is discarded for an effective batch only if it is discarded in
+#   every micro-batch of it. The returned tensor keeps the decision of the last
+#   complete effective batch, so that its summary, and discarded_cnt summed
+#   from it, count effective batches as without accumulation.
+#   The state is kept in tower-local variables (tf.Variable ignores reuse).
+def accumulate_discarded(is_discarded, niter, name='is_discarded'):
+    with tf.name_scope(name + '_accum'):
+        step = tf.Variable(0, trainable=False, name='step')
+        acc = tf.Variable(1.0, trainable=False, name='acc')
+        last = tf.Variable(0.0, trainable=False, name='last')
+        s, a, prev = tf.identity(step), tf.identity(acc), tf.identity(last)
+        cur = tf.where(tf.equal(s % niter, 0), is_discarded, tf.minimum(a, is_discarded))
+        done = tf.where(tf.equal(s % niter, niter - 1), cur, prev)
+        with tf.control_dependencies([cur, done]):
+            updates = [acc.assign(cur), last.assign(done), step.assign_add(1)]
+    with tf.control_dependencies(updates):
+        return tf.identity(done, name=name)
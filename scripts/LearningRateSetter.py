@@ -8,9 +8,11 @@ from abc import abstractmethod, ABCMeta
 import operator
 import six
 import os
+from collections import deque
 
 from .base import Callback
 from ..utils import logger
+from ..tfutils.common import get_global_step_value
 from param import HyperParamSetter
 
 __all__ = ['LearningRateSetter']
@@ -20,7 +22,8 @@ class LearningRateSetter(HyperParamSetter):
     Change learning rate by monitoring the change of a statistic.
     Change when it was increasing enough.
     """
-    def __init__(self, param, stat_name, init_schedule, updated_schedule, threshold, last_k):
+    def __init__(self, param, stat_name, init_schedule, updated_schedule, threshold, last_k,
+                 batch_size=None, base_batch_size=None, warmup_steps=0):
         """
         Args:
             param: same as in :class:`HyperParamSetter`.
@@ -29,6 +32,14 @@ class LearningRateSetter(HyperParamSetter):
             update_schedule: adaptive learning rate policy
             threshold (float): change threshold.
             last_k (int): last k epochs.
+            batch_size (int): the effective batch size of one step, e.g. the
+                batch size of a tower x the number of towers.
+            base_batch_size (int): the batch size the schedules were tuned for.
+                The learning rates of both schedules are scaled by
+                ``batch_size / base_batch_size`` (linear scaling rule).
+            warmup_steps (int): increase the learning rate linearly at every
+                step from the unscaled one to the scaled one in the first
+                warmup_steps steps.
 
         This callback will change plr by ``lr = update_schedule[0]``, when:
         ``min(stats) >= stats[0] + threshold``, where
@@ -41,21 +52,87 @@ class LearningRateSetter(HyperParamSetter):
                 [(0, 0.1), (82, 0.01), (123, 0.001), (300,0.0002)],
                 [(0, 0.1), (41, 0.01), (61, 0.001), (150,0.0002)],
                 1,1)
+
+            Train with 4 towers of batch 128 on schedules tuned for batch 128,
+            with 5 epochs of warm-up:
+            .. code-block:: python
+            LearningRateSetter('learning_rate','discarded_cnt',
+                [(0, 0.1), (82, 0.01), (123, 0.001), (300,0.0002)],
+                [(0, 0.1), (41, 0.01), (61, 0.001), (150,0.0002)],
+                1,1, batch_size=512, base_batch_size=128,
+                warmup_steps=5 * steps_per_epoch)
         """
         super(LearningRateSetter, self).__init__(param)
         self.stat_name = stat_name
         self.last_k = last_k
         self.threshold = threshold
 
+        self.scale = 1.0
+        if batch_size and base_batch_size:
+            self.scale = float(batch_size) / base_batch_size
+        self.warmup_steps = warmup_steps
+        # values of stat_name in the last k+1 epochs
+        self.hist = deque(maxlen=last_k + 1)
+        self.nr_hist_seen = 0
+
         self.last_changed_epoch = 0
         self.updated = False
         init_schedule = [(int(a), float(b)) for a, b in init_schedule]
         self.schedule = sorted(init_schedule, key=operator.itemgetter(0))
+        self.warmup_init = self.schedule[0][1]
+        self.schedule = self._scale(self.schedule)
         updated_schedule = [(int(a), float(b)) for a, b in updated_schedule]
-        self.updated_schedule = sorted(updated_schedule, key=operator.itemgetter(0))
+        self.updated_schedule = self._scale(sorted(updated_schedule, key=operator.itemgetter(0)))
 
-    def _get_value_to_set(self):
+    def _scale(self, schedule):
+        return [(e, v * self.scale) for e, v in schedule]
+
+    # multiply the learning rate and both schedules by factor, e.g. when the
+    #   batch size is changed during training
+    def rescale(self, factor):
+        self.scale *= factor
+        self.schedule = [(e, v * factor) for e, v in self.schedule]
+        self.updated_schedule = [(e, v * factor) for e, v in self.updated_schedule]
+        self.param.set_value(self.get_current_value() * factor)
+
+    def _before_train(self):
+        self.step = get_global_step_value()
+        super(LearningRateSetter, self)._before_train()
+        if self.step < self.warmup_steps:
+            self._warmup()
+
+    def _trigger_step(self, *args):
+        self.step += 1
+        if self.step <= self.warmup_steps:
+            self._warmup()
+
+    # the learning rate of the current schedule at this epoch
+    def _scheduled_value(self):
+        v = self.schedule[0][1]
+        for e, lr in self.schedule:
+            if e <= self.epoch_num:
+                v = lr
+        return v
+
+    # True if the learning rate is at the last stage of the current schedule
+    def is_final_stage(self):
+        return self.epoch_num >= self.schedule[-1][0]
+
+    def _warmup(self):
+        target = self._scheduled_value()
+        ratio = float(self.step) / self.warmup_steps
+        self.param.set_value(self.warmup_init + (target - self.warmup_init) * ratio)
+
+    # append the values of stat_name logged since the last call
+    def _update_hist(self):
         hist = self.trainer.monitors.get_history(self.stat_name)
+        for v in hist[self.nr_hist_seen:]:
+            self.hist.append(v)
+        self.nr_hist_seen = len(hist)
+
+    def _get_value_to_set(self):
+        self._update_hist()
+        hist = self.hist
         cur = self.get_current_value()
         logger.info("[LearningRateSetter] Triggered,%s cur=%f" %(self.param.readable_name, cur))
         if len(hist) < self.last_k + 1 or \
@@ -65,7 +142,6 @@ class LearningRateSetter(HyperParamSetter):
                     logger.info("[LearningRateSetter] Triggered, return 1")
                     return v
             return None
-        hist = hist[-self.last_k - 1:]    # len==last_k+1
         logger.info("[LearningRateSetter] Triggered, history: " +
                     ','.join(map(str, hist)))
 
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+# File: LoopResnetBase.py
+
+import math
+import sys
+sys.path.append('../../tensorpack')
+from tensorpack import *
+from tensorpack.tfutils.tower import get_current_tower_context
+
+from EpsilonResnetBase import strict_identity
+
+import tensorflow as tf
+
+"""
+Build the identical blocks of a CIFAR residual group with a tf.while_loop over
+stacked weights instead of unrolling one variable scope per block.
+
+The weights of res{g}.1 .. res{g}.{n-1} are stored in res{g}.loop with a leading
+dimension of n-1, e.g. res1.loop/conv1/W has shape [n-1, 3, 3, 16, 16] and
+res1.loop/conv1/W[k-1] is res1.k/conv1/W. convertLoopModel.py converts
+checkpoints between the two namings.
+"""
+
+LOOP_SCOPE = 'res%d.loop'
+BN_DECAY = 0.9
+BN_EPSILON = 1e-5
+# BatchNorm layers of a pre-activation block, named as in tensorpack
+BN_NAMES = ['bn', 'conv1/bn']
+CONV_NAMES = ['conv1/W', 'conv2/W']
+# per-block variables stacked in res{g}.loop
+STACKED_VARIABLES = CONV_NAMES + ['{}/{}'.format(b, v) for b in BN_NAMES
+                                  for v in ['beta', 'gamma', 'mean/EMA', 'variance/EMA']]
+
+
+def bn_variables(name, count, ch):
+    beta = tf.get_variable(name + '/beta', [count, ch],
+                           initializer=tf.constant_initializer(0.0))
+    gamma = tf.get_variable(name + '/gamma', [count, ch],
+                            initializer=tf.constant_initializer(1.0))
+    mean = tf.get_variable(name + '/mean/EMA', [count, ch],
+                           initializer=tf.constant_initializer(0.0), trainable=False)
+    var = tf.get_variable(name + '/variance/EMA', [count, ch],
+                          initializer=tf.constant_initializer(1.0), trainable=False)
+    return beta, gamma, mean, var
+
+
+# apply blocks [start, end) of a group of count identical pre-activation blocks
+#   l: input with ch channels; the blocks keep the shape of l
+#   block_names: name of each applied block, e.g. res1.3, for the summaries
+#   return: the output and a list of
+#       (name_scope, identity_w, response_abs_max, response_mean_max) per block,
+#       as recompute_segment() in EpsilonResnetBase.py.
+def loop_residual(name, l, count, start, end, block_names, EPSILON, data_format='NCHW'):
+    assert len(block_names) == end - start
+    ch = l.get_shape().as_list()[1 if data_format == 'NCHW' else 3]
+    ctx = get_current_tower_context()
+    is_training = ctx.is_training
+    # same as variance_scaling_initializer(mode='FAN_OUT') for one block
+    stddev = math.sqrt(1.3 * 2.0 / (3 * 3 * ch))
+
+    # a group may be applied in several parts, e.g. around the side output
+    with tf.variable_scope(name, reuse=True if start > 0 else None):
+        W = [tf.get_variable(x, [count, 3, 3, ch, ch],
+                             initializer=tf.truncated_normal_initializer(stddev=stddev))
+             for x in CONV_NAMES]
+        bn = [bn_variables(x, count, ch) for x in BN_NAMES]
+
+        def bn_relu(x, i, k):
+            beta, gamma, mean, var = [tf.gather(v, i) for v in bn[k]]
+            if is_training:
+                x, batch_mean, batch_var = tf.nn.fused_batch_norm(
+                    x, gamma, beta, epsilon=BN_EPSILON, data_format=data_format)
+            else:
+                x, batch_mean, batch_var = tf.nn.fused_batch_norm(
+                    x, gamma, beta, mean=mean, variance=var,
+                    epsilon=BN_EPSILON, data_format=data_format, is_training=False)
+            return tf.nn.relu(x), batch_mean, batch_var
+
+        def conv(x, i, k):
+            return tf.nn.conv2d(x, tf.gather(W[k], i), [1, 1, 1, 1], 'SAME',
+                                data_format=data_format)
+
+        def body(i, x, tas):
+            c, m0, v0 = bn_relu(x, i, 0)
+            c = conv(c, i, 0)
+            c, m1, v1 = bn_relu(c, i, 1)
+            c = conv(c, i, 1)
+            identity_w = strict_identity(c, EPSILON, summary=False)
+            x = identity_w * c + x
+            values = [identity_w, tf.reduce_max(tf.abs(c)), tf.reduce_mean(tf.abs(c)),
+                      m0, v0, m1, v1]
+            return i + 1, x, [ta.write(i - start, v) for ta, v in zip(tas, values)]
+
+        tas = [tf.TensorArray(tf.float32, size=end - start) for _ in range(7)]
+        _, l, tas = tf.while_loop(lambda i, x, tas: i < end, body,
+                                  [tf.constant(start), l, tas], swap_memory=True)
+        stats = [ta.stack() for ta in tas]
+
+        # maintain the moving statistics of BatchNorm on the main training tower
+        if is_training and ctx.is_main_training_tower:
+            idx = tf.range(start, end)
+            updates = []
+            for k in range(len(BN_NAMES)):
+                for v, batch in zip(bn[k][2:], stats[3 + 2 * k: 5 + 2 * k]):
+                    updates.append(tf.scatter_update(
+                        v, idx, tf.gather(v, idx) * BN_DECAY + batch * (1 - BN_DECAY)))
+            with tf.control_dependencies(updates):
+                l = tf.identity(l)
+
+    prefix = tf.get_default_graph().get_name_scope()
+    prefix = prefix + '/' if prefix else ''
+    gates = [(prefix + block_names[j] + '/',
+              stats[0][j], stats[1][j], stats[2][j]) for j in range(end - start)]
+    return l, gates
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+# File: adaptiveBatch.py
+
+import multiprocessing
+import os
+import resource
+
+import sys
+sys.path.append('../../tensorpack')
+from tensorpack import *
+
+import tensorflow as tf
+
+"""
+Grow the batch size during training when blocks are discarded and the
+measured peak memory leaves room for larger batches.
+
+ResizableBatchData is a BatchData whose batch size can be changed while the
+dataflow runs, also in the processes of PrefetchData. BatchSizeGrowth checks
+discarded_cnt and the peak memory at the end of each epoch, grows the batch
+size of the next epochs, scales the learning rate by the same factor and keeps
+the number of images per epoch.
+"""
+
+class ResizableBatchData(BatchData):
+    """
+    BatchData with a batch size in shared memory, so that a new batch size is
+    used by the next batches, also in the processes forked by PrefetchData.
+    """
+    def __init__(self, ds, batch_size, remainder=False):
+        self._batch_size = multiprocessing.Value('i', batch_size)
+        super(ResizableBatchData, self).__init__(ds, batch_size, remainder)
+
+    @property
+    def batch_size(self):
+        return self._batch_size.value
+
+    @batch_size.setter
+    def batch_size(self, value):
+        self._batch_size.value = value
+
+# find the ResizableBatchData in a chain of ProxyDataFlow, e.g. inside of PrefetchData
+def find_resizable(ds):
+    while not isinstance(ds, ResizableBatchData):
+        assert hasattr(ds, 'ds'), 'no ResizableBatchData in the dataflow'
+        ds = ds.ds
+    return ds
+
+
+class BatchSizeGrowth(Callback):
+    """
+    At the end of an epoch, if discarded_cnt increased since the last change
+    of the batch size, grow the batch size to the largest multiple of
+    `multiple` whose predicted peak memory is within `safety` of the memory
+    limit. The peak memory is assumed to grow linearly with the batch size.
+    """
+    def __init__(self, dataflow, lr_setter=None, stat_name='discarded_cnt',
+                 max_batch_size=1024, max_factor=2.0, multiple=16,
+                 memory_limit_mb=None, safety=0.85):
+        """
+        Args:
+            dataflow: the training dataflow, containing a ResizableBatchData.
+            lr_setter: the LearningRateSetter to rescale. If None, the
+                learning_rate variable is scaled.
+            max_factor (float): maximal growth at one epoch.
+            memory_limit_mb (float): memory available for training. Default:
+                the memory of the first GPU, or the physical memory without GPU.
+        """
+        self.dataflow = dataflow
+        self.batch_data = find_resizable(dataflow)
+        self.lr_setter = lr_setter
+        self.stat_name = stat_name
+        self.max_batch_size = max_batch_size
+        self.max_factor = max_factor
+        self.multiple = multiple
+        self.memory_limit_mb = memory_limit_mb
+        self.safety = safety
+        self.last_cnt = None
+
+    def _setup_graph(self):
+        self.use_gpu = tf.test.is_gpu_available()
+        if self.use_gpu:
+            with tf.device('/gpu:0'):
+                self.max_bytes = tf.contrib.memory_stats.MaxBytesInUse()
+                self.bytes_limit = tf.contrib.memory_stats.BytesLimit()
+        self.lr = [v for v in tf.global_variables() if v.op.name == 'learning_rate']
+
+    # peak memory and memory limit in MB
+    def _memory(self):
+        if self.use_gpu:
+            peak, limit = self.trainer.sess.run([self.max_bytes, self.bytes_limit])
+            peak, limit = peak / 1024.0 ** 2, limit / 1024.0 ** 2
+        else:
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+            limit = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 1024.0 ** 2
+        return peak, self.memory_limit_mb or limit
+
+    def _before_train(self):
+        self.last_cnt = None
+
+    def _trigger_epoch(self):
+        hist = self.trainer.monitors.get_history(self.stat_name)
+        if len(hist) == 0:
+            return
+        cnt = hist[-1]
+        if self.last_cnt is None:
+            self.last_cnt = cnt
+        if cnt <= self.last_cnt:
+            return
+        old = self.batch_data.batch_size
+        peak, limit = self._memory()
+        new = min(old * self.max_factor, old * limit * self.safety / peak, self.max_batch_size)
+        new = int(new) // self.multiple * self.multiple
+        logger.info('[BatchSizeGrowth] {}={}, peak memory {:.0f}/{:.0f} MB, batch size {}'.format(
+            self.stat_name, cnt, peak, limit, old))
+        if new <= old:
+            return
+        self.last_cnt = cnt
+        self.batch_data.batch_size = new
+        # the same number of images per epoch
+        self.trainer.config.steps_per_epoch = self.dataflow.size()
+        factor = float(new) / old
+        if self.lr_setter is not None:
+            self.lr_setter.rescale(factor)
+        else:
+            for v in self.lr:
+                v.load(self.trainer.sess.run(v) * factor, self.trainer.sess)
+        logger.info('[BatchSizeGrowth] batch size {} -> {}, learning rate x{:.3g}, '
+                    '{} steps per epoch'.format(old, new, factor, self.trainer.config.steps_per_epoch))
@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+# File: asyncCheckpoint.py
+
+import glob
+import json
+import os
+import threading
+
+import sys
+sys.path.append('../../tensorpack')
+from tensorpack import *
+from tensorpack.tfutils.common import get_global_step_value
+from tensorpack.tfutils.varmanip import get_savename_from_varname
+
+from earlyStop import latest_stat, discarded_state, block_of_stat
+
+import tensorflow as tf
+
+"""
+Save the checkpoints in a background thread and keep only those which matter
+for the compression of an epsilon-ResNet.
+
+At the end of an epoch, AsyncModelSaver copies the values of the variables
+out of the training session, which takes a fraction of a second, and a
+thread writes them as model-{step} with a Saver of another graph. A new
+checkpoint is only started when the previous one is written.
+
+Retention: a checkpoint is kept for good if the set of discarded blocks (or
+discarded_cnt) changed since the previous checkpoint, or if val_error reached
+a new best. Of the others, the last `keep_recent` ones and one every
+`keep_every` epochs are kept, as well as those pinned, e.g. by AutoCompressor
+until they are compressed. The `checkpoint` file lists the kept checkpoints,
+and checkpoints.json describes them.
+"""
+
+class AsyncModelSaver(Callback):
+    """
+    Save the model at the end of every epoch in a background thread, with a
+    compression-aware retention policy. Put it after InferenceRunner in the
+    callbacks to see the val_error of the same epoch.
+    """
+    # run only by the chief of data-parallel training, see dataParallel.py
+    chief_only = True
+
+    def __init__(self, block_names, val_stat='val_error', cnt_stat='discarded_cnt',
+                 keep_recent=2, keep_every=50, checkpoint_dir=None):
+        """
+        Args:
+            block_names (list): names of the is_discarded statistics.
+            keep_recent (int): number of recent checkpoints always kept.
+            keep_every (int): keep the checkpoints of every keep_every epochs.
+                0 to keep only the recent and the important ones.
+            checkpoint_dir (str): default: logger.LOG_DIR.
+        """
+        self.block_names = block_names
+        self.val_stat = val_stat
+        self.cnt_stat = cnt_stat
+        self.keep_recent = keep_recent
+        self.keep_every = keep_every
+        self.checkpoint_dir = checkpoint_dir
+        self.pins = []
+
+    # never delete the checkpoints of the steps returned by `steps`, called
+    #   from the thread, e.g. AutoCompressor.pinned_steps
+    def pin(self, steps):
+        self.pins.append(steps)
+
+    # apply the retention to the checkpoints no longer pinned, at the end
+    def release(self):
+        self._wait()
+        self.pins = []
+        if self.records:
+            self._apply_retention()
+
+    def _setup_graph(self):
+        if self.checkpoint_dir is None:
+            self.checkpoint_dir = logger.LOG_DIR
+        # the variables to save, under their names without tower prefix, as ModelSaver
+        var_dict = {}
+        for v in tf.global_variables():
+            name = get_savename_from_varname(v.op.name)
+            if name is not None and name not in var_dict:
+                var_dict[name] = v
+        names = sorted(var_dict.keys())
+        self.variables = [var_dict[name] for name in names]
+
+        # a copy of the variables in another graph, written by the thread
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            copies = {}
+            self.placeholders = []
+            assign_ops = []
+            for name, v in zip(names, self.variables):
+                dtype = v.dtype.base_dtype
+                copy = tf.Variable(tf.zeros(v.get_shape(), dtype), trainable=False,
+                                   collections=[], name='copy')
+                ph = tf.placeholder(dtype, v.get_shape())
+                assign_ops.append(tf.assign(copy, ph))
+                self.placeholders.append(ph)
+                copies[name] = copy
+            self.assign_op = tf.group(*assign_ops)
+            self.saver = tf.train.Saver(copies, max_to_keep=None,
+                                        write_version=tf.train.SaverDef.V2)
+        self.sess = tf.Session(graph=self.graph,
+                               config=tf.ConfigProto(device_count={'GPU': 0}))
+
+    def _before_train(self):
+        self.thread = None
+        self.error = None
+        self.records = []
+        self.last_discarded = None
+        self.best_val = None
+
+    # the record of a new checkpoint, with the reasons to keep it
+    def _record(self, step):
+        blocks, cnt = discarded_state(self.trainer, self.block_names, self.cnt_stat)
+        val = latest_stat(self.trainer, self.val_stat)
+        reasons = []
+        if (blocks, cnt) != self.last_discarded:
+            self.last_discarded = (blocks, cnt)
+            reasons.append('discarded')
+        if val is not None and (self.best_val is None or val < self.best_val):
+            self.best_val = val
+            reasons.append('best')
+        if self.keep_every > 0 and self.epoch_num % self.keep_every == 0:
+            reasons.append('every')
+        return {'step': step, 'epoch': self.epoch_num,
+                'discarded_blocks': [block_of_stat(b) for b in blocks],
+                'discarded_cnt': cnt, self.val_stat: None if val is None else float(val),
+                'keep': reasons, 'path': 'model-{}'.format(step)}
+
+    # wait for the checkpoint being written
+    def _wait(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            raise self.error
+
+    def _trigger_epoch(self):
+        self._wait()
+        step = get_global_step_value()
+        values = self.trainer.sess.run(self.variables)
+        record = self._record(step)
+        self.thread = threading.Thread(target=self._save, args=(values, record))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _after_train(self):
+        self._wait()
+
+    # wait for the checkpoint of `step` and keep it for good, e.g. the final
+    #   model of ConvergenceStopper. False if there is no such checkpoint.
+    def keep(self, step, reason):
+        self._wait()
+        records = [r for r in self.records if r['step'] == step and not r.get('deleted')]
+        if not records:
+            return False
+        if reason not in records[0]['keep']:
+            records[0]['keep'].append(reason)
+        self._apply_retention()
+        return True
+
+    def _save(self, values, record):
+        try:
+            self.sess.run(self.assign_op, feed_dict=dict(zip(self.placeholders, values)))
+            self.saver.save(self.sess, os.path.join(self.checkpoint_dir, 'model'),
+                            global_step=record['step'], write_meta_graph=False,
+                            write_state=False)
+            self.records.append(record)
+            self._apply_retention()
+            logger.info('[AsyncModelSaver] {} saved, kept: {}'.format(
+                record['path'], ','.join(record['keep']) or 'recent'))
+        except Exception as e:
+            self.error = e
+
+    def _apply_retention(self):
+        recent = self.records[-self.keep_recent:] if self.keep_recent > 0 else []
+        pinned = set(s for steps in self.pins for s in steps())
+        for r in self.records:
+            if r.get('deleted') or r['keep'] or any(r is x for x in recent) \
+                    or r['step'] in pinned:
+                continue
+            for f in glob.glob(os.path.join(self.checkpoint_dir, r['path'] + '.*')):
+                os.remove(f)
+            r['deleted'] = True
+        kept = [r['path'] for r in self.records if not r.get('deleted')]
+        tf.train.update_checkpoint_state(self.checkpoint_dir, kept[-1], kept)
+        with open(os.path.join(self.checkpoint_dir, 'checkpoints.json'), 'w') as f:
+            json.dump([r for r in self.records if not r.get('deleted')], f, indent=2)
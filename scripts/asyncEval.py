@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+# File: asyncEval.py
+
+import glob
+import json
+import os
+import re
+import subprocess
+import time
+
+import sys
+sys.path.append('../../tensorpack')
+from tensorpack import *
+from tensorpack.utils.stats import RatioCounter
+from tensorpack.tfutils.common import get_global_step_value
+
+import tensorflow as tf
+
+"""
+Validate the checkpoints in another process while the training goes on.
+
+AsyncValidation replaces InferenceRunner: before training it starts the
+training script again with --eval_watch <log dir>, which calls watch(). The
+watcher evaluates the latest checkpoint listed in the `checkpoint` file
+whenever it changes, and the compressed models written by AutoCompressor, and
+appends the errors to <log dir>/eval/results.jsonl. At the end of every epoch
+AsyncValidation puts the new errors into the monitors under the names of
+InferenceRunner, e.g. val_error or val-error-top1, so they are logged and seen
+by the other callbacks as before. The errors of a checkpoint arrive at the end
+of a later epoch; results.jsonl has the step of each of them.
+"""
+
+RESULTS = os.path.join('eval', 'results.jsonl')
+
+
+# the errors of the outputs of a dataset predictor, by their names
+#   outputs: vectors of 0/1 per image, e.g. incorrect_vector
+def error_stats(pred, names):
+    counters = [RatioCounter() for _ in names]
+    for o in pred.get_result():
+        for c, v in zip(counters, o):
+            c.feed(v.sum(), v.shape[0])
+    return dict((name, c.ratio) for name, c in zip(names, counters))
+
+def checkpoint_step(prefix):
+    return int(re.search('-(\d+)$', prefix).group(1))
+
+
+def watch(log_dir, evaluate, evaluate_compressed=None, poll=5):
+    """
+    Evaluate the new checkpoints of log_dir until the parent process exits.
+
+    Args:
+        evaluate: function(model_path) -> dict of errors of a checkpoint.
+        evaluate_compressed: function(cfg_path) -> dict of errors of a
+            compressed model in <log dir>/compressed.
+    """
+    parent = os.getppid()
+    path = os.path.join(log_dir, RESULTS)
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    last_step = None
+    done_cfg = set()
+    while os.getppid() == parent:
+        results = []
+        ckpt = tf.train.get_checkpoint_state(log_dir)
+        if ckpt is not None:
+            prefix = ckpt.model_checkpoint_path
+            if not os.path.isabs(prefix):
+                prefix = os.path.join(log_dir, prefix)
+            step = checkpoint_step(prefix)
+            if step != last_step and os.path.exists(prefix + '.index'):
+                last_step = step
+                results.append({'step': step, 'stats': evaluate(prefix)})
+        if evaluate_compressed is not None:
+            for cfg in sorted(glob.glob(os.path.join(log_dir, 'compressed', '*.cfg'))):
+                if cfg not in done_cfg:
+                    done_cfg.add(cfg)
+                    results.append({'step': checkpoint_step(cfg[:-len('.cfg')]),
+                                    'stats': evaluate_compressed(cfg)})
+        with open(path, 'a') as f:
+            for r in results:
+                f.write(json.dumps(r) + '\n')
+                logger.info('[asyncEval] step {}: {}'.format(r['step'], r['stats']))
+        if not results:
+            time.sleep(poll)
+
+
+class AsyncValidation(Callback):
+    """
+    Run the validation in a child process started with --eval_watch, and put
+    its errors into the monitors.
+    """
+    # run only by the chief of data-parallel training, see dataParallel.py
+    chief_only = True
+
+    def __init__(self, gpu=None, final_timeout=600):
+        """
+        Args:
+            gpu (str): the GPUs of the validation process, default: none.
+            final_timeout (float): seconds to wait after training for the
+                errors of the last checkpoint.
+        """
+        self.gpu = gpu
+        self.final_timeout = final_timeout
+
+    def _before_train(self):
+        self.path = os.path.join(logger.LOG_DIR, RESULTS)
+        self.offset = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+        self.last_step = None
+        # the last --gpu is used by argparse
+        cmd = [sys.executable] + sys.argv + ['--eval_watch', logger.LOG_DIR,
+                                             '--gpu', self.gpu or '']
+        env = dict(os.environ, CUDA_VISIBLE_DEVICES=self.gpu or '')
+        self.log = open(os.path.join(logger.LOG_DIR, 'eval.log'), 'a')
+        self.proc = subprocess.Popen(cmd, env=env, stdout=self.log, stderr=subprocess.STDOUT)
+
+    # the results appended since the last call
+    def _read_results(self):
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path, 'r') as f:
+            f.seek(self.offset)
+            lines = f.readlines()
+        results = []
+        for l in lines:
+            if not l.endswith('\n'):
+                break
+            self.offset += len(l)
+            results.append(json.loads(l))
+        return results
+
+    def _trigger_epoch(self):
+        for r in self._read_results():
+            self.last_step = r['step']
+            for name, v in sorted(r['stats'].items()):
+                self.trainer.monitors.put_scalar(name, v)
+            logger.info('[AsyncValidation] errors of step {}'.format(r['step']))
+        if self.proc.poll() is not None:
+            logger.warn('[AsyncValidation] the validation process exited with {}, see {}'.format(
+                self.proc.returncode, self.log.name))
+
+    def _after_train(self):
+        step = get_global_step_value()
+        deadline = time.time() + self.final_timeout
+        while self.proc.poll() is None and time.time() < deadline:
+            for r in self._read_results():
+                self.last_step = r['step']
+                logger.info('[AsyncValidation] step {}: {}'.format(r['step'], r['stats']))
+            if self.last_step is not None and self.last_step >= step:
+                break
+            time.sleep(1)
+        if self.proc.poll() is None:
+            self.proc.terminate()
+        self.log.close()
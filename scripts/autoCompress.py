@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+# File: autoCompress.py
+
+import os
+import subprocess
+import threading
+from collections import deque
+
+import sys
+sys.path.append('../../tensorpack')
+from tensorpack import *
+from tensorpack.tfutils.common import get_global_step_value
+
+from earlyStop import latest_stat, discarded_state, block_of_stat
+
+"""
+Compress every checkpoint during the training, in the background.
+
+At the end of an epoch, AutoCompressor takes the discarded blocks and the
+validation errors of the epoch and runs compressModel.py on model-{step} in
+a child process at low priority and without GPU, one checkpoint at a time.
+The compressed model and its cfg are written to <log dir>/compressed, ready
+for cifarCompressedResnet.py, svhnCompressedResnet.py or
+imagenetCompressedResnet.py --cfg. compressModel.py reads the checkpoint
+directly, so the `checkpoint` file of the training is left alone.
+
+The checkpoints still to compress are pinned in the AsyncModelSaver given as
+`saver`, whose retention would otherwise delete them while they wait; they
+stay on disk until compressed. The retention is applied again when the
+compression is over.
+"""
+
+COMPRESS_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'compressModel.py')
+
+
+class AutoCompressor(Callback):
+    """
+    Compress the checkpoint of every epoch with its discarded blocks. Put it
+    after the saver of the checkpoints and InferenceRunner in the callbacks.
+    """
+    # run only by the chief of data-parallel training, see dataParallel.py
+    chief_only = True
+
+    def __init__(self, block_names, val_stats=('val_error',), cnt_stat='discarded_cnt',
+                 out_dir=None, wait=600, saver=None):
+        """
+        Args:
+            block_names (list): names of the is_discarded statistics.
+            val_stats (list): the validation errors written to the cfg.
+            out_dir (str): default: <log dir>/compressed.
+            wait (float): seconds to wait for a checkpoint written in the
+                background, e.g. by AsyncModelSaver.
+            saver: the AsyncModelSaver of the training, if any, in which the
+                checkpoints still to compress are pinned. Its keep_recent
+                must be >= 1, for the checkpoint of an epoch to be there
+                when it is queued.
+        """
+        self.block_names = block_names
+        self.val_stats = list(val_stats)
+        self.cnt_stat = cnt_stat
+        self.out_dir = out_dir
+        self.wait = wait
+        self.saver = saver
+
+    def _before_train(self):
+        if self.out_dir is None:
+            self.out_dir = os.path.join(logger.LOG_DIR, 'compressed')
+        if not os.path.isdir(self.out_dir):
+            os.makedirs(self.out_dir)
+        self.log = open(os.path.join(self.out_dir, 'compress.log'), 'a')
+        self.pending = deque()
+        self.proc = None
+        self.step = None
+        # pending, proc and step are read by the thread of the saver
+        self.lock = threading.Lock()
+        if self.saver is not None:
+            self.saver.pin(self.pinned_steps)
+
+    # the steps queued or being compressed
+    def pinned_steps(self):
+        with self.lock:
+            steps = [s for s, _, _ in self.pending]
+            if self.proc is not None:
+                steps.append(self.step)
+        return steps
+
+    def _trigger_epoch(self):
+        step = get_global_step_value()
+        blocks, _ = discarded_state(self.trainer, self.block_names, self.cnt_stat)
+        val_error = [latest_stat(self.trainer, name) for name in self.val_stats]
+        with self.lock:
+            self.pending.append((step, [block_of_stat(b) for b in blocks],
+                                 [v for v in val_error if v is not None]))
+        self._poll()
+
+    # start the compression of the next checkpoint when the last one is done
+    def _poll(self):
+        if self.proc is not None:
+            if self.proc.poll() is None:
+                return
+            if self.proc.returncode != 0:
+                logger.warn('[AutoCompressor] compressing model-{} failed, see {}'.format(
+                    self.step, self.log.name))
+            else:
+                logger.info('[AutoCompressor] model-{} compressed to {}'.format(
+                    self.step, self.out_dir))
+            with self.lock:
+                self.proc = None
+        if not self.pending:
+            return
+        with self.lock:
+            step, blocks, val_error = self.pending[0]
+        cmd = [sys.executable, COMPRESS_SCRIPT, '--dir', logger.LOG_DIR,
+               '--step', str(step), '--discarded', ','.join(blocks),
+               '--val_error', ','.join(map(str, val_error)),
+               '--out_dir', self.out_dir, '--wait', str(self.wait)]
+        env = dict(os.environ, CUDA_VISIBLE_DEVICES='')
+        proc = subprocess.Popen(cmd, env=env, stdout=self.log, stderr=subprocess.STDOUT,
+                                preexec_fn=lambda: os.nice(10))
+        # still pinned while moved from pending to proc
+        with self.lock:
+            self.step, self.proc = step, proc
+            self.pending.popleft()
+
+    # compress the remaining checkpoints
+    def _after_train(self):
+        while self.proc is not None or self.pending:
+            if self.proc is not None:
+                self.proc.wait()
+            self._poll()
+        self.log.close()
+        if self.saver is not None:
+            self.saver.release()
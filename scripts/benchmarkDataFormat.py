@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+# File: benchmarkDataFormat.py
+
+import argparse
+import json
+
+from benchmarkUtils import *
+
+"""
+Compare the NHWC and NCHW layouts of the models on this machine: inference
+throughput (images/sec) and training throughput (steps/sec) on random data.
+NCHW usually fails or is slow on CPU unless TensorFlow is built with MKL; the
+error is reported in the table. Each configuration runs in its own process.
+
+Usage:
+    python benchmarkDataFormat.py --models cifar,cifar-compressed -n 18
+    python benchmarkDataFormat.py --models imagenet -d 50 --batch 32
+"""
+
+def run(name, data_format, args):
+    with tf.Graph().as_default():
+        model, num_class = get_model(name, data_format, n=args.num_units, depth=args.depth)
+        inputs, train_op = build_train_op(model)
+        feed_dict = to_feed_dict(inputs, fake_feed(model, args.batch, num_class))
+        with tf.Session(config=session_config(args.threads)) as sess:
+            sess.run(tf.global_variables_initializer())
+            train = time_steps(sess, train_op, feed_dict, args.steps)
+    with tf.Graph().as_default():
+        model, num_class = get_model(name, data_format, n=args.num_units, depth=args.depth,
+                                     predict_only=True)
+        inputs = build_inference_graph(model)
+        logits = tf.get_default_graph().get_tensor_by_name('linear/output:0')
+        feed_dict = to_feed_dict(inputs, fake_feed(model, args.batch, num_class))
+        with tf.Session(config=session_config(args.threads)) as sess:
+            sess.run(tf.global_variables_initializer())
+            infer = time_steps(sess, logits, feed_dict, args.steps)
+    return {'train_steps_per_s': 1.0 / np.mean(train),
+            'infer_images_per_s': args.batch / np.mean(infer)}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--models', help='comma separated list of cifar, cifar-compressed, '
+                        'imagenet, imagenet-compressed', default='cifar,cifar-compressed')
+    parser.add_argument('-n', '--num_units', help='number of units in each stage of cifar',
+                        type=int, default=18)
+    parser.add_argument('-d', '--depth', help='imagenet resnet depth',
+                        type=int, default=50, choices=[18, 34, 50, 101, 152])
+    parser.add_argument('--data_formats', default='NHWC,NCHW')
+    parser.add_argument('--batch', type=int, default=64)
+    parser.add_argument('--steps', type=int, default=10)
+    parser.add_argument('--threads', help='intra-op threads, default: all cores', type=int)
+    parser.add_argument('--output', help='save the results as json')
+    args = parser.parse_args()
+
+    rows = []
+    for name in args.models.split(','):
+        for data_format in args.data_formats.split(','):
+            r = run_isolated(run, name, data_format, args)
+            r.update({'model': name, 'data_format': data_format})
+            rows.append(r)
+    print_table(rows, ['model', 'data_format', 'train_steps_per_s',
+                       'infer_images_per_s', 'peak_rss_mb', 'failure'])
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(rows, f, indent=2)
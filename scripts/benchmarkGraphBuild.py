@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+# File: benchmarkGraphBuild.py
+
+import argparse
+import json
+import os
+import time
+
+from benchmarkUtils import *
+
+"""
+Compare the unrolled CIFAR epsilon-ResNet with the while_loop builder (--loop):
+graph construction time, graph size, session startup (creation and variable
+initialization), first step and steady step time. Each configuration runs in
+its own process on random data.
+
+Usage:
+    python benchmarkGraphBuild.py -n 18,33,83,125 --towers 2
+"""
+
+def run(n, loop, args):
+    import cifarEpsilonResnet
+    with tf.Graph().as_default() as g:
+        start = time.time()
+        model = cifarEpsilonResnet.Model(args.epsilon, 10, n, loop=loop)
+        inputs, train_op = build_train_op(model, args.towers)
+        build = time.time() - start
+        rst = {'n': n, 'loop': loop, 'build_s': build,
+               'nodes': len(g.get_operations()),
+               'graph_def_mb': len(g.as_graph_def().SerializeToString()) / 1024.0 / 1024.0}
+        feed_dict = to_feed_dict(inputs, fake_feed(model, args.batch, 10))
+
+        start = time.time()
+        sess = tf.Session()
+        sess.run(tf.global_variables_initializer())
+        rst['startup_s'] = time.time() - start
+        start = time.time()
+        sess.run(train_op, feed_dict=feed_dict)
+        rst['first_step_s'] = time.time() - start
+        rst['step_s'] = float(np.mean(time_steps(sess, train_op, feed_dict, args.steps, warmup=0)))
+        sess.close()
+    return rst
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--gpu', help='comma separated list of GPU(s) to use.')
+    parser.add_argument('-n', '--num_units', help='comma separated numbers of units in each stage',
+                        default='18,33,83,125')
+    parser.add_argument('-e', '--epsilon', type=float, default=2.5)
+    parser.add_argument('--towers', help='number of replicated towers', type=int, default=1)
+    parser.add_argument('--batch', type=int, default=32)
+    parser.add_argument('--steps', type=int, default=5)
+    parser.add_argument('--output', help='save the results as json')
+    args = parser.parse_args()
+    if args.gpu:
+        os.environ['CUDA_VISIBLE_DEVICES'] = args.gpu
+
+    rows = []
+    for n in [int(x) for x in args.num_units.split(',')]:
+        for loop in [False, True]:
+            r = run_isolated(run, n, loop, args)
+            r.update({'n': n, 'loop': loop})
+            rows.append(r)
+    print_table(rows, ['n', 'loop', 'build_s', 'nodes', 'graph_def_mb',
+                       'startup_s', 'first_step_s', 'step_s', 'peak_rss_mb', 'failure'])
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(rows, f, indent=2)
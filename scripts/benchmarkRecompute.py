@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+# File: benchmarkRecompute.py
+
+import argparse
+import json
+import math
+import os
+
+from benchmarkUtils import *
+from compressModel import cfg as depth_cfg
+
+"""
+Benchmark peak memory and step time of epsilon-ResNet training versus the
+segment size of gradient checkpointing (--recompute of the training scripts).
+Each segment size is run in its own process on random data.
+
+Usage:
+    python benchmarkRecompute.py --model cifar -n 125 --batch 128 --segments 0,1,5,11,25
+    python benchmarkRecompute.py --model imagenet -d 152 --batch 32 --data_format NHWC
+"""
+
+def run(args, segment):
+    with tf.Graph().as_default():
+        model, num_class = get_model(args.model, args.data_format, n=args.num_units,
+                                     depth=args.depth, epsilon=args.epsilon, recompute=segment)
+        inputs, train_op = build_train_op(model)
+        fetches = [train_op]
+        if tf.test.is_gpu_available():
+            fetches.append(tf.contrib.memory_stats.MaxBytesInUse())
+        feed_dict = to_feed_dict(inputs, fake_feed(model, args.batch, num_class))
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            durations = time_steps(sess, fetches, feed_dict, args.steps)
+            rst = {'segment': segment, 'step_time': float(np.mean(durations))}
+            if len(fetches) > 1:
+                rst['peak_device_mb'] = sess.run(fetches[1]) / 1024.0 / 1024.0
+    return rst
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--gpu', help='comma separated list of GPU(s) to use.')
+    parser.add_argument('--model', choices=['cifar', 'imagenet'], default='cifar')
+    parser.add_argument('-n', '--num_units', help='number of units in each stage of cifar',
+                        type=int, default=125)
+    parser.add_argument('-d', '--depth', help='imagenet resnet depth',
+                        type=int, default=152, choices=[18, 34, 50, 101, 152])
+    parser.add_argument('-e', '--epsilon', type=float, default=2.5)
+    parser.add_argument('--data_format', help='specify NCHW or NHWC, default: NCHW with GPU, NHWC without',
+                        type=str, choices=['NCHW', 'NHWC'])
+    parser.add_argument('--batch', type=int, default=128)
+    parser.add_argument('--steps', type=int, default=10)
+    parser.add_argument('--segments', help='comma separated segment sizes, 0 means no recomputation. '
+                        'Default: 0, 1, sqrt(n) and n')
+    parser.add_argument('--output', help='save the results as json')
+    args = parser.parse_args()
+    if args.gpu:
+        os.environ['CUDA_VISIBLE_DEVICES'] = args.gpu
+
+    if args.segments:
+        segments = [int(x) for x in args.segments.split(',')]
+    else:
+        n = args.num_units if args.model == 'cifar' else max(depth_cfg[args.depth])
+        segments = sorted(set([0, 1, int(round(math.sqrt(n))), n]))
+
+    rows = [run_isolated(run, args, s) for s in segments]
+    for s, r in zip(segments, rows):
+        r.setdefault('segment', s)
+    print_table(rows, ['segment', 'step_time', 'peak_rss_mb', 'peak_device_mb', 'failure'])
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(rows, f, indent=2)
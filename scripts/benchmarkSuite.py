@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+# File: benchmarkSuite.py
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import time
+import numpy as np
+
+import sys
+sys.path.append('../../tensorpack')
+from tensorpack import *
+
+from benchmarkUtils import get_model, build_train_op, fake_feed, to_feed_dict, session_config, \
+    time_steps, percentile, run_isolated, print_table
+from graphCache import build_inference_graph
+from compressModel import cfg as depth_cfg
+
+import tensorflow as tf
+
+"""
+The standard CPU benchmark of the epsilon-ResNets and of the compressed
+models, to compare machines, TensorFlow builds and changes of the code.
+
+The suite covers cifar with n in --num_units and imagenet with depth in
+--depths. For each of them, the epsilon-ResNet and the compressed models at
+every level of --levels are measured, the level being the fraction of the
+blocks of each group which are discarded (0 is the plain ResNet, without the
+gates), plus the compressed models of --cfgs. Each model is run on random
+data, twice, each time in its own process:
+  - train: the training steps/sec at --train_batch;
+  - infer: the images/sec at every batch size of --batches, and the p50 and
+    p99 latency at batch 1.
+Both report the startup time, from the construction of the graph to the end
+of the first step, and the peak RSS of the process. The seeds and the number
+of threads are fixed.
+
+The json has the environment of the run and a row per model and kind. With
+--baseline, an earlier json, the metrics of the same rows are compared and
+the changes beyond --tolerance are reported as regressions; with
+--fail_on_regression the exit code is 1 if there is any.
+
+Usage:
+    python benchmarkSuite.py --suite cifar --output bench.json
+    python benchmarkSuite.py --suite all --threads 8 --baseline bench.json --fail_on_regression
+"""
+
+CIFAR_UNITS = [18, 33, 83, 125]
+IMAGENET_DEPTHS = [18, 34, 50, 101, 152]
+SEED = 2017
+# the metrics compared with the baseline, and whether higher is better
+METRICS = {'train_steps_per_s': True, 'latency_ms_p50': False, 'latency_ms_p99': False,
+           'startup_s': False, 'peak_rss_mb': False}
+
+
+# the blocks kept in each group when a fraction `level` of them is discarded
+def kept_blocks(blocks, level):
+    return [max(1, b - int(round(b * level))) for b in blocks]
+
+# the models of the suite, a dict of the arguments of get_model each
+def suite_models(args):
+    models = []
+    for suite, sizes in [('cifar', args.num_units), ('imagenet', args.depths)]:
+        if args.suite not in [suite, 'all']:
+            continue
+        for size in sizes:
+            arch = {'n': size} if suite == 'cifar' else {'depth': size}
+            tag = '{}{}'.format('n' if suite == 'cifar' else 'd', size)
+            models.append(dict(arch, key='{}-{}'.format(suite, tag), name=suite))
+            blocks = [size] * 3 if suite == 'cifar' else depth_cfg[size]
+            for level in args.levels:
+                models.append(dict(arch, key='{}-compressed-{}-l{}'.format(suite, tag, level),
+                                   name=suite + '-compressed', keep=kept_blocks(blocks, level)))
+    for cfg in args.cfgs:
+        with open(cfg, 'r') as f:
+            name = 'cifar-compressed' if 'is_cifar_model: True' in f.read() else 'imagenet-compressed'
+        models.append({'key': os.path.abspath(cfg), 'name': name, 'cfg': cfg})
+    return models
+
+def _build(m, args, **kwargs):
+    tf.set_random_seed(SEED)
+    np.random.seed(SEED)
+    arch = dict((k, v) for k, v in m.items() if k not in ['key', 'name'])
+    return get_model(m['name'], args.data_format, epsilon=args.epsilon, **dict(arch, **kwargs))
+
+def run_train(m, args):
+    start = time.time()
+    with tf.Graph().as_default():
+        model, num_class = _build(m, args)
+        inputs, train_op = build_train_op(model)
+        feed_dict = to_feed_dict(inputs, fake_feed(model, args.train_batch, num_class))
+        with tf.Session(config=session_config(args.threads)) as sess:
+            sess.run(tf.global_variables_initializer())
+            sess.run(train_op, feed_dict=feed_dict)
+            startup = time.time() - start
+            train = time_steps(sess, train_op, feed_dict, args.steps, warmup=1)
+    return {'startup_s': startup, 'train_steps_per_s': 1.0 / np.mean(train)}
+
+def run_infer(m, args):
+    start = time.time()
+    rst = {}
+    with tf.Graph().as_default():
+        model, num_class = _build(m, args, predict_only=True)
+        inputs = build_inference_graph(model)
+        output = tf.get_default_graph().get_tensor_by_name('output:0')
+        with tf.Session(config=session_config(args.threads)) as sess:
+            sess.run(tf.global_variables_initializer())
+            feed_dict = to_feed_dict(inputs, fake_feed(model, 1, num_class))
+            sess.run(output, feed_dict=feed_dict)
+            rst['startup_s'] = time.time() - start
+            latency = time_steps(sess, output, feed_dict, args.latency_steps, warmup=1)
+            rst['latency_ms_p50'] = percentile(latency, 50) * 1000
+            rst['latency_ms_p99'] = percentile(latency, 99) * 1000
+            for batch in args.batches:
+                feed_dict = to_feed_dict(inputs, fake_feed(model, batch, num_class))
+                durations = time_steps(sess, output, feed_dict, args.steps)
+                rst['images_per_s_b{}'.format(batch)] = batch / np.mean(durations)
+    return rst
+
+def environment(args):
+    return {'tensorflow': tf.__version__, 'python': platform.python_version(),
+            'platform': platform.platform(), 'processor': platform.processor(),
+            'cpus': multiprocessing.cpu_count(), 'threads': args.threads,
+            'data_format': args.data_format, 'seed': SEED}
+
+# the changes of the metrics of the rows also in the baseline, the
+#   regressions are those worse than tolerance
+def compare(rows, baseline, tolerance):
+    old = dict(((r['model'], r['kind']), r) for r in baseline['results'])
+    changes = []
+    for r in rows:
+        b = old.get((r['model'], r['kind']))
+        if b is None:
+            continue
+        for k in sorted(r.keys()):
+            higher_better = METRICS.get(k, k.startswith('images_per_s'))
+            if not isinstance(r[k], float) or not isinstance(b.get(k), float) or not b[k]:
+                continue
+            change = r[k] / b[k] - 1.0
+            worse = -change if higher_better else change
+            changes.append({'model': r['model'], 'kind': r['kind'], 'metric': k,
+                            'baseline': b[k], 'value': r[k], 'change': change,
+                            'regression': worse > tolerance})
+    return changes
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--suite', choices=['cifar', 'imagenet', 'all'], default='all')
+    parser.add_argument('--num_units', help='comma separated units per stage of cifar',
+                        default=','.join(str(n) for n in CIFAR_UNITS))
+    parser.add_argument('--depths', help='comma separated imagenet depths',
+                        default=','.join(str(d) for d in IMAGENET_DEPTHS))
+    parser.add_argument('--levels', help='comma separated fractions of the blocks discarded '
+                        'in the compressed models', default='0,0.5,0.75')
+    parser.add_argument('--cfgs', help='comma separated .cfg of compressed models to add', default='')
+    parser.add_argument('-e', '--epsilon', type=float, default=2.5)
+    parser.add_argument('--kinds', help='comma separated train, infer', default='train,infer')
+    parser.add_argument('--train_batch', type=int, default=32)
+    parser.add_argument('--batches', help='comma separated batch sizes of the inference',
+                        default='1,8,32,128')
+    parser.add_argument('--steps', help='timed steps of the training and of each batch size',
+                        type=int, default=10)
+    parser.add_argument('--latency_steps', help='runs at batch 1', type=int, default=50)
+    parser.add_argument('--data_format', help='specify NCHW or NHWC, default: NHWC',
+                        type=str, choices=['NCHW', 'NHWC'], default='NHWC')
+    parser.add_argument('--threads', help='intra-op threads, default: all cores', type=int)
+    parser.add_argument('--output', help='save the results as json')
+    parser.add_argument('--baseline', help='json of an earlier run to compare with')
+    parser.add_argument('--tolerance', help='relative change of a metric reported as regression',
+                        type=float, default=0.05)
+    parser.add_argument('--fail_on_regression', action='store_true')
+    args = parser.parse_args()
+    # the suite is for CPU
+    os.environ['CUDA_VISIBLE_DEVICES'] = ''
+    args.num_units = [int(n) for n in args.num_units.split(',') if n]
+    args.depths = [int(d) for d in args.depths.split(',') if d]
+    args.levels = [float(l) for l in args.levels.split(',') if l]
+    args.cfgs = [c for c in args.cfgs.split(',') if c]
+    args.batches = [int(b) for b in args.batches.split(',') if b]
+
+    rows = []
+    for m in suite_models(args):
+        for kind in args.kinds.split(','):
+            r = run_isolated(run_train if kind == 'train' else run_infer, m, args)
+            r.update({'model': m['key'], 'kind': kind})
+            logger.info('[benchmarkSuite] {}'.format(r))
+            rows.append(r)
+    infer_keys = ['images_per_s_b{}'.format(b) for b in args.batches]
+    print_table(rows, ['model', 'kind', 'train_steps_per_s'] + infer_keys +
+                ['latency_ms_p50', 'latency_ms_p99', 'startup_s', 'peak_rss_mb', 'failure'])
+    report = {'environment': environment(args), 'results': rows}
+    regressions = []
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            report['comparison'] = compare(rows, json.load(f), args.tolerance)
+        regressions = [c for c in report['comparison'] if c['regression']]
+        print_table(report['comparison'], ['model', 'kind', 'metric', 'baseline', 'value',
+                                           'change', 'regression'])
+        logger.info('[benchmarkSuite] {} regressions beyond {:.0%}'.format(
+            len(regressions), args.tolerance))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if regressions and args.fail_on_regression:
+        sys.exit(1)
@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+# File: benchmarkUtils.py
+
+import multiprocessing
+import resource
+import time
+import numpy as np
+from six.moves.queue import Empty
+
+import sys
+sys.path.append('../../tensorpack')
+from tensorpack import *
+from tensorpack.tfutils.tower import TowerContext
+from graphCache import build_inference_graph
+from EpsilonResnetBase import POLL_SECONDS
+
+import tensorflow as tf
+
+"""
+Helpers shared by the benchmark scripts: build a ModelDesc outside of a
+trainer, feed it with random data, time the steps and measure the peak memory
+of each configuration in its own process.
+"""
+
+# random inputs matching the InputDesc of a model
+#   float inputs are images in [0, 255), int inputs are labels in [0, num_class)
+def fake_feed(model, batch_size, num_class):
+    feed = {}
+    for desc in model.get_inputs_desc():
+        shape = [batch_size if d is None else d for d in desc.shape]
+        if desc.type in [tf.int32, tf.int64]:
+            feed[desc.name] = np.random.randint(0, num_class, size=shape)
+        else:
+            feed[desc.name] = np.random.uniform(0, 255, size=shape)
+        feed[desc.name] = feed[desc.name].astype(desc.type.as_numpy_dtype)
+    return feed
+
+# build the training graph of model in the default graph
+#   towers > 1 replicates the model and averages the gradients, as
+#   SyncMultiGPUTrainer does, without placing the towers on devices.
+#   return the placeholders and the training op
+def build_train_op(model, towers=1):
+    inputs = model.get_reused_placehdrs()
+    opt = model.get_optimizer()
+    tower_grads = []
+    for k in range(towers):
+        with tf.variable_scope(tf.get_variable_scope(), reuse=k > 0), \
+                TowerContext('tower{}'.format(k) if towers > 1 else '', is_training=True):
+            model.build_graph(inputs)
+            tower_grads.append(opt.compute_gradients(model.get_cost()))
+    grads = []
+    for gv in zip(*tower_grads):
+        g = [tf.convert_to_tensor(x[0]) for x in gv if x[0] is not None]
+        if len(g):
+            grads.append((tf.add_n(g) / float(len(g)), gv[0][1]))
+    with tf.control_dependencies(tf.get_collection(tf.GraphKeys.UPDATE_OPS)):
+        train_op = opt.apply_gradients(grads, global_step=get_global_step_var())
+    return inputs, train_op
+
+# threads: number of intra-op threads, None for all cores
+def session_config(threads=None):
+    config = tf.ConfigProto(allow_soft_placement=True)
+    if threads:
+        config.intra_op_parallelism_threads = threads
+        config.inter_op_parallelism_threads = 1
+    return config
+
+def to_feed_dict(inputs, feed):
+    return dict((x, feed[x.op.name]) for x in inputs if x.op.name in feed)
+
+# run fetches `warmup + steps` times, return the durations of the last `steps`
+def time_steps(sess, fetches, feed_dict, steps, warmup=2):
+    for _ in range(warmup):
+        sess.run(fetches, feed_dict=feed_dict)
+    durations = []
+    for _ in range(steps):
+        start = time.time()
+        sess.run(fetches, feed_dict=feed_dict)
+        durations.append(time.time() - start)
+    return durations
+
+def percentile(durations, q):
+    return float(np.percentile(durations, q)) if len(durations) else float('nan')
+
+# peak resident memory of this process in MB
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+def _isolated(fn, args, queue):
+    try:
+        rst = fn(*args)
+        rst['peak_rss_mb'] = peak_rss_mb()
+        queue.put(rst)
+    except Exception as e:
+        queue.put({'failure': '{}: {}'.format(type(e).__name__, e)})
+
+# run fn(*args) in a new process so that its peak memory is not shared with
+#   other configurations. fn returns a dict, to which peak_rss_mb is added.
+#   An exception of fn gives {'failure': '<type>: <message>'}, and a process
+#   killed, e.g. by the OOM killer, {'failure': 'killed: <exitcode>'}.
+def run_isolated(fn, *args):
+    queue = multiprocessing.Queue()
+    p = multiprocessing.Process(target=_isolated, args=(fn, args, queue))
+    p.start()
+    while True:
+        try:
+            rst = queue.get(timeout=POLL_SECONDS)
+            break
+        except Empty:
+            if p.is_alive():
+                continue
+            # the result may have been put just before the exit
+            try:
+                rst = queue.get(timeout=1)
+            except Empty:
+                rst = {'failure': 'killed: {}'.format(p.exitcode)}
+            break
+    p.join()
+    return rst
+
+def print_table(rows, keys):
+    print('\t'.join(keys))
+    for r in rows:
+        print('\t'.join(
+            '{:.4g}'.format(r[k]) if isinstance(r.get(k), float) else str(r.get(k, ''))
+            for k in keys))
+
+# build one of the models of the scripts
+#   name: cifar, cifar-compressed, imagenet or imagenet-compressed
+#   n: units per stage of cifar, depth: imagenet depth
+#   cfg: the .cfg of a compressed model, otherwise the uncompressed structure is used
+#   keep: the blocks kept in each group of a compressed model without cfg
+#   data_format: None for the default of this machine
+#   return the model and its number of classes
+def get_model(name, data_format, n=18, depth=50, epsilon=2.5, cfg=None, keep=None, **kwargs):
+    from compressModel import read_cfg, read_channels, cfg as depth_cfg
+    from EpsilonResnetBase import default_data_format
+    data_format = data_format or default_data_format()
+    structure, discard_first_block, channels = None, None, None
+    if cfg:
+        n, structure, discard_first_block, _ = read_cfg(cfg)
+        depth = n
+        structure = list(np.add(structure, discard_first_block))
+        channels = read_channels(cfg)
+    elif keep is not None:
+        structure, discard_first_block = list(keep), [0] * len(keep)
+    if name == 'cifar':
+        import cifarEpsilonResnet
+        return cifarEpsilonResnet.Model(epsilon, 10, n, data_format=data_format, **kwargs), 10
+    if name == 'cifar-compressed':
+        import cifarCompressedResnet
+        if structure is None:
+            structure, discard_first_block = [n] * 3, [0] * 3
+        return cifarCompressedResnet.Model(10, structure, discard_first_block, n,
+                                           data_format=data_format, channels=channels, **kwargs), 10
+    if name == 'imagenet':
+        import imagenetEpsilonResnet
+        defs = depth_cfg[depth]
+        imagenetEpsilonResnet.DEPTH = depth
+        imagenetEpsilonResnet.EPSILON = epsilon
+        imagenetEpsilonResnet.SIDE_POSITION = imagenetEpsilonResnet.side_position(defs)
+        return imagenetEpsilonResnet.Model(data_format=data_format, **kwargs), 1000
+    if name == 'imagenet-compressed':
+        import imagenetCompressedResnet
+        imagenetCompressedResnet.DEPTH = depth
+        imagenetCompressedResnet.structure = structure or []
+        imagenetCompressedResnet.discard_first_block = discard_first_block or []
+        return imagenetCompressedResnet.Model(data_format=data_format, channels=channels, **kwargs), 1000
+    raise ValueError('unknown model {}'.format(name))
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+# File: channelStats.py
+
+import argparse
+import json
+import os
+import re
+import numpy as np
+
+import sys
+sys.path.append('../../tensorpack')
+from tensorpack import *
+
+from EpsilonResnetBase import default_data_format, channel_axis
+from graphCache import load_inference_graph, restore_variables
+from evalModels import get_model, get_script_data
+from benchmarkUtils import session_config
+
+import tensorflow as tf
+
+"""
+The per-channel responses of the convolutions of the blocks of an
+epsilon-ResNet, for the channel pruning of compressModel.py.
+
+strict_identity discards a block when the max |response| of its last conv is
+below epsilon. The same statistic is computed here for every output channel
+of every conv of the blocks, res{g}.{k}/conv{i} of cifar and svhn and
+group{g}/block{k}/conv{i} of imagenet, over --batches batches of the training
+data of the script: the max of |output| over the images and the positions.
+The output of conv1 of the blocks, and conv2 of the bottlenecks, is taken
+after its BNReLU, i.e. as it is read by the next conv.
+
+The json is given to compressModel.py with --channel_stats, the channels whose
+response is <= --channel_epsilon are removed from the kernels and the batch
+norms of the kept blocks. With --channel_epsilon 0 only the channels which are
+zero on all the calibration images are removed.
+
+Usage:
+    python channelStats.py --model train_log/cifarEpsilonResnet/model-1000 --dataset cifar10 -n 18 -e 2.5
+    python compressModel.py --dir train_log/cifarEpsilonResnet --step 1000 \\
+        --channel_stats train_log/cifarEpsilonResnet/model-1000.channel_stats.json --channel_epsilon 0.01
+"""
+
+# the outputs of the convs of the blocks
+re_CONV_OUTPUT = '^((res\d+\.\d+|group\d+/block\d+)/conv\d+)/output$'
+
+
+# the output tensors of the convs of the blocks, by block name/conv
+def conv_outputs(graph):
+    outputs = {}
+    for op in graph.get_operations():
+        rst = re.match(re_CONV_OUTPUT, op.name)
+        if rst:
+            outputs[rst.group(1)] = op.outputs[0]
+    return outputs
+
+def collect(model_path, args):
+    """
+    Returns:
+        dict: block name/conv -> the max |output| of each of its channels,
+        and the number of images.
+    """
+    model, script, arch, model_path = get_model(model_path, args)
+    graph = load_inference_graph(model, script, args.graph_cache, **arch)
+    ch_axis = channel_axis(args.data_format)
+    with graph.as_default():
+        outputs = conv_outputs(graph)
+        names = sorted(outputs.keys())
+        # the max over the images and the positions, per channel
+        maxes = [tf.reduce_max(tf.abs(outputs[n]), [a for a in range(4) if a != ch_axis])
+                 for n in names]
+        x = graph.get_tensor_by_name('input:0')
+        sess = tf.Session(config=session_config(args.threads))
+        restore_variables(sess, model_path)
+    logger.info('[channelStats] {} convs in {}'.format(len(names), model_path))
+    stats = [None] * len(names)
+    count, images = 0, 0
+    ds = get_script_data(args, train=True)
+    ds.reset_state()
+    with sess:
+        for dp in ds.get_data():
+            if count >= args.batches:
+                break
+            for k, v in enumerate(sess.run(maxes, feed_dict={x: dp[0]})):
+                stats[k] = v if stats[k] is None else np.maximum(stats[k], v)
+            count += 1
+            images += len(dp[0])
+    return dict((n, [float(r) for r in s]) for n, s in zip(names, stats)), images
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', help='checkpoint of an epsilon-ResNet', required=True)
+    parser.add_argument('--dataset', help='calibration data', default='cifar10',
+                        choices=['cifar10', 'cifar100', 'svhn', 'imagenet'])
+    parser.add_argument('--data', help='ILSVRC dataset dir')
+    parser.add_argument('-n', '--num_units', help='units per stage of cifar and svhn',
+                        type=int, default=18)
+    parser.add_argument('-d', '--depth', help='depth of imagenet',
+                        type=int, default=50, choices=[18, 34, 50, 101, 152])
+    parser.add_argument('-e', '--epsilon', help='epsilon of the model', type=float, default=2.5)
+    parser.add_argument('--batches', help='batches of the training data', type=int, default=100)
+    parser.add_argument('--batch', type=int, default=128)
+    parser.add_argument('--data_format', help='specify NCHW or NHWC, default: NCHW with GPU, NHWC without',
+                        type=str, choices=['NCHW', 'NHWC'])
+    parser.add_argument('--threads', help='intra-op threads, default: all cores', type=int)
+    parser.add_argument('--graph_cache', help='directory to cache the inference graphs')
+    parser.add_argument('--gpu', help='comma separated list of GPU(s) to use.')
+    parser.add_argument('--output', help='the json, default: the checkpoint with .channel_stats.json')
+    args = parser.parse_args()
+    if args.gpu:
+        os.environ['CUDA_VISIBLE_DEVICES'] = args.gpu
+    args.data_format = args.data_format or default_data_format()
+    args.output = args.output or args.model + '.channel_stats.json'
+
+    stats, images = collect(args.model, args)
+    with open(args.output, 'w') as f:
+        json.dump({'model': os.path.abspath(args.model), 'dataset': args.dataset,
+                   'epsilon': args.epsilon, 'batches': args.batches, 'images': images,
+                   'stats': stats}, f)
+    channels = sum(len(s) for s in stats.values())
+    zeros = sum(sum(1 for r in s if r == 0) for s in stats.values())
+    logger.info('[channelStats] {} channels, {} zero on {} images, written to {}'.format(
+        channels, zeros, images, args.output))
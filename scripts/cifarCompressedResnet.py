@@ -16,7 +16,12 @@ from tensorpack.utils.stats import RatioCounter
 from tensorpack.tfutils.symbolic_functions import *
 from tensorpack.tfutils.summary import *
 
-from compressModel import read_cfg
+from compressModel import read_cfg, read_channels
+from EpsilonResnetBase import default_data_format, check_data_format, channel_axis, pad_channel, \
+    scatter_channels
+from graphCache import cached_dataset_predictor
+import sequentialEval
+import parallelEval
 
 import tensorflow as tf
 from tensorflow.contrib.layers import variance_scaling_initializer
@@ -40,41 +45,62 @@ To train:
 BATCH_SIZE = 128
 NUM_UNITS = None
 OUTDIR = ''
+GRAPH_CACHE = None
+DATA_FORMAT = 'NCHW'
+# the arguments of sequentialEval.sequential_eval with --sequential
+SEQUENTIAL = None
+# processes and threads of each process of the evaluation, see parallelEval.py
+EVAL_PROCS = 1
+EVAL_THREADS = None
 IS_CIFAR10 = True
 NUM_CLASS = 10
 
 structure = []
 discard_first_block = []
+# the pruned channels of the blocks, see compressModel.prune_channels
+block_channels = None
 
 class Model(ModelDesc):
 
-    def __init__(self, NUM_CLASS, structure, discard_first_block, n):
+    # predict_only: take the images alone and build the logits and the
+    #   probabilities `output`, without loss, summaries and label
+    # channels: the kept channels of the pruned convs of the blocks, see
+    #   compressModel.prune_channels
+    def __init__(self, NUM_CLASS, structure, discard_first_block, n, data_format='NCHW',
+                 predict_only=False, channels=None):
         super(Model, self).__init__()
         self.n = n
         self.NUM_CLASS = NUM_CLASS
         self.structure = structure
         self.discard_first_block = discard_first_block
+        check_data_format(data_format)
+        self.data_format = data_format
+        self.predict_only = predict_only
+        self.channels = channels or {}
 
     def _get_inputs(self):
+        if self.predict_only:
+            return [InputDesc(tf.float32, [None, 32, 32, 3], 'input')]
         return [InputDesc(tf.float32, [None, 32, 32, 3], 'input'),
                 InputDesc(tf.int32, [None], 'label')]
 
     def _build_graph(self, inputs):
-        image, label = inputs
+        image = inputs[0]
         image = image / 128.0
-        assert tf.test.is_gpu_available()
-        image = tf.transpose(image, [0, 3, 1, 2])
+        if self.data_format == 'NCHW':
+            image = tf.transpose(image, [0, 3, 1, 2])
+        ch_axis = channel_axis(self.data_format)
 
         cnt = tf.placeholder(tf.int32, [None,784], name='x-input')
         
         def first_block(name, l):
-            in_channel = l.get_shape().as_list()[1]
+            in_channel = l.get_shape().as_list()[ch_axis]
             out_channel = in_channel * 2
             
             grp = int(name[3])
             if self.discard_first_block[grp-1] == 1:
                 l = AvgPooling('pool', l, 2)
-                l = tf.pad(l, [[0, 0], [in_channel // 2, in_channel // 2], [0, 0], [0, 0]])
+                l = pad_channel(l, in_channel // 2, self.data_format)
             else:
                 l = residual(name, l, increase_dim=True)
             return l
@@ -82,7 +108,7 @@ class Model(ModelDesc):
 
         def residual(name, l, increase_dim=False, first=False):
             shape = l.get_shape().as_list()
-            in_channel = shape[1]
+            in_channel = shape[ch_axis]
 
             if increase_dim:
                 out_channel = in_channel * 2
@@ -91,19 +117,26 @@ class Model(ModelDesc):
                 out_channel = in_channel
                 stride1 = 1
             
+            # the kept channels of the convs, the pruned channels of conv2 are
+            #   put back as zeros to be added to the shortcut
+            kept = self.channels.get(name, {})
+            kept1 = kept.get('conv1', range(out_channel))
+            kept2 = kept.get('conv2', range(out_channel))
+
             #implement: full pre-activation
             with tf.variable_scope(name) as scope:
                 b1 = l if first else BNReLU(l)
-                c1 = Conv2D('conv1', b1, out_channel, stride=stride1, nl=BNReLU)
-                c2 = Conv2D('conv2', c1, out_channel)
+                c1 = Conv2D('conv1', b1, len(kept1), stride=stride1, nl=BNReLU)
+                c2 = Conv2D('conv2', c1, len(kept2))
+                c2 = scatter_channels(c2, kept2, out_channel, self.data_format)
                 if increase_dim:
                     l = AvgPooling('pool', l, 2)
-                    l = tf.pad(l, [[0, 0], [in_channel // 2, in_channel // 2], [0, 0], [0, 0]])
+                    l = pad_channel(l, in_channel // 2, self.data_format)
 
                 l = c2 + l
                 return l
             l = AvgPooling('pool', l, 2)
-        with argscope([Conv2D, AvgPooling, BatchNorm, GlobalAvgPooling], data_format='NCHW'), \
+        with argscope([Conv2D, AvgPooling, BatchNorm, GlobalAvgPooling], data_format=self.data_format), \
                 argscope(Conv2D, nl=tf.identity, use_bias=False, kernel_shape=3,
                          W_init=variance_scaling_initializer(mode='FAN_OUT')):
             #pdb.set_trace()
@@ -130,8 +163,11 @@ class Model(ModelDesc):
             logits = FullyConnected('linear', l, out_dim=self.NUM_CLASS, nl=tf.identity)
         
         print("logits: "+str(logits.shape))
-        #prob = tf.nn.softmax(logits, name='output')
+        if self.predict_only:
+            tf.nn.softmax(logits, name='output')
+            return
 
+        label = inputs[1]
         cost = tf.nn.sparse_softmax_cross_entropy_with_logits(logits=logits, labels=label)
         print("cost1: "+str(cost.shape))
         cost = tf.reduce_mean(cost, name='cross_entropy_loss')
@@ -156,7 +192,7 @@ class Model(ModelDesc):
         return opt
 
 
-def get_data(train_or_test):
+def get_data(train_or_test, shard=None):
     isTrain = train_or_test == 'train'
     print("=================1 cifar10 = %r" % IS_CIFAR10)
     if IS_CIFAR10:
@@ -164,6 +200,8 @@ def get_data(train_or_test):
     else:
         ds = dataset.Cifar100(train_or_test)
     pp_mean = ds.get_per_pixel_mean()
+    if shard is not None:
+        ds = parallelEval.shard_dataset(ds, *shard)
     if isTrain:
         augmentors = [
             imgaug.CenterPaste((40, 40)),
@@ -183,7 +221,7 @@ def get_data(train_or_test):
 
 
 def get_config():
-    logger.set_logger_dir('train_log.' + out_dir)
+    logger.set_logger_dir('train_log.' + OUTDIR)
     dataset_train = get_data('train')
     dataset_test = get_data('test')
     return TrainConfig(
@@ -195,22 +233,35 @@ def get_config():
             ScheduledHyperParamSetter('learning_rate',
                 [(1, 0.1), (82, 0.01), (123, 0.001), (300, 0.0002)])
         ],
-        model=Model(NUM_CLASS, structure, discard_first_block, n=NUM_UNITS),
+        model=Model(NUM_CLASS, structure, discard_first_block, n=NUM_UNITS,
+                    data_format=DATA_FORMAT, channels=block_channels),
         max_epoch = 10,
         #max_epoch=1,
     )
 
+# the predictor of the test set, or of its shard (rank, size)
+def get_predictor(model_file, shard=None, config=None):
+    return cached_dataset_predictor(
+        Model(NUM_CLASS, structure, discard_first_block, NUM_UNITS, data_format=DATA_FORMAT,
+              predict_only=True, channels=block_channels),
+        model_file, get_data('test', shard), ['input', 'label'], ['incorrect_vector'],
+        cache_dir=GRAPH_CACHE, script='cifarCompressedResnet', session_config=config,
+        structure=structure, discard_first_block=discard_first_block,
+        num_class=NUM_CLASS, data_format=DATA_FORMAT, channels=block_channels)
+
 def eval_on_cifar(model_file):
     print('structure: {}'.format(structure))
-    ds = get_data('test')
-    pred_config = PredictConfig(
-        model=Model(
-            NUM_CLASS, structure, discard_first_block, NUM_UNITS),
-        session_init=get_model_loader(model_file),
-        input_names = ['input', 'label'],
-        output_names = ['incorrect_vector']
-    )
-    pred = SimpleDatasetPredictor(pred_config, ds)
+    if EVAL_PROCS > 1 and SEQUENTIAL is None:
+        counts = parallelEval.parallel_counts(
+            lambda shard, config: parallelEval.count_errors(get_predictor(model_file, shard, config)),
+            EVAL_PROCS, EVAL_THREADS)
+        print("Error: {}".format(parallelEval.ratio(counts[0])))
+        return
+    pred = get_predictor(model_file)
+    if SEQUENTIAL is not None:
+        # the test set of tensorpack is shuffled
+        sequentialEval.sequential_eval(pred, ['Error'], **SEQUENTIAL)
+        return
     acc = RatioCounter()
     for o in pred.get_result():
         batch_size = o[0].shape[0]
@@ -219,12 +270,17 @@ def eval_on_cifar(model_file):
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
-    parser.add_argument('--gpu', help='comma separated list of GPU(s) to use.', required = True)
+    parser.add_argument('--gpu', help='comma separated list of GPU(s) to use.')
     parser.add_argument('-n', '--num_units',
             help='number of units in each stage',
             type=int, default=18)
     parser.add_argument('-o', '--output', help='output', type=str)
     parser.add_argument('--cfg', help = 'config of compressed model', required = True)
+    parser.add_argument('--data_format', help='specify NCHW or NHWC, default: NCHW with GPU, NHWC without',
+                        type=str, choices=['NCHW', 'NHWC'])
+    parser.add_argument('--graph_cache', help='directory to cache the inference graphs of evaluation')
+    sequentialEval.add_arguments(parser)
+    parallelEval.add_arguments(parser)
     feature_parser = parser.add_mutually_exclusive_group(required=False)
     feature_parser.add_argument('--cifar10', help='iscifar10', dest= 'dataset',action = 'store_true')
     feature_parser.add_argument('--cifar100', help='iscifar100', dest= 'dataset',action = 'store_false')
@@ -236,6 +292,11 @@ if __name__ == '__main__':
         os.environ['CUDA_VISIBLE_DEVICES'] = args.gpu
     if args.output:
         OUTDIR = "." + args.output
+    GRAPH_CACHE = args.graph_cache
+    SEQUENTIAL = sequentialEval.from_args(args)
+    EVAL_PROCS = args.eval_procs
+    EVAL_THREADS = args.eval_threads
+    DATA_FORMAT = args.data_format or default_data_format()
     IS_CIFAR10 = args.dataset
     if not IS_CIFAR10:
         NUM_CLASS  = 100
@@ -243,6 +304,7 @@ if __name__ == '__main__':
     if args.cfg:
         NUM_UNITS, structure, discard_first_block, model_path = read_cfg(args.cfg)
         structure = np.add(structure, discard_first_block)
+        block_channels = read_channels(args.cfg)
         print(model_path)
     else:
         structure = [NUM_UNITS] * 3
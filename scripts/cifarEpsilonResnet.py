@@ -18,7 +18,16 @@ from tensorpack.tfutils.summary import *
 from tensorpack.tfutils.gradproc import SummaryGradient
 
 from EpsilonResnetBase import *
-from compressModel import read_cfg
+from LoopResnetBase import loop_residual, LOOP_SCOPE
+from compressModel import read_cfg, read_channels
+import dataParallel
+from adaptiveBatch import ResizableBatchData, BatchSizeGrowth
+from earlyStop import ConvergenceStopper, cifar_block_names
+from asyncCheckpoint import AsyncModelSaver
+from autoCompress import AutoCompressor
+from asyncEval import AsyncValidation, watch, error_stats
+from graphCache import cached_dataset_predictor
+from cifarCompressedResnet import Model as CompressedModel
 
 import tensorflow as tf
 from tensorflow.contrib.layers import variance_scaling_initializer
@@ -43,29 +52,80 @@ EPSILON = 2.5
 NUM_UNITS = None
 IS_CIFAR10 = True
 NUM_CLASS = 10
+RECOMPUTE = 0
+NR_TOWER = 1
+SCALE_LR = False
+WARMUP_EPOCHS = 5
+GROW_BATCH = False
+MAX_BATCH = 1024
+MEMORY_LIMIT = None
+EARLY_STOP = 0
+STOP_TOLERANCE = 0.001
+ASYNC_SAVE = False
+KEEP_EVERY = 50
+AUTO_COMPRESS = False
+ASYNC_EVAL = False
+EVAL_GPU = None
+GRAPH_CACHE = None
+LOOP = False
+# the schedules of LearningRateSetter, UPDATED_LR_SCHEDULE is followed from the
+#   epoch where discarded_cnt increased by LR_THRESHOLD
+LR_SCHEDULE = [(0, 0.1), (82, 0.01), (123, 0.001), (300, 0.0002)]
+UPDATED_LR_SCHEDULE = [(0, 0.1), (41, 0.01), (61, 0.001), (150, 0.0002)]
+LR_THRESHOLD = 1
+# (fraction of the training set, fraction of the test set, seed) of
+#   dataParallel.subsample, set by timeToAccuracy.py
+SUBSAMPLE = None
+# callbacks run after the others, e.g. by timeToAccuracy.py
+EXTRA_CALLBACKS = []
+DATA_FORMAT = 'NCHW'
 
 class Model(ModelDesc):
 
-    def __init__(self, EPSILON, NUM_CLASS, n):
+    def __init__(self, EPSILON, NUM_CLASS, n, recompute=0, loop=False, data_format='NCHW',
+                 predict_only=False):
+        """
+        Args:
+            data_format (str): NCHW for GPU or NHWC for CPU.
+            recompute (int): if > 0, keep activations only at the boundaries of
+                segments of `recompute` blocks and recompute the rest in the
+                backward pass. About sqrt(n) gives the lowest memory.
+            loop (bool): build res{g}.1 .. res{g}.{n-1} with a tf.while_loop
+                over stacked weights in res{g}.loop, see LoopResnetBase.py.
+            predict_only (bool): take the images alone and build the logits
+                and the probabilities `output`, without loss, summaries,
+                is_discarded statistics and side output.
+        """
         super(Model, self).__init__()
         self.n = n
         self.EPSILON = EPSILON
         self.NUM_CLASS = NUM_CLASS
+        self.recompute = recompute
+        if recompute > 0:
+            check_recompute_grad()
+        self.loop = loop
+        check_data_format(data_format)
+        self.data_format = data_format
+        self.predict_only = predict_only
 
     def _get_inputs(self):
+        if self.predict_only:
+            return [InputDesc(tf.float32, [None, 32, 32, 3], 'input')]
         return [InputDesc(tf.float32, [None, 32, 32, 3], 'input'),
                 InputDesc(tf.int32, [None], 'label')]
 
     def _build_graph(self, inputs):
-        image, label = inputs
+        image = inputs[0]
+        label = None if self.predict_only else inputs[1]
         image = image / 128.0
-        assert tf.test.is_gpu_available()
-        image = tf.transpose(image, [0, 3, 1, 2])
+        if self.data_format == 'NCHW':
+            image = tf.transpose(image, [0, 3, 1, 2])
+        ch_axis = channel_axis(self.data_format)
         
         all_cnt = tf.constant(self.n * 3+2, tf.float32, name="all_cnt")
         preds = []
 
-        epsilon = get_scalar_var('epsilon', self.EPSILON, summary=True)
+        epsilon = get_scalar_var('epsilon', self.EPSILON, summary=not self.predict_only)
 
         def residual_convs(l, first,out_channel,stride1):
             b1 = l if first else BNReLU(l)
@@ -75,13 +135,13 @@ class Model(ModelDesc):
                 
         def residual(name, l, increase_dim=False, first=False):
             shape = l.get_shape().as_list()
-            in_channel = shape[1]
+            in_channel = shape[ch_axis]
 
             if increase_dim:
                 out_channel = in_channel * 2
                 stride1 = 2
                 short_cut = AvgPooling('pool', l, 2)
-                short_cut = tf.pad(short_cut, [[0, 0], [in_channel // 2, in_channel // 2], [0, 0], [0, 0]])
+                short_cut = pad_channel(short_cut, in_channel // 2, self.data_format)
             else:
                 out_channel = in_channel
                 stride1 = 1
@@ -92,36 +152,85 @@ class Model(ModelDesc):
                 identity_w = strict_identity(l, self.EPSILON)
                 # apply strict identity
                 l = identity_w * l + short_cut
-                # monitor is_discarded
-                is_discarded = tf.where(
-                        tf.equal(identity_w,0.0), 1.0, 0.0, 'is_discarded')
-                add_moving_summary(is_discarded)
-                preds.append(is_discarded)
+                monitor_discarded(identity_w)
+            return l
+
+        def monitor_discarded(identity_w):
+            if self.predict_only:
+                return
+            # monitor is_discarded
+            is_discarded = tf.where(
+                    tf.equal(identity_w,0.0), 1.0, 0.0, 'is_discarded')
+            add_moving_summary(is_discarded)
+            preds.append(is_discarded)
+
+        def residual_body(increase_dim=False, first=False):
+            # residual and shortcut of one block, to be gated by recompute_segment
+            def fn(l):
+                in_channel = l.get_shape().as_list()[ch_axis]
+                if increase_dim:
+                    short_cut = AvgPooling('pool', l, 2)
+                    short_cut = pad_channel(short_cut, in_channel // 2, self.data_format)
+                    return residual_convs(l, first, in_channel * 2, 2), short_cut
+                return residual_convs(l, first, in_channel, 1), l
+            return fn
+
+        def stack(l, blocks):
+            # blocks: a list of (name, increase_dim, first) applied in order
+            if self.recompute <= 0:
+                for name, increase_dim, first in blocks:
+                    l = residual(name, l, increase_dim, first)
+                return l
+            for i in range(0, len(blocks), self.recompute):
+                segment = [(name, residual_body(increase_dim, first))
+                        for name, increase_dim, first in blocks[i:i + self.recompute]]
+                l, gates = recompute_segment(segment, l, self.EPSILON)
+                monitor_gates(gates)
+            return l
+
+        def monitor_gates(gates):
+            if self.predict_only:
+                return
+            for name_scope, identity_w, abs_max, abs_mean in gates:
+                add_response_summary(name_scope, abs_max, abs_mean)
+                with tf.name_scope(name_scope):
+                    monitor_discarded(identity_w)
+
+        def group(l, head, g, start, end):
+            # apply the blocks in head, then the identical blocks res{g}.start .. res{g}.{end-1}
+            names = ['res{}.{}'.format(g, k) for k in range(start, end)]
+            if not self.loop:
+                return stack(l, head + [(name, False, False) for name in names])
+            l = stack(l, head)
+            if start < end:
+                l, gates = loop_residual(LOOP_SCOPE % g, l, self.n - 1, start - 1, end - 1,
+                        names, self.EPSILON, data_format=self.data_format)
+                monitor_gates(gates)
             return l
             
         side_output_cost = []
-        with argscope([Conv2D, AvgPooling, BatchNorm, GlobalAvgPooling], data_format='NCHW'), \
+        with argscope([Conv2D, AvgPooling, BatchNorm, GlobalAvgPooling], data_format=self.data_format), \
                 argscope(Conv2D, nl=tf.identity, use_bias=False, kernel_shape=3,
                          W_init=variance_scaling_initializer(mode='FAN_OUT')):
             l = Conv2D('conv0', image, 16, nl=BNReLU)
-            l = residual('res1.0', l, first=True)
-            for k in range(1, self.n):
-                l= residual('res1.{}'.format(k), l)
+            l = group(l, [('res1.0', False, True)], 1, 1, self.n)
             # 32,c=16
             
-            l = residual('res2.0', l, increase_dim=True)
-            for k in range(1, self.n):
-                l = residual('res2.{}'.format(k), l)
-                if k == self.n/2:
-                    side_output_cost.append(side_output('res2.{}'.format(k), l, label, self.NUM_CLASS))
+            # the side output after res2.{n/2} is a segment boundary
+            side = self.n // 2
+            l = group(l, [('res2.0', True, False)], 2, 1, side + 1)
+            if side >= 1 and not self.predict_only:
+                side_output_cost.append(side_output('res2.{}'.format(side), l, label, self.NUM_CLASS))
+            l = group(l, [], 2, side + 1, self.n)
             # 16,c=32
-            l = residual('res3.0', l, increase_dim=True)
-            for k in range(1, self.n):
-                l = residual('res3.' + str(k), l)
+            l = group(l, [('res3.0', True, False)], 3, 1, self.n)
             l = BNReLU('bnlast', l)
             # 8,c=64
             l = GlobalAvgPooling('gap', l)
             logits = FullyConnected('linear', l, out_dim=self.NUM_CLASS, nl=tf.identity)
+        if self.predict_only:
+            tf.nn.softmax(logits, name='output')
+            return
         cost = tf.nn.sparse_softmax_cross_entropy_with_logits(logits=logits, labels=label)
         cost = tf.reduce_mean(cost, name='cross_entropy_loss')
         wrong = prediction_incorrect(logits, label)
@@ -150,7 +259,7 @@ class Model(ModelDesc):
     def _get_optimizer(self):
         lr = get_scalar_var('learning_rate', 0.1, summary=True)
         opt = tf.train.MomentumOptimizer(lr, 0.90)
-        return opt
+        return dataParallel.wrap_optimizer(opt)
 
 
 def get_data(train_or_test):
@@ -162,6 +271,8 @@ def get_data(train_or_test):
         print('train on cifar100')
         ds = dataset.Cifar100(train_or_test)
     pp_mean = ds.get_per_pixel_mean()
+    if SUBSAMPLE is not None:
+        ds = dataParallel.subsample(ds, SUBSAMPLE[0 if isTrain else 1], SUBSAMPLE[2])
     if isTrain:
         augmentors = [
             imgaug.CenterPaste((40, 40)),
@@ -173,15 +284,21 @@ def get_data(train_or_test):
         augmentors = [
             imgaug.MapImage(lambda x: x - pp_mean)
         ]
+    if isTrain:
+        ds = dataParallel.shard_dataflow(ds)
     ds = AugmentImageComponent(ds, augmentors)
-    ds = BatchData(ds, BATCH_SIZE, remainder=not isTrain)
+    if isTrain and GROW_BATCH:
+        ds = ResizableBatchData(ds, BATCH_SIZE)
+    else:
+        ds = BatchData(ds, BATCH_SIZE, remainder=not isTrain)
     if isTrain:
-        ds = PrefetchData(ds, 3, 2)
+        # the prefetch processes of a worker would produce the same shard
+        ds = PrefetchData(ds, 3, 2 if dataParallel.get_worker() is None else 1)
     return ds
 
 def get_config(out_dir):
     print("outdir: %s"%out_dir)
-    logger.set_logger_dir('train_log.' + out_dir)
+    logger.set_logger_dir('train_log.' + out_dir + dataParallel.log_dir_suffix())
     dataset_train = get_data('train')
     dataset_test = get_data('test')
     MAX_EPOCH = 1000
@@ -190,35 +307,83 @@ def get_config(out_dir):
     side_inferences = [ClassificationError(x+ "/incorrect_vector",\
             x + "/val_error") for x in side_prediction_name]
     inferences = side_inferences + [ScalarStats('cost'), ClassificationError()]
+    lr_scaling = {}
+    if SCALE_LR:
+        # the schedules were tuned for one tower of BATCH_SIZE
+        lr_scaling = dict(batch_size=BATCH_SIZE * NR_TOWER * dataParallel.world_size(),
+                          base_batch_size=BATCH_SIZE,
+                          warmup_steps=int(WARMUP_EPOCHS * dataset_train.size()))
+    lr_setter = LearningRateSetter('learning_rate','discarded_cnt',
+                                   LR_SCHEDULE, UPDATED_LR_SCHEDULE,
+                                   LR_THRESHOLD, 1, **lr_scaling)
+    if ASYNC_EVAL:
+        validation = AsyncValidation(EVAL_GPU)
+    else:
+        validation = InferenceRunner(dataset_test, inferences)
+    saver = None
+    if ASYNC_SAVE:
+        # after the validation, to keep the checkpoints of the best val_error
+        saver = AsyncModelSaver(cifar_block_names(NUM_UNITS), keep_every=KEEP_EVERY)
+        callbacks = [validation, saver, lr_setter]
+    else:
+        callbacks = [ModelSaver(), validation, lr_setter]
+    if AUTO_COMPRESS:
+        callbacks.append(AutoCompressor(cifar_block_names(NUM_UNITS), saver=saver))
+    if GROW_BATCH:
+        callbacks.append(BatchSizeGrowth(dataset_train, lr_setter, max_batch_size=MAX_BATCH,
+                                         memory_limit_mb=MEMORY_LIMIT))
+    if EARLY_STOP > 0:
+        callbacks.append(ConvergenceStopper(lr_setter, cifar_block_names(NUM_UNITS),
+                                            patience=EARLY_STOP, tolerance=STOP_TOLERANCE,
+                                            async_saver=saver))
+    callbacks.extend(EXTRA_CALLBACKS)
     return TrainConfig(
         dataflow=dataset_train,
-        callbacks=[
-            ModelSaver(),
-            InferenceRunner(dataset_test, inferences),
-            LearningRateSetter('learning_rate','discarded_cnt',
-                [(0, 0.1), (82, 0.01), (123, 0.001), (300,0.0002)],
-                [(0, 0.1), (41, 0.01), (61, 0.001), (150,0.0002)],
-                1,1),
-        ],
-        model=Model(EPSILON, NUM_CLASS, NUM_UNITS),
+        callbacks=dataParallel.wrap_callbacks(callbacks),
+        session_config=dataParallel.session_config(),
+        model=Model(EPSILON, NUM_CLASS, NUM_UNITS, recompute=RECOMPUTE, loop=LOOP,
+                    data_format=DATA_FORMAT),
         max_epoch = MAX_EPOCH,
     )
 
 def eval_on_cifar(model_file):
     ds = get_data('test')
-    pred_config = PredictConfig(
-        model=Model(n=NUM_UNITS),
-        session_init=get_model_loader(model_file),
-        input_names = ['input', 'label'],
-        output_names = ['incorrect_vector']
-    )
-    pred = SimpleDatasetPredictor(pred_config, ds)
+    pred = cached_dataset_predictor(
+        Model(EPSILON, NUM_CLASS, NUM_UNITS, data_format=DATA_FORMAT, predict_only=True),
+        model_file, ds, ['input', 'label'], ['incorrect_vector'],
+        cache_dir=GRAPH_CACHE, script='cifarEpsilonResnet',
+        n=NUM_UNITS, epsilon=EPSILON, num_class=NUM_CLASS, data_format=DATA_FORMAT)
     acc = RatioCounter()
     for o in pred.get_result():
         batch_size = o[0].shape[0]
         acc.feed(o[0].sum(), batch_size)
     print("Error: {}".format(acc.ratio))
 
+# the validation errors of a checkpoint, under the names of InferenceRunner
+def eval_stats(model_path):
+    side = 'side_output/res2.{}'.format(NUM_UNITS/2)
+    pred = cached_dataset_predictor(
+        Model(EPSILON, NUM_CLASS, NUM_UNITS, loop=LOOP, data_format=DATA_FORMAT),
+        model_path, get_data('test'), ['input', 'label'],
+        ['incorrect_vector', side + '/incorrect_vector'],
+        cache_dir=GRAPH_CACHE, script='cifarEpsilonResnet', n=NUM_UNITS, epsilon=EPSILON,
+        loop=LOOP, num_class=NUM_CLASS, data_format=DATA_FORMAT)
+    return error_stats(pred, ['val_error', side + '/val_error'])
+
+# the validation error of a model compressed by compressModel.py
+def eval_compressed_stats(cfg_path):
+    n, structure, discard_first_block, model_path = read_cfg(cfg_path)
+    structure = np.add(structure, discard_first_block)
+    channels = read_channels(cfg_path)
+    pred = cached_dataset_predictor(
+        CompressedModel(NUM_CLASS, structure, discard_first_block, n, data_format=DATA_FORMAT,
+                        predict_only=True, channels=channels),
+        model_path, get_data('test'), ['input', 'label'], ['incorrect_vector'],
+        cache_dir=GRAPH_CACHE, script='cifarCompressedResnet',
+        structure=structure, discard_first_block=discard_first_block,
+        num_class=NUM_CLASS, data_format=DATA_FORMAT, channels=channels)
+    return error_stats(pred, ['compressed/val_error'])
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--gpu', help='comma separated list of GPU(s) to use.')
@@ -228,16 +393,71 @@ if __name__ == '__main__':
     parser.add_argument('--load', help='load model')
     parser.add_argument('-e', '--epsilon', help='set epsilon')
     parser.add_argument('-o', '--output', help='output')
+    parser.add_argument('--recompute', help='recompute activations in segments of this many blocks '
+                        'to save memory, e.g. sqrt(n). 0 to disable. Needs TensorFlow >= 1.5',
+                        type=int, default=0)
+    parser.add_argument('--data_format', help='specify NCHW or NHWC, default: NCHW with GPU, NHWC without',
+                        type=str, choices=['NCHW', 'NHWC'])
+    parser.add_argument('--loop', help='build the identical blocks of each group with a while_loop '
+                        'over stacked weights', action='store_true')
+    parser.add_argument('--scale_lr', help='scale the learning rate by the number of GPUs, '
+                        'with a linear warm-up', action='store_true')
+    parser.add_argument('--warmup', help='epochs of learning rate warm-up with --scale_lr',
+                        type=float, default=5)
     feature_parser = parser.add_mutually_exclusive_group(required=True)
     feature_parser.add_argument('--cifar10', help='iscifar10', dest='dataset', action = 'store_true')
     feature_parser.add_argument('--cifar100', help='iscifar100', dest='dataset', action = 'store_false')
 
     parser.set_defaults(feature=True)
 
+    parser.add_argument('--grow_batch', help='grow the batch size when blocks are discarded '
+                        'and the memory allows it', action='store_true')
+    parser.add_argument('--max_batch', help='maximal batch size with --grow_batch',
+                        type=int, default=1024)
+    parser.add_argument('--memory_limit', help='memory in MB for --grow_batch, '
+                        'default: GPU memory or physical memory', type=float)
+    parser.add_argument('--early_stop', help='stop when the discarded blocks and val_error '
+                        'have not changed in this many epochs at the final learning rate. 0 to disable',
+                        type=int, default=0)
+    parser.add_argument('--stop_tolerance', help='minimal improvement of val_error with --early_stop',
+                        type=float, default=0.001)
+    parser.add_argument('--async_save', help='save the checkpoints in the background and keep '
+                        'those where the discarded blocks changed or val_error was the best',
+                        action='store_true')
+    parser.add_argument('--keep_every', help='with --async_save, also keep the checkpoints of '
+                        'every this many epochs. 0 to disable', type=int, default=50)
+    parser.add_argument('--auto_compress', help='compress the checkpoint of every epoch '
+                        'in the background', action='store_true')
+    parser.add_argument('--async_eval', help='validate the checkpoints in another process '
+                        'instead of at the end of every epoch', action='store_true')
+    parser.add_argument('--eval_gpu', help='GPU(s) of the validation process of --async_eval, '
+                        'default: CPU')
+    parser.add_argument('--eval_watch', help='run as the validation process of --async_eval '
+                        'on this log dir')
+    dataParallel.add_arguments(parser)
     args = parser.parse_args()
+    # the validation process is not a data-parallel worker
+    worker = None if args.eval_watch else dataParallel.init_from_args(args)
     NUM_UNITS = args.num_units
+    RECOMPUTE = args.recompute
+    LOOP = args.loop
+    SCALE_LR = args.scale_lr
+    WARMUP_EPOCHS = args.warmup
+    GROW_BATCH = args.grow_batch
+    MAX_BATCH = args.max_batch
+    MEMORY_LIMIT = args.memory_limit
+    EARLY_STOP = args.early_stop
+    STOP_TOLERANCE = args.stop_tolerance
+    ASYNC_SAVE = args.async_save
+    KEEP_EVERY = args.keep_every
+    AUTO_COMPRESS = args.auto_compress
+    ASYNC_EVAL = args.async_eval
+    EVAL_GPU = args.eval_gpu
+    # the workers would grow their batches at different epochs
+    assert worker is None or not GROW_BATCH, '--grow_batch is not supported with data parallelism'
     if args.gpu:
         os.environ['CUDA_VISIBLE_DEVICES'] = args.gpu
+    DATA_FORMAT = args.data_format or default_data_format()
     if args.epsilon:
         EPSILON = float(args.epsilon)
     if not args.dataset:
@@ -248,10 +468,17 @@ if __name__ == '__main__':
     if args.output:
         out_dir = "." + args.output
     print('epsilon = %f' % EPSILON)
+    if args.gpu:
+        NR_TOWER = len(args.gpu.split(','))
+    if args.eval_watch:
+        watch(args.eval_watch, eval_stats, eval_compressed_stats)
+        sys.exit()
     config = get_config(out_dir)
     if args.load:
         config.session_init = SaverRestore(args.load)
-    if args.gpu:
-        config.nr_tower = len(args.gpu.split(','))
-    SyncMultiGPUTrainer(config).train()
+    config.nr_tower = NR_TOWER
+    if worker is not None:
+        QueueInputTrainer(config).train()
+    else:
+        SyncMultiGPUTrainer(config).train()
     #SimpleTrainer(config).train()
@@ -1,7 +1,9 @@
 import tensorflow as tf
 import re, math
 import argparse
+import json
 import os, sys
+import time
 
 re_NAME_CIFAR = "res(\d).(\d+)"
 re_NAME_IMAGENET = "group(\d)/block(\d+)"
@@ -23,6 +25,26 @@ fmt_global_step = '(global_step '
 discarded_treshold = 1
 
 
+# read N and the kind of model from the command line in the first line of log.log
+def parse_header(l):
+    if 'cifar' in l or 'svhn' in l:
+        is_cifar_model = True
+        rst = re.search('-n ?(\d+)', l, re.IGNORECASE)
+    elif 'imagenet' in l:
+        is_cifar_model = False
+        rst = re.search('-d ?(\d+)', l, re.IGNORECASE)
+    else:
+        print('the dataset is unknown')
+        sys.exit()
+    if not rst:
+        print("N could not be figured out in log.log")
+        sys.exit()
+    return int(rst.group(1)), is_cifar_model
+
+def get_model_info(logfile):
+    with open(logfile, 'r') as f:
+        return parse_header(f.readline())
+
 # read log.log and extract discarded blocks
 def get_discarded_block(logfile, step):
     discarded_block = []
@@ -35,27 +57,8 @@ def get_discarded_block(logfile, step):
     for l in open(logfile, 'r'):
         if idx == 0:
             idx = 1
-            if 'cifar' in l or 'svhn' in l:
-                is_cifar_model = True
-                re_NAME = re_NAME_CIFAR
-                rst = re.search('-n ?(\d+)', l, re.IGNORECASE)
-                if rst:
-                    N = int(rst.group(1))
-                else:
-                    print("N could not be figured out in log.log")
-                    sys.exit()
-            elif 'imagenet' in l:
-                is_cifar_model = False
-                re_NAME = re_NAME_IMAGENET
-                rst = re.search('-d ?(\d+)', l, re.IGNORECASE)
-                if rst:
-                    N = int(rst.group(1))
-                else:
-                    print("N could not be figured out in log.log")
-                    sys.exit()
-            else:
-                print('the dataset is unknown')
-                sys.exit()
+            N, is_cifar_model = parse_header(l)
+            re_NAME = re_NAME_CIFAR if is_cifar_model else re_NAME_IMAGENET
         elif '%s%d'%(fmt_global_step,step) in l:
             step_found = True
         elif step_found:
@@ -83,7 +86,15 @@ def get_discarded_block(logfile, step):
                             discarded_block.append(rst.group(1))
     return N, is_cifar_model, discarded_block, val_error
                
-def setup(model_dir, step):
+# wait until the index of a checkpoint, written after its data, exists
+def wait_for_checkpoint(model_prefix, timeout):
+    deadline = time.time() + timeout
+    while not os.path.exists('{}.index'.format(model_prefix)) and time.time() < deadline:
+        time.sleep(1)
+
+# find log.log and the model of step under model_dir. With discarded_block,
+#   log.log is only read for N and the kind of model.
+def setup(model_dir, step, discarded_block=None, val_error=None, wait=0):
     iter_dir = [x for x in os.walk(model_dir)]
     log_cnt = 0
     for root, subdir, files in os.walk(model_dir):
@@ -96,27 +107,17 @@ def setup(model_dir, step):
         sys.exit()
 
     log_path = '{}/log.log'.format(model_dir)    
-    chk_path = '{}/checkpoint'.format(model_dir)
-    model_path = '{}/model-{}.data-00000-of-00001'.format(model_dir, step)
+    model_prefix = '{}/model-{}'.format(model_dir, step)
+    wait_for_checkpoint(model_prefix, wait)
+    model_path = '{}.data-00000-of-00001'.format(model_prefix)
     if not os.path.exists(model_path):
         print('the model file does not exist: model-{}.data-00000-of-00001'.format(step))
-        sys.exit()
-    if os.path.exists(chk_path):
-        os.rename(chk_path, '{}.bak'.format(chk_path))
-    with open(chk_path, 'w') as f:
-        f.write('model_checkpoint_path: \"model-%d\"\n'%(step))
-        f.write('all_model_checkpoint_paths: \"model-%d\"\n'%(step))
-    N, is_cifar_model, discarded_block, val_error = get_discarded_block(log_path, step)
-
-    name_mapping, discard_first_block, structure = remap_variable(discarded_block, is_cifar_model, N)
-    gen_cfg(is_cifar_model, model_dir, N, discarded_block, step, discard_first_block, structure, val_error)
-    return model_dir, is_cifar_model, name_mapping
-
-def clear(model_dir):
-    chk_path_bak = '{}/checkpoint.bak'.format(model_dir)
-    chk_path= '{}/checkpoint'.format(model_dir)
-    if os.path.exists(chk_path_bak):
-        os.rename(chk_path_bak, chk_path)
+        sys.exit(1)
+    if discarded_block is None:
+        N, is_cifar_model, discarded_block, val_error = get_discarded_block(log_path, step)
+    else:
+        N, is_cifar_model = get_model_info(log_path)
+    return model_dir, model_prefix, N, is_cifar_model, discarded_block, val_error
 
 def get_structure(is_cifar_model, N):
     if is_cifar_model:
@@ -186,6 +187,39 @@ def remap_variable(discarded_block, is_cifar_model, N):
         structure = structure[1:]
     return name_mapping, discard_first_block, structure
 
+# the output channels kept in the convs of the blocks of the compressed model,
+#   {new block name: {conv: [kept channels]}}, only for the convs which lose channels.
+#   stats: {old block name/conv: max |response| of each output channel}, see channelStats.py
+#   A channel is pruned when its response is <= epsilon; one channel is always kept.
+def prune_channels(stats, name_mapping, epsilon):
+    channels = {}
+    for name, response in stats.items():
+        blk, conv = name.rsplit('/', 1)
+        if blk not in name_mapping:
+            continue
+        kept = [i for i, r in enumerate(response) if r > epsilon]
+        if len(kept) == 0:
+            kept = [max(range(len(response)), key=lambda i: response[i])]
+        if len(kept) < len(response):
+            channels.setdefault(name_mapping[blk], {})[conv] = kept
+    return channels
+
+# slice a variable of a block with pruned channels, e.g. res1.3/conv1/W
+#   name: the name in the block, e.g. conv1/W, conv1/bn/gamma, conv2/W/Momentum
+#   The output channels of a conv are the last axis of its kernel and of its BN,
+#   they are the input channels, axis 2, of the kernel of the next conv.
+def slice_variable(v, name, kept):
+    parts = name.split('/')
+    rst = re.match('conv(\d)$', parts[0])
+    if not rst or len(parts) < 2:
+        return v
+    if parts[0] in kept and parts[1] in ['W', 'b', 'bn']:
+        v = v.take(kept[parts[0]], axis=-1)
+    prev = 'conv{}'.format(int(rst.group(1)) - 1)
+    if parts[1] == 'W' and prev in kept:
+        v = v.take(kept[prev], axis=2)
+    return v
+
 def gen_cfg(is_cifar_model, model_dir, N, discarded_block, step, discard_first_block, structure, val_error):
     cfg_path = (fmt_saved_model + '.cfg')%(model_dir,step)
     model_path = (fmt_saved_model + '.data-00000-of-00001')%(model_dir,step)
@@ -202,6 +236,9 @@ def gen_cfg(is_cifar_model, model_dir, N, discarded_block, step, discard_first_b
         f.write('discard_first_block: {}\n'.format(first_block_flag))
         f.write('structure: {}\n'.format(structure))
         f.write('val_error: {}\n'.format(val_error))
+        channels_path = (fmt_saved_model + '.channels.json')%(model_dir,step)
+        if os.path.exists(channels_path):
+            f.write('channels: {}\n'.format(os.path.abspath(channels_path)))
 
 def read_cfg(cfg_path):
     with open(cfg_path, 'r') as f:
@@ -222,24 +259,41 @@ def read_cfg(cfg_path):
     print('model_path={}'.format(model_path))
     return N, structure, discard_first_block, model_path
 
-def compress(is_cifar_model, model_dir, step, name_mapping):
-    vars = tf.contrib.framework.list_variables(model_dir)
+# the pruned channels of the blocks of a cfg, see prune_channels, or None
+def read_channels(cfg_path):
+    with open(cfg_path, 'r') as f:
+        for l in f:
+            if l.startswith('channels: '):
+                with open(l.strip().replace('channels: ', ''), 'r') as fin:
+                    return json.load(fin)
+    return None
+
+# compress the checkpoint model_prefix into out_dir. The checkpoint is read
+#   directly, the 'checkpoint' file of the training is not used nor written.
+#   channels: the kept channels of the blocks, see prune_channels
+def compress(is_cifar_model, model_prefix, out_dir, step, name_mapping, channels={}):
+    vars = tf.contrib.framework.list_variables(model_prefix)
     with tf.Graph().as_default(), tf.Session().as_default() as sess:
         new_vars = []
         for name, shape in vars:
             #print('----------------')
             #print('old name:{}'.format(name))
-            v = tf.contrib.framework.load_variable(model_dir, name)
+            v = tf.contrib.framework.load_variable(model_prefix, name)
             prefix = name.split('/')[0]
             if 'tower' not in name :
                 # 'convshortcut': a conv to increase dimension for ImagNet
-                if prefix in kept_variable or 'convshortcut' in name:
+                # 'block0/preact': the BN before convshortcut, kept when block0 is discarded
+                if prefix in kept_variable or 'convshortcut' in name or \
+                        (not is_cifar_model and '/block0/preact/' in name):
                     new_vars.append(tf.Variable(v, name=name))
                     #print("no change in name:{}".format(new_vars[-1].name))
                 else:
                     blk = get_block_name(is_cifar_model, name)  
                     if blk in name_mapping: 
-                        new_vars.append(tf.Variable(v, name=name.replace(blk, name_mapping[blk])))
+                        new_blk = name_mapping[blk]
+                        if new_blk in channels:
+                            v = slice_variable(v, name[len(blk) + 1:], channels[new_blk])
+                        new_vars.append(tf.Variable(v, name=name.replace(blk, new_blk)))
                         #print("new name:{}".format(new_vars[-1].name))
                     else:
                         #print('{} is discarded'.format(name))
@@ -249,15 +303,62 @@ def compress(is_cifar_model, model_dir, step, name_mapping):
                 pass 
         saver = tf.train.Saver(new_vars)
         sess.run(tf.global_variables_initializer())
-        saved_path = fmt_saved_model%(model_dir,step)
-        saver.save(sess, saved_path)
+        saved_path = fmt_saved_model%(out_dir,step)
+        saver.save(sess, saved_path, write_meta_graph=False, write_state=False)
         print('The model is compressed and saved at {}'.format(saved_path))
 
+# compress the model of step in model_dir and write its cfg, in out_dir
+#   (default: the dir of log.log)
+#   channel_stats: the json of channelStats.py to prune the channels of the
+#   kept blocks whose response is <= channel_epsilon
+def compress_step(model_dir, step, discarded_block=None, val_error=None, out_dir=None, wait=0,
+                  channel_stats=None, channel_epsilon=0.0):
+    model_dir, model_prefix, N, is_cifar_model, discarded_block, val_error = setup(
+        model_dir, step, discarded_block, val_error, wait)
+    out_dir = out_dir or model_dir
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    name_mapping, discard_first_block, structure = remap_variable(discarded_block, is_cifar_model, N)
+    channels = {}
+    channels_path = (fmt_saved_model + '.channels.json')%(out_dir,step)
+    if channel_stats:
+        with open(channel_stats, 'r') as f:
+            stats = json.load(f)['stats']
+        channels = prune_channels(stats, name_mapping, channel_epsilon)
+        with open(channels_path, 'w') as f:
+            json.dump(channels, f)
+        old_names = dict((v, k) for k, v in name_mapping.items())
+        print('channels pruned: {} of {}'.format(
+            sum(len(stats[old_names[b] + '/' + c]) - len(k) for b, convs in channels.items()
+                for c, k in convs.items()),
+            sum(len(r) for r in stats.values())))
+    elif os.path.exists(channels_path):
+        os.remove(channels_path)
+    compress(is_cifar_model, model_prefix, out_dir, step, name_mapping, channels)
+    # the cfg is written last, when the compressed model is complete
+    gen_cfg(is_cifar_model, out_dir, N, discarded_block, step, discard_first_block, structure, val_error)
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('--dir', help="saved model directory", type=str, required=True)
     parser.add_argument('--step', help="which step of model is compressed ", type=int, required=True)
+    parser.add_argument('--discarded', help="comma separated discarded blocks, e.g. res1.3,res2.5, "
+                        "instead of those in log.log", type=str)
+    parser.add_argument('--val_error', help="comma separated validation errors with --discarded",
+                        type=str, default='')
+    parser.add_argument('--out_dir', help="directory of the compressed model, default: the dir of log.log",
+                        type=str)
+    parser.add_argument('--wait', help="seconds to wait for the model to be written",
+                        type=float, default=0)
+    parser.add_argument('--channel_stats', help="json of channelStats.py, prune the channels "
+                        "of the kept blocks", type=str)
+    parser.add_argument('--channel_epsilon', help="prune the channels whose max response "
+                        "is <= this", type=float, default=0.0)
     args = parser.parse_args()
-    model_dir, is_cifar, name_mapping = setup(args.dir, args.step)
-    compress(is_cifar, model_dir, args.step, name_mapping)
-    clear(model_dir)
+    discarded_block = None
+    val_error = None
+    if args.discarded is not None:
+        discarded_block = [b for b in args.discarded.split(',') if b]
+        val_error = [float(v) for v in args.val_error.split(',') if v]
+    compress_step(args.dir, args.step, discarded_block, val_error, args.out_dir, args.wait,
+                  args.channel_stats, args.channel_epsilon)
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+# File: convertLoopModel.py
+
+import argparse
+import re
+import numpy as np
+import tensorflow as tf
+
+from LoopResnetBase import LOOP_SCOPE, STACKED_VARIABLES
+
+"""
+Convert CIFAR/SVHN epsilon-ResNet checkpoints between the unrolled naming
+res{g}.{k}/... and the stacked naming res{g}.loop/... used by --loop.
+res{g}.0 is never stacked. Other variables are copied unchanged.
+
+Usage:
+    python convertLoopModel.py --to loop --load train_log.xxx/model-1000 --output train_log.xxx/loop-model-1000
+    python convertLoopModel.py --to blocks --load train_log.xxx/loop-model-1000 --output train_log.xxx/model-1000
+"""
+
+re_BLOCK = 'res(\d)\.(\d+)/(.*)$'
+re_LOOP = 'res(\d)\.loop/(.*)$'
+
+
+# variables is a dict of name -> value
+def to_loop(variables):
+    blocks = {}
+    converted = {}
+    for name, v in variables.items():
+        rst = re.match(re_BLOCK, name)
+        if rst and int(rst.group(2)) > 0 and rst.group(3) in STACKED_VARIABLES:
+            g, k = int(rst.group(1)), int(rst.group(2))
+            blocks.setdefault((g, rst.group(3)), {})[k] = v
+        else:
+            converted[name] = v
+    for (g, suffix), values in blocks.items():
+        n = max(values.keys())
+        assert sorted(values.keys()) == list(range(1, n + 1)), \
+            'res{}.k/{} is missing for some k'.format(g, suffix)
+        converted['{}/{}'.format(LOOP_SCOPE % g, suffix)] = \
+            np.stack([values[k] for k in range(1, n + 1)])
+    return converted
+
+def to_blocks(variables):
+    converted = {}
+    for name, v in variables.items():
+        rst = re.match(re_LOOP, name)
+        if rst and rst.group(2) in STACKED_VARIABLES:
+            g = int(rst.group(1))
+            for k in range(1, v.shape[0] + 1):
+                converted['res{}.{}/{}'.format(g, k, rst.group(2))] = v[k - 1]
+        else:
+            converted[name] = v
+    return converted
+
+def load_variables(path):
+    return dict((name, tf.contrib.framework.load_variable(path, name))
+                for name, _ in tf.contrib.framework.list_variables(path))
+
+def save_variables(variables, path):
+    with tf.Graph().as_default(), tf.Session() as sess:
+        new_vars = [tf.Variable(v, name=name) for name, v in sorted(variables.items())]
+        saver = tf.train.Saver(new_vars)
+        sess.run(tf.global_variables_initializer())
+        saver.save(sess, path)
+    print('The converted model is saved at {}'.format(path))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--load', help='checkpoint to convert', required=True)
+    parser.add_argument('--output', help='path of the converted checkpoint', required=True)
+    parser.add_argument('--to', help='target naming', choices=['loop', 'blocks'], required=True)
+    args = parser.parse_args()
+    variables = load_variables(args.load)
+    convert = to_loop if args.to == 'loop' else to_blocks
+    save_variables(convert(variables), args.output)
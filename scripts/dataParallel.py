@@ -0,0 +1,382 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+# File: dataParallel.py
+
+import multiprocessing
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+from multiprocessing.connection import Listener, Client
+import numpy as np
+
+sys.path.append('../../tensorpack')
+from tensorpack import *
+from tensorpack.tfutils.common import get_default_sess_config
+
+import EpsilonResnetBase
+
+import tensorflow as tf
+
+"""
+Synchronous data-parallel training of the epsilon-ResNets across CPU worker
+processes, on one host or several.
+
+Every worker builds the whole model, trains on its own shard of the dataflow
+and averages the gradients with the other workers at every step through a
+SocketCollective: worker 0 listens on --master (host:port, or the path of a
+unix socket), the others connect to it. The gate statistic of every
+strict_identity is reduced with max across the workers, so that a block is
+discarded only if the responses of the whole global batch are below epsilon.
+The gates, is_discarded, discarded_cnt and thus the learning rate decisions of
+LearningRateSetter are identical in all workers.
+
+Worker 0 is the chief: it saves the models and runs the inference. The
+variables of the chief are broadcast to the other workers before training.
+BatchNorm statistics are computed on the local batch of each worker.
+
+Usage:
+    # 4 workers on this host
+    python cifarEpsilonResnet.py --cifar10 -n 18 --workers 4
+    # 2 hosts, 2 workers each
+    host0$ python cifarEpsilonResnet.py --cifar10 -n 18 --master host0:29500 --world_size 4 --rank 0
+    host0$ python cifarEpsilonResnet.py --cifar10 -n 18 --master host0:29500 --world_size 4 --rank 1
+    host1$ python cifarEpsilonResnet.py --cifar10 -n 18 --master host0:29500 --world_size 4 --rank 2
+    host1$ python cifarEpsilonResnet.py --cifar10 -n 18 --master host0:29500 --world_size 4 --rank 3
+"""
+
+AUTHKEY = b'epsilon-resnet'
+# seed shared by the workers to shuffle the datasets in the same order
+SHARD_SEED = 2017
+_WORKER = None
+
+
+# host:port for TCP, anything else is the path of a unix socket
+def parse_address(address):
+    host, sep, port = address.rpartition(':')
+    if sep and port.isdigit():
+        return (host or '127.0.0.1', int(port)), 'AF_INET'
+    return address, 'AF_UNIX'
+
+
+class SocketCollective(object):
+    """
+    Collective operations on lists of numpy arrays between `size` processes,
+    through worker 0. The calls must be made in the same order by all the
+    workers; `key` is checked to catch mismatched calls.
+    """
+    def __init__(self, rank, size, address, timeout=600):
+        self.rank = rank
+        self.size = size
+        self.lock = threading.Lock()
+        if size == 1:
+            return
+        addr, family = parse_address(address)
+        if rank == 0:
+            if family == 'AF_UNIX' and os.path.exists(addr):
+                os.remove(addr)
+            listener = Listener(addr, family, authkey=AUTHKEY)
+            self.conns = [None] * size
+            for _ in range(size - 1):
+                conn = listener.accept()
+                self.conns[conn.recv()] = conn
+            listener.close()
+        else:
+            # worker 0 may start later
+            deadline = time.time() + timeout
+            while True:
+                try:
+                    self.conn = Client(addr, family, authkey=AUTHKEY)
+                    break
+                except (socket.error, OSError):
+                    if time.time() > deadline:
+                        raise
+                    time.sleep(1)
+            self.conn.send(rank)
+        logger.info('[dataParallel] worker {}/{} connected to {}'.format(rank, size, address))
+
+    def _exchange(self, key, arrays, reduce_fn):
+        if self.rank == 0:
+            msgs = [(key, arrays)] + [self.conns[r].recv() for r in range(1, self.size)]
+            for r, (k, _) in enumerate(msgs):
+                assert k == key, 'worker {} called {} instead of {}'.format(r, k, key)
+            result = reduce_fn([m[1] for m in msgs])
+            for r in range(1, self.size):
+                self.conns[r].send(result)
+            return result
+        self.conn.send((key, arrays))
+        return self.conn.recv()
+
+    # reduce arrays elementwise across the workers
+    #   op: 'mean', 'sum' or 'max'
+    def allreduce(self, arrays, op='mean', key=None):
+        if self.size == 1:
+            return arrays
+        fn = {'mean': np.add, 'sum': np.add, 'max': np.maximum}[op]
+
+        def reduce_fn(all_arrays):
+            result = []
+            for xs in zip(*all_arrays):
+                r = xs[0]
+                for x in xs[1:]:
+                    r = fn(r, x)
+                if op == 'mean':
+                    r = r / float(self.size)
+                result.append(np.asarray(r, dtype=xs[0].dtype))
+            return result
+        with self.lock:
+            return self._exchange(key, arrays, reduce_fn)
+
+    # return the arrays of worker 0
+    def broadcast(self, arrays, key=None):
+        if self.size == 1:
+            return arrays
+        with self.lock:
+            return self._exchange(key, arrays, lambda all_arrays: all_arrays[0])
+
+    def close(self):
+        if self.size == 1:
+            return
+        for c in (self.conns[1:] if self.rank == 0 else [self.conn]):
+            c.close()
+
+
+class ShardData(ProxyDataFlow):
+    """
+    Take every `size`-th datapoint of ds, starting from the `rank`-th, and the
+    same number of datapoints in all workers so that they run the same number
+    of steps. The shards are disjoint if ds produces the same order in all the
+    workers: with `seed`, ds.rng is re-seeded by reset_state(), so a shuffled
+    dataset, e.g. dataset.Cifar10, is shuffled in the same order by all the
+    workers at every epoch. Don't use it with a seed inside of a multiprocess
+    prefetch, whose processes would produce the same datapoints.
+    """
+    def __init__(self, ds, rank, size, seed=None):
+        super(ShardData, self).__init__(ds)
+        self.rank = rank
+        self.world_size = size
+        self.seed = seed
+
+    def reset_state(self):
+        super(ShardData, self).reset_state()
+        if self.seed is not None and hasattr(self.ds, 'rng'):
+            self.ds.rng = np.random.RandomState(self.seed)
+
+    def size(self):
+        return self.ds.size() // self.world_size
+
+    def get_data(self):
+        cnt = 0
+        for k, dp in enumerate(self.ds.get_data()):
+            if cnt == self.size():
+                break
+            if k % self.world_size == self.rank:
+                cnt += 1
+                yield dp
+
+
+class Subset(ProxyDataFlow):
+    """
+    A fixed random subset of an in-memory dataset, dataset.Cifar10,
+    dataset.Cifar100 or dataset.SVHNDigit, chosen with `seed`.
+    """
+    def __init__(self, ds, fraction, seed=SHARD_SEED):
+        super(Subset, self).__init__(ds)
+        n = len(ds.data) if hasattr(ds, 'data') else ds.X.shape[0]
+        index = np.sort(np.random.RandomState(seed).choice(n, int(n * fraction), replace=False))
+        if hasattr(ds, 'data'):
+            ds.data = [ds.data[i] for i in index]
+        else:
+            ds.X, ds.Y = ds.X[index], ds.Y[index]
+        self._size = len(index)
+
+    # re-seeded by ShardData
+    @property
+    def rng(self):
+        return self.ds.rng
+
+    @rng.setter
+    def rng(self, rng):
+        self.ds.rng = rng
+
+    def size(self):
+        return self._size
+
+# a fixed random subset of ds, e.g. for the short runs of timeToAccuracy.py
+def subsample(ds, fraction, seed=SHARD_SEED):
+    return ds if fraction >= 1 else Subset(ds, fraction, seed)
+
+
+class AllReduceOptimizer(tf.train.Optimizer):
+    """
+    Average the gradients across the workers of a SocketCollective before
+    applying them with the wrapped optimizer.
+    """
+    def __init__(self, opt, collective):
+        super(AllReduceOptimizer, self).__init__(False, 'AllReduceOptimizer')
+        self._opt = opt
+        self._collective = collective
+
+    def compute_gradients(self, *args, **kwargs):
+        return self._opt.compute_gradients(*args, **kwargs)
+
+    def get_slot(self, *args, **kwargs):
+        return self._opt.get_slot(*args, **kwargs)
+
+    def get_slot_names(self, *args, **kwargs):
+        return self._opt.get_slot_names(*args, **kwargs)
+
+    def apply_gradients(self, grads_and_vars, global_step=None, name=None):
+        grads_and_vars = [(tf.convert_to_tensor(g), v) for g, v in grads_and_vars if g is not None]
+        grads = [g for g, _ in grads_and_vars]
+        with tf.name_scope('AllReduceOptimizer'):
+            averaged = tf.py_func(
+                lambda *g: self._collective.allreduce(list(g), 'mean', 'gradients'),
+                grads, [g.dtype for g in grads], stateful=True, name='allreduce')
+        for a, g in zip(averaged, grads):
+            a.set_shape(g.get_shape())
+        return self._opt.apply_gradients(
+            [(a, v) for a, (_, v) in zip(averaged, grads_and_vars)], global_step, name)
+
+
+class BroadcastVariables(Callback):
+    """ Set all the global variables to those of the chief before training. """
+    def __init__(self, collective):
+        self.collective = collective
+
+    def _before_train(self):
+        sess = self.trainer.sess
+        variables = tf.global_variables()
+        names = [v.op.name for v in variables]
+        assert names == self.collective.broadcast(names, 'variable names'), \
+            'the workers built different graphs'
+        values = self.collective.broadcast(sess.run(variables), 'variables')
+        if self.collective.rank != 0:
+            for v, value in zip(variables, values):
+                v.load(value, sess)
+        logger.info('[dataParallel] {} variables broadcast from the chief'.format(len(variables)))
+
+
+class Worker(object):
+    """
+    The data-parallel state of this process. Created by setup_worker().
+    """
+    def __init__(self, rank, size, master, threads=None):
+        self.rank = rank
+        self.size = size
+        self.threads = threads
+        self.is_chief = rank == 0
+        self.collective = SocketCollective(rank, size, master)
+        EpsilonResnetBase.set_gate_reducer(self.reduce_gate)
+
+    # the gate statistic reduced with max across the workers,
+    #   with the gradient of the local one. The key is the name of the op, so
+    #   that the gates of different blocks are never paired.
+    def reduce_gate(self, s):
+        key = 'gate ' + s.op.name
+        r = tf.py_func(lambda x: self.collective.allreduce([x], 'max', key)[0],
+                       [s], s.dtype, stateful=True, name='allreduce_gate')
+        r.set_shape(s.get_shape())
+        return s + tf.stop_gradient(r - s)
+
+    def shard(self, ds, seed=SHARD_SEED):
+        return ShardData(ds, self.rank, self.size, seed)
+
+    def optimizer(self, opt):
+        return AllReduceOptimizer(opt, self.collective)
+
+    # the chief saves the models and runs the inference
+    def callbacks(self, callbacks):
+        if not self.is_chief:
+            callbacks = [cb for cb in callbacks
+                         if not isinstance(cb, (ModelSaver, InferenceRunner))
+                         and not getattr(cb, 'chief_only', False)]
+        return [BroadcastVariables(self.collective)] + callbacks
+
+    def session_config(self):
+        config = get_default_sess_config()
+        if self.threads:
+            config.intra_op_parallelism_threads = self.threads
+            config.inter_op_parallelism_threads = 2
+        return config
+
+
+def get_worker():
+    return _WORKER
+
+def setup_worker(args):
+    global _WORKER
+    _WORKER = Worker(args.rank, args.world_size, args.master, args.threads)
+    return _WORKER
+
+# wrap the optimizer of a model when this process is a data-parallel worker
+def wrap_optimizer(opt):
+    return opt if _WORKER is None else _WORKER.optimizer(opt)
+
+# wrap the training dataflow when this process is a data-parallel worker
+def shard_dataflow(ds, seed=SHARD_SEED):
+    return ds if _WORKER is None else _WORKER.shard(ds, seed)
+
+# the callbacks of this worker
+def wrap_callbacks(callbacks):
+    return callbacks if _WORKER is None else _WORKER.callbacks(callbacks)
+
+def session_config():
+    return get_default_sess_config() if _WORKER is None else _WORKER.session_config()
+
+def world_size():
+    return 1 if _WORKER is None else _WORKER.size
+
+def is_chief():
+    return _WORKER is None or _WORKER.is_chief
+
+# suffix of the log dir of this worker, the chief logs in the usual dir
+def log_dir_suffix():
+    return '' if is_chief() else '.worker{}'.format(_WORKER.rank)
+
+
+def add_arguments(parser):
+    parser.add_argument('--workers', help='start this many local CPU worker processes '
+                        'of data-parallel training', type=int, default=0)
+    parser.add_argument('--master', help='host:port or unix socket path of worker 0 '
+                        'for data-parallel training', default='127.0.0.1:29500')
+    parser.add_argument('--world_size', help='number of data-parallel workers on all hosts',
+                        type=int, default=0)
+    parser.add_argument('--rank', help='index of this data-parallel worker', type=int)
+    parser.add_argument('--threads', help='intra-op threads of each data-parallel worker, '
+                        'default: cores / local workers', type=int)
+
+def is_data_parallel(args):
+    return args.rank is not None and args.world_size > 0
+
+# start the workers of --workers as new processes of the same script and
+#   return their exit code. The workers are stopped if one of them fails.
+def launch_local_workers(args):
+    n = args.workers
+    threads = args.threads or max(1, multiprocessing.cpu_count() // n)
+    env = dict(os.environ, CUDA_VISIBLE_DEVICES='')
+    procs = []
+    for rank in range(n):
+        cmd = [sys.executable] + sys.argv + [
+            '--rank', str(rank), '--world_size', str(n),
+            '--master', args.master, '--threads', str(threads)]
+        procs.append(subprocess.Popen(cmd, env=env))
+    while any(p.poll() is None for p in procs):
+        if any(p.poll() for p in procs):
+            for p in procs:
+                if p.poll() is None:
+                    p.terminate()
+        time.sleep(1)
+    return max(p.returncode for p in procs)
+
+# handle the data-parallel arguments in the main of a training script:
+#   exit after the local workers of --workers are done, or set up this
+#   worker. Return the Worker, or None without data parallelism.
+def init_from_args(args):
+    if args.workers > 0 and args.rank is None:
+        sys.exit(launch_local_workers(args))
+    if is_data_parallel(args):
+        return setup_worker(args)
+    return None
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+# File: earlyStop.py
+
+import json
+import os
+
+import sys
+sys.path.append('../../tensorpack')
+from tensorpack import *
+from tensorpack.tfutils.common import get_global_step_value
+from tensorpack.train.base import StopTraining
+
+import dataParallel
+
+import tensorflow as tf
+
+"""
+Stop the training of an epsilon-ResNet once it has converged, instead of
+running until max_epoch.
+
+ConvergenceStopper ends the training at the end of an epoch when
+    1. the set of discarded blocks has not changed in the last `patience` epochs,
+    2. LearningRateSetter is at the last stage of its current schedule,
+    3. the best val_error of the last `patience` epochs is not better than the
+       best one before them by more than `tolerance`.
+Before stopping, it saves the model of the last step, or keeps the
+checkpoint AsyncModelSaver wrote for it, logs the statistics of this epoch in
+the format parsed by compressModel.py and writes them to early_stop.json in
+the log dir.
+"""
+
+# the names of the is_discarded statistics of the cifar and svhn models
+def cifar_block_names(n):
+    return ['res{}.{}/is_discarded'.format(g, k) for g in [1, 2, 3] for k in range(n)]
+
+# the names of the is_discarded statistics of the imagenet models,
+#   defs: the number of blocks of each group
+def imagenet_block_names(defs):
+    return ['group{}/block{}/is_discarded'.format(g, k)
+            for g, nr_block in enumerate(defs) for k in range(nr_block)]
+
+# the block of an is_discarded statistic, res1.3 or group2/block3 as in log.log
+def block_of_stat(name):
+    return name[:-len('/is_discarded')] if name.endswith('/is_discarded') else name
+
+# the last value of a statistic, or None
+def latest_stat(trainer, name):
+    hist = trainer.monitors.get_history(name)
+    return hist[-1] if len(hist) else None
+
+# the names of the blocks discarded at this epoch, and the rounded discarded_cnt
+def discarded_state(trainer, block_names, cnt_stat='discarded_cnt'):
+    blocks = [name for name in block_names if latest_stat(trainer, name) == 1.0]
+    cnt = latest_stat(trainer, cnt_stat)
+    return tuple(blocks), None if cnt is None else int(round(cnt))
+
+
+class ConvergenceStopper(Callback):
+    """
+    Stop the training when the discarded blocks, the learning rate and the
+    validation error have converged. Put it after ModelSaver and
+    InferenceRunner in the callbacks.
+    """
+    def __init__(self, lr_setter, block_names, patience=10, tolerance=0.001,
+                 val_stat='val_error', cnt_stat='discarded_cnt', async_saver=None):
+        """
+        Args:
+            lr_setter: the LearningRateSetter of the training.
+            block_names (list): names of the is_discarded statistics. The
+                rounded cnt_stat must not change either, so that the blocks
+                without a statistic are covered.
+            patience (int): K, the number of epochs without change.
+            tolerance (float): minimal improvement of val_stat in K epochs.
+            async_saver: the AsyncModelSaver of the training, if any. The
+                final model is then its checkpoint of the last step, kept
+                for good, instead of one saved by the stopper.
+        """
+        self.lr_setter = lr_setter
+        self.block_names = block_names
+        self.patience = patience
+        self.tolerance = tolerance
+        self.val_stat = val_stat
+        self.cnt_stat = cnt_stat
+        self.async_saver = async_saver
+
+    def _setup_graph(self):
+        self.saver = tf.train.Saver(max_to_keep=None, write_version=tf.train.SaverDef.V2)
+
+    def _before_train(self):
+        self.last_discarded = None
+        self.nr_unchanged = 0
+
+    # the reason to stop, or None
+    def _converged(self):
+        discarded = discarded_state(self.trainer, self.block_names, self.cnt_stat)
+        if discarded == self.last_discarded:
+            self.nr_unchanged += 1
+        else:
+            self.last_discarded = discarded
+            self.nr_unchanged = 0
+        if self.nr_unchanged < self.patience:
+            return None
+        if not self.lr_setter.is_final_stage():
+            return None
+        hist = self.trainer.monitors.get_history(self.val_stat)
+        if len(hist) <= self.patience:
+            return None
+        best_before = min(hist[:-self.patience])
+        best_recent = min(hist[-self.patience:])
+        if best_recent < best_before - self.tolerance:
+            return None
+        return ('discarded blocks unchanged in {} epochs, final learning rate stage, '
+                '{} improved by {:.5g} <= {}'.format(self.patience, self.val_stat,
+                best_before - best_recent, self.tolerance))
+
+    def _trigger_epoch(self):
+        reason = self._converged() if dataParallel.is_chief() else None
+        # only the chief runs the inference
+        worker = dataParallel.get_worker()
+        if worker is not None:
+            reason = worker.collective.broadcast([reason], 'early stop')[0]
+        if reason is None:
+            return
+        logger.info('[ConvergenceStopper] ' + reason)
+        if dataParallel.is_chief():
+            self._save(reason)
+        raise StopTraining()
+
+    # save the model and the statistics of this epoch for compressModel.py
+    def _save(self, reason):
+        step = get_global_step_value()
+        # AsyncModelSaver writes the `checkpoint` file in its thread
+        if self.async_saver is None or not self.async_saver.keep(step, 'final'):
+            self.saver.save(self.trainer.sess, os.path.join(logger.LOG_DIR, 'model'),
+                            global_step=step, write_meta_graph=False,
+                            write_state=self.async_saver is None)
+        # the statistics of the epoch are printed after the callbacks, so
+        #   log those parsed by compressModel.py after the epoch line
+        stats = {}
+        for name in self.block_names + [self.cnt_stat, self.val_stat]:
+            v = latest_stat(self.trainer, name)
+            if v is not None:
+                stats[name] = float(v)
+                logger.info('{}: {}'.format(name, float(v)))
+        blocks, cnt = discarded_state(self.trainer, self.block_names, self.cnt_stat)
+        with open(os.path.join(logger.LOG_DIR, 'early_stop.json'), 'w') as f:
+            json.dump({'epoch': self.epoch_num, 'global_step': step, 'reason': reason,
+                       'discarded_blocks': [block_of_stat(b) for b in blocks],
+                       'discarded_cnt': cnt, 'stats': stats}, f, indent=2)
+        logger.info('[ConvergenceStopper] model-{} saved, compress it with: '
+                    'python compressModel.py --dir {} --step {}'.format(
+                        step, logger.LOG_DIR, step))
@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+# File: evalModels.py
+
+import argparse
+import json
+import multiprocessing
+import os
+import pickle
+import time
+import numpy as np
+
+import sys
+sys.path.append('../../tensorpack')
+from tensorpack import *
+from tensorpack.utils.stats import RatioCounter
+
+from compressModel import read_cfg, read_channels, cfg as depth_cfg
+from EpsilonResnetBase import default_data_format
+from graphCache import load_inference_graph, GraphDatasetPredictor
+from benchmarkUtils import session_config, print_table
+
+import tensorflow as tf
+
+"""
+Evaluate many models on the same test set in one pass: every batch is read,
+decoded and augmented once and given to all the models, in this process or
+in a pool of worker processes, each holding some of the models.
+
+A model is either the .cfg of a compressed model written by compressModel.py,
+or a checkpoint of an epsilon-ResNet whose architecture is given by -n or -d
+and --epsilon. The table has the errors of each model and its throughput in
+images/sec, measured on the time spent in its session.
+
+Usage:
+    python evalModels.py --dataset cifar10 --models a/compressed_model_1000.cfg,b/compressed_model_2000.cfg
+    python evalModels.py --dataset imagenet --data /path/to/ilsvrc12 -d 101 --workers 4 \\
+        --models train_log/imagenetEpsilonResnet/model-550000,train_log/x/compressed_model_550000.cfg
+"""
+
+# the errors of each kind of model, by the names of their 0/1 outputs
+CIFAR_OUTPUTS = [('incorrect_vector', 'error')]
+IMAGENET_OUTPUTS = [('wrong-top1', 'top1_error'), ('wrong-top5', 'top5_error')]
+
+
+# the train or test dataflow of the training script of the dataset
+def get_script_data(args, train=False):
+    if args.dataset == 'imagenet':
+        import imagenetEpsilonResnet as script
+        # get_data reads the dataset dir from the arguments of the script
+        script.args = args
+        script.BATCH_SIZE = args.batch
+        return script.get_data('train' if train else 'val')
+    if args.dataset == 'svhn':
+        import svhnEpsilonResnet as script
+    else:
+        import cifarEpsilonResnet as script
+        script.IS_CIFAR10 = args.dataset == 'cifar10'
+    script.BATCH_SIZE = args.batch
+    return script.get_data('train' if train else 'test')
+
+def get_test_data(args):
+    return get_script_data(args)
+
+# the model of a cfg or a checkpoint, the arguments of its graph cache entry
+#   and the path of its variables
+def get_model(path, args):
+    data_format = args.data_format
+    num_class = {'cifar10': 10, 'cifar100': 100, 'svhn': 10, 'imagenet': 1000}[args.dataset]
+    if path.endswith('.cfg'):
+        n, structure, discard_first_block, model_path = read_cfg(path)
+        structure = list(np.add(structure, discard_first_block))
+        channels = read_channels(path)
+        arch = dict(structure=structure, discard_first_block=discard_first_block,
+                    num_class=num_class, data_format=data_format, channels=channels)
+        if args.dataset == 'imagenet':
+            import imagenetCompressedResnet
+            model = imagenetCompressedResnet.Model(data_format, n, structure, discard_first_block,
+                                                   predict_only=True, channels=channels)
+            arch['depth'] = n
+            return model, 'imagenetCompressedResnet', arch, model_path
+        import cifarCompressedResnet
+        model = cifarCompressedResnet.Model(num_class, structure, discard_first_block, n,
+                                            data_format=data_format, predict_only=True,
+                                            channels=channels)
+        return model, 'cifarCompressedResnet', arch, model_path
+    if args.dataset == 'imagenet':
+        import imagenetEpsilonResnet
+        defs = depth_cfg[args.depth]
+        imagenetEpsilonResnet.DEPTH = args.depth
+        imagenetEpsilonResnet.EPSILON = args.epsilon
+        imagenetEpsilonResnet.SIDE_POSITION = imagenetEpsilonResnet.side_position(defs)
+        model = imagenetEpsilonResnet.Model(data_format=data_format, predict_only=True)
+        return model, 'imagenetEpsilonResnet', dict(
+            depth=args.depth, epsilon=args.epsilon, num_class=num_class,
+            data_format=data_format), path
+    import cifarEpsilonResnet
+    model = cifarEpsilonResnet.Model(args.epsilon, num_class, args.num_units, data_format=data_format,
+                                     predict_only=True)
+    return model, 'cifarEpsilonResnet', dict(
+        n=args.num_units, epsilon=args.epsilon, num_class=num_class,
+        data_format=data_format), path
+
+
+class ModelRunner(object):
+    """ Run some of the models on every batch and count their errors. """
+    def __init__(self, paths, args, threads=None):
+        self.outputs = IMAGENET_OUTPUTS if args.dataset == 'imagenet' else CIFAR_OUTPUTS
+        self.models = []
+        for path in paths:
+            model, script, arch, model_path = get_model(path, args)
+            graph = load_inference_graph(model, script, args.graph_cache, **arch)
+            pred = GraphDatasetPredictor(graph, model_path, None, ['input', 'label'],
+                                         [o for o, _ in self.outputs], session_config(threads))
+            self.models.append({'path': path, 'pred': pred, 'seconds': 0.0,
+                                'counters': [RatioCounter() for _ in self.outputs]})
+
+    def feed(self, dp):
+        for m in self.models:
+            start = time.time()
+            outputs = m['pred'](*dp)
+            m['seconds'] += time.time() - start
+            for c, v in zip(m['counters'], outputs):
+                c.feed(v.sum(), v.shape[0])
+
+    def results(self):
+        rows = []
+        for m in self.models:
+            r = {'model': m['path'], 'images': m['counters'][0].count,
+                 'images_per_s': m['counters'][0].count / max(m['seconds'], 1e-9)}
+            for (_, name), c in zip(self.outputs, m['counters']):
+                r[name] = c.ratio
+            rows.append(r)
+        return rows
+
+
+# the batches are pickled once by the main process for all the workers
+def worker_main(paths, args, threads, conn):
+    runner = ModelRunner(paths, args, threads)
+    conn.send('ready')
+    while True:
+        dp = pickle.loads(conn.recv_bytes())
+        if dp is None:
+            break
+        runner.feed(dp)
+    conn.send(runner.results())
+
+
+def evaluate(args):
+    paths = args.models.split(',')
+    ds = get_test_data(args)
+    ds.reset_state()
+    if args.workers <= 0:
+        runner = ModelRunner(paths, args, args.threads)
+        start = time.time()
+        for dp in ds.get_data():
+            runner.feed(dp)
+        rows = runner.results()
+    else:
+        nr_worker = min(args.workers, len(paths))
+        threads = args.threads or max(1, multiprocessing.cpu_count() // nr_worker)
+        conns, procs = [], []
+        for k in range(nr_worker):
+            parent, child = multiprocessing.Pipe()
+            p = multiprocessing.Process(target=worker_main,
+                                        args=(paths[k::nr_worker], args, threads, child))
+            p.start()
+            # only the worker holds its end, so that the pipe breaks when it dies
+            child.close()
+            conns.append(parent)
+            procs.append(p)
+        try:
+            for c in conns:
+                c.recv()
+            start = time.time()
+            for dp in ds.get_data():
+                data = pickle.dumps(dp, pickle.HIGHEST_PROTOCOL)
+                for c in conns:
+                    c.send_bytes(data)
+            rows = []
+            for c in conns:
+                c.send_bytes(pickle.dumps(None))
+                rows.extend(c.recv())
+        except (EOFError, IOError, OSError):
+            for p in procs:
+                if p.is_alive():
+                    p.terminate()
+                p.join()
+            raise RuntimeError('an evaluation worker died, exit codes: {}'.format(
+                [p.exitcode for p in procs]))
+        for p in procs:
+            p.join()
+        rows.sort(key=lambda r: paths.index(r['model']))
+    logger.info('{} models evaluated in {:.1f} sec'.format(len(paths), time.time() - start))
+    return rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--models', help='comma separated list of .cfg of compressed models '
+                        'and checkpoints of epsilon-ResNets', required=True)
+    parser.add_argument('--dataset', help='test set', default='cifar10',
+                        choices=['cifar10', 'cifar100', 'svhn', 'imagenet'])
+    parser.add_argument('--data', help='ILSVRC dataset dir')
+    parser.add_argument('-n', '--num_units', help='units per stage of the cifar and svhn checkpoints',
+                        type=int, default=18)
+    parser.add_argument('-d', '--depth', help='depth of the imagenet checkpoints',
+                        type=int, default=50, choices=[18, 34, 50, 101, 152])
+    parser.add_argument('-e', '--epsilon', help='epsilon of the checkpoints', type=float, default=2.5)
+    parser.add_argument('--data_format', help='specify NCHW or NHWC, default: NCHW with GPU, NHWC without',
+                        type=str, choices=['NCHW', 'NHWC'])
+    parser.add_argument('--batch', type=int, default=128)
+    parser.add_argument('--workers', help='worker processes sharing the models, '
+                        '0 to run all of them in this process', type=int, default=0)
+    parser.add_argument('--threads', help='intra-op threads of each worker, '
+                        'default: cores / workers', type=int)
+    parser.add_argument('--graph_cache', help='directory to cache the inference graphs')
+    parser.add_argument('--gpu', help='comma separated list of GPU(s) to use.')
+    parser.add_argument('--output', help='save the results as json')
+    args = parser.parse_args()
+    if args.gpu:
+        os.environ['CUDA_VISIBLE_DEVICES'] = args.gpu
+    args.data_format = args.data_format or default_data_format()
+
+    rows = evaluate(args)
+    errors = [name for _, name in (IMAGENET_OUTPUTS if args.dataset == 'imagenet' else CIFAR_OUTPUTS)]
+    print_table(rows, ['model'] + errors + ['images', 'images_per_s'])
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(rows, f, indent=2)
@@ -0,0 +1,280 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+# File: exportModel.py
+
+import argparse
+import json
+import os
+import numpy as np
+
+import sys
+sys.path.append('../../tensorpack')
+from tensorpack import *
+
+from EpsilonResnetBase import default_data_format
+from graphCache import load_inference_graph, restore_variables
+from inferenceServer import load_compressed
+from benchmarkUtils import session_config, time_steps, percentile, run_isolated, print_table
+
+import tensorflow as tf
+try:
+    from tensorflow.tools.graph_transforms import TransformGraph
+except ImportError:
+    TransformGraph = None
+
+"""
+Export a compressed model as a frozen GraphDef for deployment, and compare it
+with the plain graph on CPU.
+
+The predict-only graph of the .cfg is built, its variables are inlined as
+constants, then it is simplified:
+  - the Identity nodes, e.g. the `output` of every tensorpack layer, are
+    bypassed;
+  - chains of Pad with constant paddings, e.g. the tf.pad of the shortcut of a
+    discarded first block after AvgPooling, are merged into one Pad, and Pads
+    of zeros are removed;
+  - chains of Transpose are composed, and removed when they cancel out;
+  - the constants are folded and the batch norms are folded into the
+    convolutions by the graph transforms of TensorFlow, when available;
+  - the nodes not needed by `output` and `linear/output` are dropped.
+With --xla the benchmark also runs the frozen graph with XLA JIT compilation:
+its nodes are marked for compilation as by
+tf.contrib.compiler.jit.experimental_jit_scope, since TensorFlow 1.x does not
+cluster the unmarked nodes on CPU, and the number of XLA clusters formed is
+reported (0 when TensorFlow is built without XLA). The benchmark reports the
+latency at batch 1 and the throughput at batch 128. The export and every
+graph of the benchmark run in their own processes, so that no session is
+created in the process which forks them.
+
+Usage:
+    python exportModel.py --cfg train_log/x/compressed/compressed_model_1000.cfg --benchmark --xla
+"""
+
+INPUT = 'input'
+# the probabilities and the logits of the predict-only models
+OUTPUTS = ['output', 'linear/output']
+# strip_unused_nodes is not used, it would change the type of the uint8 input of imagenet
+TRANSFORMS = ['fold_constants(ignore_errors=true)', 'fold_batch_norms', 'fold_old_batch_norms',
+              'sort_by_execution_order']
+
+
+def _node_name(ref):
+    return ref.lstrip('^').split(':')[0]
+
+def const_value(nodes, ref):
+    node = nodes.get(_node_name(ref))
+    if node is None or node.op != 'Const':
+        return None
+    return tf.make_ndarray(node.attr['value'].tensor)
+
+def add_const(graph_def, name, value):
+    node = graph_def.node.add()
+    node.op = 'Const'
+    node.name = name
+    node.attr['dtype'].type = tf.as_dtype(value.dtype).as_datatype_enum
+    node.attr['value'].tensor.CopyFrom(tf.make_tensor_proto(value))
+    return name
+
+# make the consumers of node `name` read `ref` instead
+def _bypass(graph_def, name, ref):
+    for node in graph_def.node:
+        for i, x in enumerate(node.input):
+            if x == name or x == name + ':0':
+                node.input[i] = ref
+            elif x == '^' + name:
+                node.input[i] = '^' + _node_name(ref)
+
+# one pass over the graph, return the number of nodes simplified
+def _simplify_once(graph_def, outputs):
+    nodes = dict((n.name, n) for n in graph_def.node)
+    changed = 0
+    for node in list(graph_def.node):
+        if node.name in outputs:
+            continue
+        if node.op == 'Identity' and len(node.input) == 1:
+            _bypass(graph_def, node.name, node.input[0])
+            changed += 1
+        elif node.op == 'Pad':
+            paddings = const_value(nodes, node.input[1])
+            if paddings is None:
+                continue
+            if not paddings.any():
+                _bypass(graph_def, node.name, node.input[0])
+                changed += 1
+                continue
+            inner = nodes.get(_node_name(node.input[0]))
+            inner_paddings = const_value(nodes, inner.input[1]) \
+                if inner is not None and inner.op == 'Pad' else None
+            if inner_paddings is not None:
+                node.input[0] = inner.input[0]
+                node.input[1] = add_const(graph_def, node.name + '/merged_paddings',
+                                           inner_paddings + paddings)
+                changed += 1
+        elif node.op == 'Transpose':
+            perm = const_value(nodes, node.input[1])
+            if perm is None:
+                continue
+            if (perm == np.arange(len(perm))).all():
+                _bypass(graph_def, node.name, node.input[0])
+                changed += 1
+                continue
+            inner = nodes.get(_node_name(node.input[0]))
+            inner_perm = const_value(nodes, inner.input[1]) \
+                if inner is not None and inner.op == 'Transpose' else None
+            if inner_perm is not None:
+                # x.transpose(p1).transpose(p2) == x.transpose(p1[p2])
+                node.input[0] = inner.input[0]
+                node.input[1] = add_const(graph_def, node.name + '/merged_perm',
+                                           inner_perm[perm].astype(perm.dtype))
+                changed += 1
+    return changed
+
+# return the simplified graph_def and the number of nodes simplified
+def simplify(graph_def, outputs=OUTPUTS):
+    graph_def = tf.GraphDef.FromString(graph_def.SerializeToString())
+    total = 0
+    while True:
+        changed = _simplify_once(graph_def, outputs)
+        # drop the nodes bypassed or merged
+        graph_def = tf.graph_util.extract_sub_graph(graph_def, outputs)
+        total += changed
+        if not changed:
+            break
+    if TransformGraph is not None:
+        graph_def = TransformGraph(graph_def, [INPUT], outputs, TRANSFORMS)
+    else:
+        logger.warn('[exportModel] graph_transforms is not available, '
+                    'the constants are folded when the session is created')
+    return graph_def, total
+
+# the predict-only graph of a compressed model with its variables as constants
+def freeze(cfg_path, data_format=None, graph_cache=None):
+    model, script, arch, model_path = load_compressed(cfg_path, data_format)
+    graph = load_inference_graph(model, script, graph_cache, **arch)
+    with graph.as_default(), tf.Session() as sess:
+        restore_variables(sess, model_path)
+        return tf.graph_util.convert_variables_to_constants(
+            sess, graph.as_graph_def(), OUTPUTS)
+
+def export(cfg_path, out_path, data_format=None, graph_cache=None):
+    frozen = freeze(cfg_path, data_format, graph_cache)
+    graph_def, simplified = simplify(frozen)
+    with open(out_path, 'wb') as f:
+        f.write(graph_def.SerializeToString())
+    info = {'cfg': os.path.abspath(cfg_path), 'data_format': data_format,
+            'input': INPUT, 'outputs': OUTPUTS,
+            'nodes_frozen': len(frozen.node), 'nodes': len(graph_def.node),
+            'simplified': simplified}
+    with open(os.path.splitext(out_path)[0] + '.json', 'w') as f:
+        json.dump(info, f, indent=2)
+    logger.info('[exportModel] {} nodes ({} frozen, {} simplified), written to {}'.format(
+        info['nodes'], info['nodes_frozen'], simplified, out_path))
+    return info
+
+
+# the XLA ops launching the compiled clusters
+XLA_LAUNCH_OPS = ['_XlaLaunch', 'XlaLaunch', '_XlaRun']
+
+def xla_config(config):
+    config.graph_options.optimizer_options.global_jit_level = tf.OptimizerOptions.ON_1
+    return config
+
+# mark the nodes for XLA JIT compilation, as experimental_jit_scope does:
+#   global_jit_level alone has no effect on CPU in TensorFlow 1.x
+def mark_for_xla(graph_def):
+    for node in graph_def.node:
+        node.attr['_XlaCompile'].b = True
+    return graph_def
+
+# the number of XLA clusters in the graphs executed for fetches
+def xla_clusters(sess, fetches, feed_dict):
+    meta = tf.RunMetadata()
+    sess.run(fetches, feed_dict=feed_dict, run_metadata=meta,
+             options=tf.RunOptions(output_partition_graphs=True))
+    return sum(1 for g in meta.partition_graphs for n in g.node if n.op in XLA_LAUNCH_OPS)
+
+# a session on a frozen graph, its input and its probabilities
+def load_frozen(path, threads=None, xla=False):
+    graph_def = tf.GraphDef()
+    with open(path, 'rb') as f:
+        graph_def.ParseFromString(f.read())
+    if xla:
+        graph_def = mark_for_xla(graph_def)
+    graph = tf.Graph()
+    with graph.as_default():
+        tf.import_graph_def(graph_def, name='')
+    config = session_config(threads)
+    sess = tf.Session(graph=graph, config=xla_config(config) if xla else config)
+    return sess, graph.get_tensor_by_name(INPUT + ':0'), graph.get_tensor_by_name(OUTPUTS[0] + ':0')
+
+# a session on the plain predict-only graph, with variables
+def load_plain(cfg_path, data_format, threads=None):
+    model, script, arch, model_path = load_compressed(cfg_path, data_format)
+    graph = load_inference_graph(model, script, None, **arch)
+    sess = tf.Session(graph=graph, config=session_config(threads))
+    with graph.as_default():
+        restore_variables(sess, model_path)
+    return sess, graph.get_tensor_by_name(INPUT + ':0'), graph.get_tensor_by_name(OUTPUTS[0] + ':0')
+
+def fake_images(x, batch):
+    shape = [batch] + x.get_shape().as_list()[1:]
+    return np.random.uniform(0, 255, size=shape).astype(x.dtype.as_numpy_dtype)
+
+def run_benchmark(kind, args):
+    if kind == 'plain':
+        sess, x, y = load_plain(args.cfg, args.data_format, args.threads)
+    else:
+        sess, x, y = load_frozen(args.out, args.threads, xla=kind == 'frozen+xla')
+    rst = {}
+    with sess:
+        latency = time_steps(sess, y, {x: fake_images(x, 1)}, args.steps)
+        batch = time_steps(sess, y, {x: fake_images(x, args.batch)}, max(args.steps // 5, 3))
+        rst['nodes'] = len(sess.graph.as_graph_def().node)
+        if kind == 'frozen+xla':
+            rst['xla_clusters'] = xla_clusters(sess, y, {x: fake_images(x, 1)})
+            if not rst['xla_clusters']:
+                logger.warn('[exportModel] no XLA cluster was formed, '
+                            'frozen+xla runs the graph without XLA')
+    rst.update({'latency_ms_p50': percentile(latency, 50) * 1000,
+                'latency_ms_p90': percentile(latency, 90) * 1000,
+                'images_per_s': args.batch / np.mean(batch)})
+    return rst
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cfg', help='cfg of the compressed model', required=True)
+    parser.add_argument('--out', help='the frozen graph, default: the cfg with .pb')
+    parser.add_argument('--data_format', help='specify NCHW or NHWC, default: NCHW with GPU, NHWC without',
+                        type=str, choices=['NCHW', 'NHWC'])
+    parser.add_argument('--graph_cache', help='directory to cache the inference graphs')
+    parser.add_argument('--benchmark', help='compare the latency and throughput of the plain '
+                        'and the frozen graphs on CPU', action='store_true')
+    parser.add_argument('--xla', help='also benchmark the frozen graph with XLA JIT', action='store_true')
+    parser.add_argument('--batch', help='batch size of the throughput', type=int, default=128)
+    parser.add_argument('--steps', help='runs at batch 1', type=int, default=50)
+    parser.add_argument('--threads', help='intra-op threads, default: all cores', type=int)
+    parser.add_argument('--gpu', help='comma separated list of GPU(s) to use.')
+    parser.add_argument('--output', help='save the benchmark as json')
+    args = parser.parse_args()
+    # the benchmark is on CPU unless --gpu is given
+    os.environ['CUDA_VISIBLE_DEVICES'] = args.gpu or ''
+    args.data_format = args.data_format or default_data_format()
+    args.out = args.out or args.cfg[:-len('.cfg')] + '.pb'
+
+    # TensorFlow can't fork once a session exists: no session in this process
+    info = run_isolated(export, args.cfg, args.out, args.data_format, args.graph_cache)
+    if 'failure' in info:
+        logger.error('[exportModel] export failed: {}'.format(info['failure']))
+        sys.exit(1)
+    if args.benchmark:
+        rows = []
+        for kind in ['plain', 'frozen'] + (['frozen+xla'] if args.xla else []):
+            r = run_isolated(run_benchmark, kind, args)
+            r['graph'] = kind
+            rows.append(r)
+        print_table(rows, ['graph', 'nodes', 'latency_ms_p50', 'latency_ms_p90', 'images_per_s',
+                           'xla_clusters', 'peak_rss_mb', 'failure'])
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(rows, f, indent=2)
@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+# File: graphCache.py
+
+import hashlib
+import inspect
+import json
+import os
+import re
+import numpy as np
+
+import sys
+sys.path.append('../../tensorpack')
+from tensorpack import *
+from tensorpack.tfutils.tower import TowerContext
+
+import tensorflow as tf
+
+"""
+On-disk cache of inference graphs. Building a deep ResNet from Python takes
+long, so the inference graph of an architecture is exported once as a
+MetaGraph and imported by later evaluations of the same architecture.
+
+The cache key contains the script, the architecture (structure,
+discard_first_block, num_class, data_format, ...), the TensorFlow version and a
+digest of the model code: the file defining the Model and MODEL_SOURCES.
+Editing any of them invalidates the cached graphs. Stale files are never read
+again and can be deleted.
+
+The models built with predict_only=True take the images alone and have no
+loss, summary or side output. The 0/1 error vectors asked by the evaluations,
+incorrect_vector, wrong-top1 and wrong-top5, are then computed from their
+logits and the labels of the dataflow by GraphDatasetPredictor.
+"""
+
+CACHE_VERSION = 1
+# modules used by the models, besides the file defining the Model class
+MODEL_SOURCES = ['EpsilonResnetBase.py', 'LoopResnetBase.py']
+# the logits of all the models
+LOGITS = 'linear/output'
+# the error vectors computed from the logits of a predict-only graph, by their top-k
+ERROR_OUTPUTS = {'incorrect_vector': 1, 'wrong-top1': 1, 'wrong-top5': 5}
+
+
+# build the inference graph of model in the default graph
+#   return the placeholders
+def build_inference_graph(model):
+    inputs = model.get_reused_placehdrs()
+    with TowerContext('', is_training=False):
+        model.build_graph(inputs)
+    return inputs
+
+def source_digest(model):
+    base = os.path.dirname(os.path.abspath(__file__))
+    files = [inspect.getsourcefile(type(model))] + \
+        [os.path.join(base, f) for f in MODEL_SOURCES]
+    h = hashlib.sha1()
+    for f in files:
+        if os.path.isfile(f):
+            with open(f, 'rb') as fin:
+                h.update(fin.read())
+    return h.hexdigest()
+
+def _jsonable(v):
+    if hasattr(v, 'tolist'):
+        return v.tolist()
+    if isinstance(v, (list, tuple)):
+        return [_jsonable(x) for x in v]
+    return v
+
+def cache_key(model, script, **arch):
+    desc = {'script': script,
+            'arch': dict((k, _jsonable(v)) for k, v in arch.items()),
+            'predict_only': getattr(model, 'predict_only', False),
+            'source': source_digest(model),
+            'tensorflow': tf.__version__,
+            'version': CACHE_VERSION}
+    key = hashlib.sha1(json.dumps(desc, sort_keys=True).encode('utf-8')).hexdigest()
+    return key[:16], desc
+
+# return a new tf.Graph holding the inference graph of model
+#   The graph is imported from cache_dir if the same architecture was built
+#   before by the same model code, otherwise it is built and exported.
+#   arch: the arguments which define the architecture, part of the cache key.
+def load_inference_graph(model, script, cache_dir=None, **arch):
+    g = tf.Graph()
+    if not cache_dir:
+        with g.as_default():
+            build_inference_graph(model)
+        return g
+
+    key, desc = cache_key(model, script, **arch)
+    path = os.path.join(cache_dir, '{}-{}.meta'.format(script, key))
+    with g.as_default():
+        if os.path.isfile(path):
+            tf.train.import_meta_graph(path, clear_devices=True)
+            logger.info('[graphCache] import the graph from {}'.format(path))
+            return g
+        build_inference_graph(model)
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        # write then rename, so concurrent evaluations never read a partial file
+        tmp = '{}.{}.tmp'.format(path, os.getpid())
+        tf.train.export_meta_graph(filename=tmp, clear_devices=True)
+        os.rename(tmp, path)
+        with open(path.replace('.meta', '.json'), 'w') as f:
+            json.dump(desc, f, indent=2, sort_keys=True)
+        logger.info('[graphCache] export the graph to {}'.format(path))
+    return g
+
+# accept a checkpoint prefix, a .index or .data-xxxxx-of-xxxxx file or a directory
+def checkpoint_prefix(path):
+    if os.path.isdir(path):
+        return tf.train.latest_checkpoint(path)
+    if path.endswith('.index'):
+        return path[:-len('.index')]
+    return re.sub('\.data-\d+-of-\d+$', '', path)
+
+# restore the variables of the default graph found in the checkpoint,
+#   initialize the others
+def restore_variables(sess, model_path):
+    prefix = checkpoint_prefix(model_path)
+    reader = tf.train.NewCheckpointReader(prefix)
+    variables = tf.global_variables()
+    found = [v for v in variables if reader.has_tensor(v.op.name)]
+    missing = [v for v in variables if not reader.has_tensor(v.op.name)]
+    if len(missing):
+        logger.warn('[graphCache] variables not found in {}: {}'.format(
+            prefix, ', '.join(v.op.name for v in missing)))
+        sess.run(tf.variables_initializer(missing))
+    if len(found):
+        tf.train.Saver(found).restore(sess, prefix)
+
+
+# 1.0 where label is not in the top-k logits, as prediction_incorrect
+def errors_from_logits(logits, label, topk=1):
+    target = logits[np.arange(len(label)), label]
+    return ((logits > target[:, np.newaxis]).sum(axis=1) >= topk).astype('float32')
+
+
+class GraphDatasetPredictor(object):
+    """
+    Run a graph from :func:`load_inference_graph` on every datapoint of a
+    DataFlow. Same interface as tensorpack's SimpleDatasetPredictor.
+    The inputs missing in a predict-only graph, e.g. label, are not fed, and
+    the outputs of ERROR_OUTPUTS missing in it are computed from the logits.
+    """
+    def __init__(self, graph, model_path, dataset, input_names, output_names, config=None):
+        self.dataset = dataset
+        ops = set(op.name for op in graph.get_operations())
+        self.input_index = [k for k, n in enumerate(input_names) if n in ops]
+        self.label_index = input_names.index('label') if 'label' in input_names else None
+        missing = [n for n in output_names if n not in ops]
+        if len(missing) and (self.label_index is None or LOGITS not in ops or
+                             any(n not in ERROR_OUTPUTS for n in missing)):
+            raise ValueError('outputs {} not found in the graph'.format(missing))
+        self.computed = [(k, ERROR_OUTPUTS[n]) for k, n in enumerate(output_names) if n not in ops]
+        fetches = [n for n in output_names if n in ops]
+        if len(self.computed):
+            fetches.append(LOGITS)
+        with graph.as_default():
+            self.inputs = [graph.get_tensor_by_name(input_names[k] + ':0') for k in self.input_index]
+            self.outputs = [graph.get_tensor_by_name(n + ':0') for n in fetches]
+            self.sess = tf.Session(config=config)
+            restore_variables(self.sess, model_path)
+
+    def __call__(self, *dp):
+        feed = dict((x, dp[k]) for x, k in zip(self.inputs, self.input_index))
+        outputs = self.sess.run(self.outputs, feed_dict=feed)
+        if not len(self.computed):
+            return outputs
+        logits = outputs.pop()
+        for k, topk in self.computed:
+            outputs.insert(k, errors_from_logits(logits, dp[self.label_index], topk))
+        return outputs
+
+    def get_result(self):
+        self.dataset.reset_state()
+        for dp in self.dataset.get_data():
+            yield self(*dp)
+
+
+# a dataset predictor for the eval functions of the scripts
+#   Without cache_dir and session_config, it is tensorpack's SimpleDatasetPredictor,
+#   unless the model is predict-only.
+def cached_dataset_predictor(model, model_path, dataset, input_names, output_names,
+                             cache_dir=None, script=None, session_config=None, **arch):
+    if not cache_dir and session_config is None and not getattr(model, 'predict_only', False):
+        pred_config = PredictConfig(
+            model=model,
+            session_init=get_model_loader(model_path),
+            input_names=input_names,
+            output_names=output_names)
+        return SimpleDatasetPredictor(pred_config, dataset)
+    graph = load_inference_graph(model, script, cache_dir, **arch)
+    return GraphDatasetPredictor(graph, model_path, dataset, input_names, output_names,
+                                 session_config)
@@ -18,30 +18,55 @@ from tensorpack.utils.stats import RatioCounter
 from tensorpack.tfutils.symbolic_functions import *
 from tensorpack.tfutils.summary import *
 
-from compressModel import read_cfg
+from compressModel import read_cfg, read_channels
+from EpsilonResnetBase import default_data_format, check_data_format, channel_axis, scatter_channels
+from graphCache import cached_dataset_predictor
+import sequentialEval
+import parallelEval
 
 TOTAL_BATCH_SIZE = 256
 INPUT_SHAPE = 224
 DEPTH = None
+GRAPH_CACHE = None
+DATA_FORMAT = 'NCHW'
+# the arguments of sequentialEval.sequential_eval with --sequential
+SEQUENTIAL = None
+# processes and threads of each process of the evaluation, see parallelEval.py
+EVAL_PROCS = 1
+EVAL_THREADS = None
 
 structure = []
 discard_first_block = []
+# the pruned channels of the blocks, see compressModel.prune_channels
+block_channels = None
 
 class Model(ModelDesc):
-    def __init__(self, data_format='NCHW'):
-        if data_format == 'NCHW':
-            assert tf.test.is_gpu_available()
+    # depth, structure, discard_first_block, channels: default to the globals set from --cfg
+    # predict_only: take the images alone and build the logits and the
+    #   probabilities `output`, without loss, summaries and label
+    # channels: the kept channels of the pruned convs of the blocks, see
+    #   compressModel.prune_channels
+    def __init__(self, data_format='NCHW', depth=None, structure=None, discard_first_block=None,
+                 predict_only=False, channels=None):
+        check_data_format(data_format)
         self.data_format = data_format
+        self.depth = depth
+        self.structure = structure
+        self.discard_first_block = discard_first_block
+        self.predict_only = predict_only
+        self.channels = channels
 
     def _get_inputs(self):
         # uint8 instead of float32 is used as input type to reduce copy overhead.
         # It might hurt the performance a liiiitle bit.
         # The pretrained models were trained with float32.
-        return [InputDesc(tf.uint8, [None, INPUT_SHAPE, INPUT_SHAPE, 3], 'input'),
-                InputDesc(tf.int32, [None], 'label')]
+        image = InputDesc(tf.uint8, [None, INPUT_SHAPE, INPUT_SHAPE, 3], 'input')
+        if self.predict_only:
+            return [image]
+        return [image, InputDesc(tf.int32, [None], 'label')]
 
     def _build_graph(self, inputs):
-        image, label = inputs
+        image = inputs[0]
         image = tf.cast(image, tf.float32) * (1.0 / 255)
 
         # Wrong mean/std are used for compatibility with pre-trained models.
@@ -51,6 +76,12 @@ class Model(ModelDesc):
         image = (image - image_mean) / image_std
         if self.data_format == 'NCHW':
             image = tf.transpose(image, [0, 3, 1, 2])
+        ch_axis = channel_axis(self.data_format)
+        depth = self.depth or DEPTH
+        blocks = structure if self.structure is None else self.structure
+        first_discarded = discard_first_block if self.discard_first_block is None \
+            else self.discard_first_block
+        pruned = (block_channels if self.channels is None else self.channels) or {}
 
         def shortcut(l, n_in, n_out, stride):
             if n_in != n_out:
@@ -58,8 +89,18 @@ class Model(ModelDesc):
             else:
                 return l
 
-        def basicblock(l, ch_out, stride, preact):
-            ch_in = l.get_shape().as_list()[1]
+        # widths: the kept channels of the pruned convs of the block
+        def width(widths, conv, ch):
+            return len(widths[conv]) if conv in widths else ch
+
+        # the last conv of a block, its pruned channels are put back as zeros
+        #   to be added to the shortcut
+        def last_conv(name, l, ch_out, kernel, widths):
+            l = Conv2D(name, l, width(widths, name, ch_out), kernel)
+            return scatter_channels(l, widths.get(name, range(ch_out)), ch_out, self.data_format)
+
+        def basicblock(l, ch_out, stride, preact, widths={}):
+            ch_in = l.get_shape().as_list()[ch_axis]
             if preact == 'both_preact':
                 l = BNReLU('preact', l)
                 input = l
@@ -68,12 +109,12 @@ class Model(ModelDesc):
                 l = BNReLU('preact', l)
             else:
                 input = l
-            l = Conv2D('conv1', l, ch_out, 3, stride=stride, nl=BNReLU)
-            l = Conv2D('conv2', l, ch_out, 3)
+            l = Conv2D('conv1', l, width(widths, 'conv1', ch_out), 3, stride=stride, nl=BNReLU)
+            l = last_conv('conv2', l, ch_out, 3, widths)
             return l + shortcut(input, ch_in, ch_out, stride)
 
-        def bottleneck(l, ch_out, stride, preact):
-            ch_in = l.get_shape().as_list()[1]
+        def bottleneck(l, ch_out, stride, preact, widths={}):
+            ch_in = l.get_shape().as_list()[ch_axis]
             if preact == 'both_preact':
                 l = BNReLU('preact', l)
                 input = l
@@ -82,35 +123,46 @@ class Model(ModelDesc):
                 l = BNReLU('preact', l)
             else:
                 input = l
-            l = Conv2D('conv1', l, ch_out, 1, nl=BNReLU)
-            l = Conv2D('conv2', l, ch_out, 3, stride=stride, nl=BNReLU)
-            l = Conv2D('conv3', l, ch_out * 4, 1)
+            l = Conv2D('conv1', l, width(widths, 'conv1', ch_out), 1, nl=BNReLU)
+            l = Conv2D('conv2', l, width(widths, 'conv2', ch_out), 3, stride=stride, nl=BNReLU)
+            l = last_conv('conv3', l, ch_out * 4, 1, widths)
             return l + shortcut(input, ch_in, ch_out * 4, stride)
 
+        def first_block(l, ch_out, stride, preact):
+            # the residual of block0 is discarded, only its shortcut is kept.
+            #   As in imagenetEpsilonResnet, the shortcut has ch_out * 4 channels.
+            ch_in = l.get_shape().as_list()[ch_axis]
+            if preact == 'both_preact':
+                l = BNReLU('preact', l)
+            return shortcut(l, ch_in, ch_out * 4, stride)
+
         def layer(l, layername, block_func, features, count, stride, first=False):
             with tf.variable_scope(layername):
                 with tf.variable_scope('block0'):
                     grp = int(layername[5])
-                    if discard_first_block and discard_first_block[grp] ==1:
+                    if len(first_discarded) and first_discarded[grp] ==1:
                         l = first_block(l, features, stride,
                                 'no_preact' if first else 'both_preact')
                     else:
                         l = block_func(l, features, stride,
-                                   'no_preact' if first else 'both_preact')
+                                   'no_preact' if first else 'both_preact',
+                                   pruned.get('{}/block0'.format(layername), {}))
                 for i in range(1, count):
                     with tf.variable_scope('block{}'.format(i)):
-                        l = block_func(l, features, 1, 'default')
+                        l = block_func(l, features, 1, 'default',
+                                       pruned.get('{}/block{}'.format(layername, i), {}))
                 return l
 
         cfg = {
             18: ([2, 2, 2, 2], basicblock),
             34: ([3, 4, 6, 3], basicblock),
             50: ([3, 4, 6, 3], bottleneck),
-            101: ([3, 4, 23, 3], bottleneck)
+            101: ([3, 4, 23, 3], bottleneck),
+            152: ([3, 8, 36, 3], bottleneck)
         }
-        defs, block_func = cfg[DEPTH]
-        if len(structure)>0:
-            defs = structure
+        defs, block_func = cfg[depth]
+        if len(blocks)>0:
+            defs = blocks
 
         with argscope(Conv2D, nl=tf.identity, use_bias=False,
                       W_init=variance_scaling_initializer(mode='FAN_OUT')), \
@@ -125,7 +177,11 @@ class Model(ModelDesc):
                       .BNReLU('bnlast')
                       .GlobalAvgPooling('gap')
                       .FullyConnected('linear', 1000, nl=tf.identity)())
+        if self.predict_only:
+            tf.nn.softmax(logits, name='output')
+            return
 
+        label = inputs[1]
         loss = tf.nn.sparse_softmax_cross_entropy_with_logits(logits=logits, labels=label)
         loss = tf.reduce_mean(loss, name='xentropy-loss')
 
@@ -144,14 +200,17 @@ class Model(ModelDesc):
         return tf.train.MomentumOptimizer(lr, 0.9, use_nesterov=True)
 
 
-def get_data(train_or_test, fake=False):
+def get_data(train_or_test, fake=False, shard=None):
     if fake:
         return FakeData([[64, 224, 224, 3], [64]], 1000, random=False, dtype='uint8')
     isTrain = train_or_test == 'train'
 
     datadir = args.data
+    # the val set is shuffled for the sequential evaluation
     ds = dataset.ILSVRC12(datadir, train_or_test,
-                          shuffle=True if isTrain else False, dir_structure='original')
+                          shuffle=isTrain or SEQUENTIAL is not None, dir_structure='original')
+    if shard is not None:
+        ds = parallelEval.shard_dataset(ds, *shard)
     if isTrain:
         class Resize(imgaug.ImageAugmentor):
             """
@@ -230,15 +289,27 @@ def get_config(fake=False, data_format='NCHW'):
     )
 
 
+# the predictor of the val set, or of its shard (rank, size)
+def get_predictor(model_file, shard=None, config=None):
+    return cached_dataset_predictor(
+        Model(data_format=DATA_FORMAT, predict_only=True), model_file, get_data('val', shard=shard),
+        ['input', 'label'], ['wrong-top1', 'wrong-top5'],
+        cache_dir=GRAPH_CACHE, script='imagenetCompressedResnet', session_config=config,
+        depth=DEPTH, structure=structure, discard_first_block=discard_first_block,
+        num_class=1000, data_format=DATA_FORMAT, channels=block_channels)
+
 def eval_on_ILSVRC12(model_file, data_dir):
-    ds = get_data('val')
-    pred_config = PredictConfig(
-        model=Model(),
-        session_init=get_model_loader(model_file),
-        input_names=['input', 'label'],
-        output_names=['wrong-top1', 'wrong-top5']
-    )
-    pred = SimpleDatasetPredictor(pred_config, ds)
+    if EVAL_PROCS > 1 and SEQUENTIAL is None:
+        counts = parallelEval.parallel_counts(
+            lambda shard, config: parallelEval.count_errors(get_predictor(model_file, shard, config)),
+            EVAL_PROCS, EVAL_THREADS)
+        print("Top1 Error: {}".format(parallelEval.ratio(counts[0])))
+        print("Top5 Error: {}".format(parallelEval.ratio(counts[1])))
+        return
+    pred = get_predictor(model_file)
+    if SEQUENTIAL is not None:
+        sequentialEval.sequential_eval(pred, ['Top1 Error', 'Top5 Error'], **SEQUENTIAL)
+        return
     acc1, acc5 = RatioCounter(), RatioCounter()
     for o in pred.get_result():
         batch_size = o[0].shape[0]
@@ -250,20 +321,29 @@ def eval_on_ILSVRC12(model_file, data_dir):
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
-    parser.add_argument('--gpu', help='comma separated list of GPU(s) to use.', required=True)
+    parser.add_argument('--gpu', help='comma separated list of GPU(s) to use.')
     parser.add_argument('--data', help='ILSVRC dataset dir')
     parser.add_argument('--load', help='load model')
     parser.add_argument('--fake', help='use fakedata to test or benchmark this model', action='store_true')
-    parser.add_argument('--data_format', help='specify NCHW or NHWC',
-                        type=str, default='NCHW')
+    parser.add_argument('--data_format', help='specify NCHW or NHWC, default: NCHW with GPU, NHWC without',
+                        type=str, choices=['NCHW', 'NHWC'])
     parser.add_argument('-d', '--depth', help='resnet depth',
-                        type=int, default=18, choices=[18, 34, 50, 101])
+                        type=int, default=18, choices=[18, 34, 50, 101, 152])
     parser.add_argument('--eval', action='store_true')
     parser.add_argument('--cfg',  help = 'eval compressed model based on cfg file')
+    parser.add_argument('--graph_cache', help='directory to cache the inference graphs of evaluation')
+    sequentialEval.add_arguments(parser)
+    parallelEval.add_arguments(parser)
     args = parser.parse_args()
 
     DEPTH = args.depth
-    os.environ['CUDA_VISIBLE_DEVICES'] = args.gpu
+    GRAPH_CACHE = args.graph_cache
+    SEQUENTIAL = sequentialEval.from_args(args)
+    EVAL_PROCS = args.eval_procs
+    EVAL_THREADS = args.eval_threads
+    if args.gpu:
+        os.environ['CUDA_VISIBLE_DEVICES'] = args.gpu
+    DATA_FORMAT = args.data_format or default_data_format()
 
     if args.eval:
         BATCH_SIZE = 128    # something that can run on one gpu
@@ -272,17 +352,17 @@ if __name__ == '__main__':
     
     if args.cfg:
         BATCH_SIZE = 128
-        global structure, discard_first_block
         DEPTH, structure, discard_first_block, model_path = read_cfg(args.cfg)
         structure = np.add(structure, discard_first_block)
+        block_channels = read_channels(args.cfg)
         eval_on_ILSVRC12(model_path, args.data)
         sys.exit()
 	
-    NR_GPU = len(args.gpu.split(','))
+    NR_GPU = len(args.gpu.split(',')) if args.gpu else 1
     BATCH_SIZE = TOTAL_BATCH_SIZE // NR_GPU
 
     logger.auto_set_dir()
-    config = get_config(fake=args.fake, data_format=args.data_format)
+    config = get_config(fake=args.fake, data_format=DATA_FORMAT)
     if args.load:
         config.session_init = SaverRestore(args.load)
     config.nr_tower = NR_GPU
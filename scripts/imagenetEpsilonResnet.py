@@ -16,89 +16,159 @@ from tensorpack import *
 from tensorpack.utils.stats import RatioCounter
 from tensorpack.tfutils.symbolic_functions import *
 from tensorpack.tfutils.summary import *
+from tensorpack.tfutils.tower import get_current_tower_context
 
 from EpsilonResnetBase import *
+from AccumGradOptimizer import AccumGradOptimizer
+import dataParallel
+from graphCache import cached_dataset_predictor
+import sequentialEval
+import parallelEval
+from earlyStop import imagenet_block_names
+from asyncCheckpoint import AsyncModelSaver
+from autoCompress import AutoCompressor
+from asyncEval import AsyncValidation, watch, error_stats
+from compressModel import read_cfg, read_channels
+import imagenetCompressedResnet
 
 TOTAL_BATCH_SIZE = 256
 INPUT_SHAPE = 224
 DEPTH = None
 SIDE_POSITION = None
 EPSILON = 2.0
+RECOMPUTE = 0
+ACCUM = 1
+GRAPH_CACHE = None
+DATA_FORMAT = 'NCHW'
+# the arguments of sequentialEval.sequential_eval with --sequential
+SEQUENTIAL = None
+# processes and threads of each process of the evaluation, see parallelEval.py
+EVAL_PROCS = 1
+EVAL_THREADS = None
+ASYNC_SAVE = False
+KEEP_EVERY = 10
+AUTO_COMPRESS = False
+ASYNC_EVAL = False
+EVAL_GPU = None
+
+# normalize the uint8 images and transpose them to data_format
+def preprocess(image, data_format):
+    image = tf.cast(image, tf.float32) * (1.0 / 255)
+
+    # Wrong mean/std are used for compatibility with pre-trained models.
+    # Should actually add a RGB-BGR conversion here.
+    image_mean = tf.constant([0.485, 0.456, 0.406], dtype=tf.float32)
+    image_std = tf.constant([0.229, 0.224, 0.225], dtype=tf.float32)
+    image = (image - image_mean) / image_std
+    if data_format == 'NCHW':
+        image = tf.transpose(image, [0, 3, 1, 2])
+    return image
+
+def shortcut(l, n_in, n_out, stride):
+    if n_in != n_out:
+        return Conv2D('convshortcut', l, n_out, 1, stride=stride)
+    else:
+        return l
+
+def residual_convs(l, ch_out, stride, is_basicblock):
+    if is_basicblock:
+        l = Conv2D('conv1', l, ch_out, 3, stride=stride, nl=BNReLU)
+        l = Conv2D('conv2', l, ch_out, 3)
+    else:
+        l = Conv2D('conv1', l, ch_out, 1, nl=BNReLU)
+        l = Conv2D('conv2', l, ch_out, 3, stride=stride, nl=BNReLU)
+        l = Conv2D('conv3', l, ch_out * 4, 1)
+    return l    
+
+# residual and shortcut of one block
+# the block of group2 after which the side supervision is placed, in the
+#   middle of the network, at least the first one (depth 18)
+def side_position(defs):
+    return max(0, sum(defs) // 2 - sum(defs[:2]) - 1)
+
+def residual_body(l, ch_out, stride, preact, is_basicblock, data_format):
+    ch_in = l.get_shape().as_list()[channel_axis(data_format)]
+    if preact == 'both_preact':
+        l = BNReLU('preact', l)
+        input = l
+    elif preact != 'no_preact':
+        input = l
+        l = BNReLU('preact', l)
+    else:
+        input = l
+    short_cut = shortcut(input, ch_in, ch_out if is_basicblock else ch_out * 4, stride)
+    l = residual_convs(l, ch_out, stride, is_basicblock)
+    return l, short_cut
+
 
 class Model(ModelDesc):
-    def __init__(self, data_format='NCHW'):
-        if data_format == 'NCHW':
-            assert tf.test.is_gpu_available()
+    def __init__(self, data_format='NCHW', recompute=0, accum=1, predict_only=False):
+        """
+        Args:
+            recompute (int): if > 0, keep activations only at the boundaries of
+                segments of `recompute` blocks in each group and recompute
+                the rest in the backward pass.
+            accum (int): number of micro-batches whose gradients are accumulated
+                before one update of the optimizer.
+            predict_only (bool): take the images alone and build the logits
+                and the probabilities `output`, without loss, summaries,
+                is_discarded statistics and side output.
+        """
+        check_data_format(data_format)
         self.data_format = data_format
+        self.recompute = recompute
+        if recompute > 0:
+            check_recompute_grad()
+        self.accum = accum
+        self.predict_only = predict_only
 
     def _get_inputs(self):
         # uint8 instead of float32 is used as input type to reduce copy overhead.
         # It might hurt the performance a liiiitle bit.
         # The pretrained models were trained with float32.
-        return [InputDesc(tf.uint8, [None, INPUT_SHAPE, INPUT_SHAPE, 3], 'input'),
-                InputDesc(tf.int32, [None], 'label')]
+        image = InputDesc(tf.uint8, [None, INPUT_SHAPE, INPUT_SHAPE, 3], 'input')
+        if self.predict_only:
+            return [image]
+        return [image, InputDesc(tf.int32, [None], 'label')]
 
     def _build_graph(self, inputs):
-        image, label = inputs
-        image = tf.cast(image, tf.float32) * (1.0 / 255)
-
-        # Wrong mean/std are used for compatibility with pre-trained models.
-        # Should actually add a RGB-BGR conversion here.
-        image_mean = tf.constant([0.485, 0.456, 0.406], dtype=tf.float32)
-        image_std = tf.constant([0.229, 0.224, 0.225], dtype=tf.float32)
-        image = (image - image_mean) / image_std
-        if self.data_format == 'NCHW':
-            image = tf.transpose(image, [0, 3, 1, 2])
+        image = inputs[0]
+        label = None if self.predict_only else inputs[1]
+        image = preprocess(image, self.data_format)
         
         # collect the state for each sparsity promoting function
         preds = []
         # collect outputs of side suprvision
         side_output_cost = []
-        epsilon = get_scalar_var('epsilon', EPSILON, summary=True)
+        epsilon = get_scalar_var('epsilon', EPSILON, summary=not self.predict_only)
 
-        def shortcut(l, n_in, n_out, stride):
-            if n_in != n_out:
-                return Conv2D('convshortcut', l, n_out, 1, stride=stride)
-            else:
-                return l
-        
         def basicblock(l, ch_out, stride, preact):
             return residual(l, ch_out, stride, preact, True)
 
         def bottleneck(l, ch_out, stride, preact):
             return residual(l, ch_out, stride, preact, False)
-        
-        def residual_convs(l, ch_out, stride, is_basicblock):
-            if is_basicblock:
-                l = Conv2D('conv1', l, ch_out, 3, stride=stride, nl=BNReLU)
-                l = Conv2D('conv2', l, ch_out, 3)
-            else:
-                l = Conv2D('conv1', l, ch_out, 1, nl=BNReLU)
-                l = Conv2D('conv2', l, ch_out, 3, stride=stride, nl=BNReLU)
-                l = Conv2D('conv3', l, ch_out * 4, 1)
-            return l    
 
         def residual(l, ch_out, stride, preact, is_basicblock):
-            ch_in = l.get_shape().as_list()[1]
-            if preact == 'both_preact':
-                l = BNReLU('preact', l)
-                input = l
-            elif preact != 'no_preact':
-                input = l
-                l = BNReLU('preact', l)
-            else:
-                input = l
-            short_cut = shortcut(input, ch_in, ch_out * 4, stride)
-            l = residual_convs(l, ch_out, stride, is_basicblock)
+            l, short_cut = residual_body(l, ch_out, stride, preact, is_basicblock,
+                                         self.data_format)
             identity_w = strict_identity(l, EPSILON)
             l = identity_w * l + short_cut
-            
-            is_discarded = tf.subtract(1.0, identity_w, 'is_discarded')
+            monitor_discarded(identity_w)
+            return l
+
+        def monitor_discarded(identity_w):
+            if self.predict_only:
+                return
+            if self.accum > 1 and get_current_tower_context().is_training:
+                # count the blocks discarded for the whole effective batch
+                is_discarded = accumulate_discarded(
+                    tf.subtract(1.0, identity_w), self.accum, 'is_discarded')
+            else:
+                is_discarded = tf.subtract(1.0, identity_w, 'is_discarded')
             #is_kept = tf.identity(identity_w, 'is_kept')
             #add_moving_summary(is_discarded, is_kept)
             add_moving_summary(is_discarded)
             preds.append(is_discarded)
-            return l
 
         cfg = {
             18: ([2, 2, 2, 2], basicblock),
@@ -111,24 +181,55 @@ class Model(ModelDesc):
         
         # the number of all residual blocks 
         all_cnt = tf.constant(sum(defs), dtype=tf.float32)
+
+        def add_side_output(name, l):
+            if not self.predict_only:
+                side_output_cost.append(side_output(name, l, label, 1000))
         
         def layer(l, layername, block_func, features, count, stride, first=False):
+            if self.recompute > 0:
+                return recomputed_layer(l, layername, block_func, features, count, stride, first)
             with tf.variable_scope(layername):
                 with tf.variable_scope('block0'):
                     l = block_func(l, features, stride,
                                    'no_preact' if first else 'both_preact')
                 # add side supervision at the middle of the network
                 if layername == 'group2' and SIDE_POSITION == 0:
-                    side_output_cost.append(side_output('block0', l, 1000))
+                    add_side_output('block0', l)
                 for i in range(1, count):
                     with tf.variable_scope('block{}'.format(i)):
                         l = block_func(l, features, 1, 'default')
                     # add side supervision at the middle of the network
                     if layername == 'group2' and i == SIDE_POSITION:
-                        side_output_cost.append(
-                            side_output('block{}'.format(i), l, label, 1000))
+                        add_side_output('block{}'.format(i), l)
                 return l
 
+        def recomputed_layer(l, layername, block_func, features, count, stride, first):
+            is_basicblock = block_func is basicblock
+            def body(i):
+                if i == 0:
+                    s, preact = stride, 'no_preact' if first else 'both_preact'
+                else:
+                    s, preact = 1, 'default'
+                return lambda x: residual_body(x, features, s, preact, is_basicblock,
+                                               self.data_format)
+
+            # segments never cross the side supervision
+            side = SIDE_POSITION if layername == 'group2' else -1
+            bounds = sorted(set(list(range(0, count, self.recompute)) +
+                                ([side + 1] if 0 <= side < count - 1 else []) + [count]))
+            with tf.variable_scope(layername):
+                for start, end in zip(bounds[:-1], bounds[1:]):
+                    segment = [('block{}'.format(i), body(i)) for i in range(start, end)]
+                    l, gates = recompute_segment(segment, l, EPSILON)
+                    for name_scope, identity_w, abs_max, abs_mean in gates:
+                        add_response_summary(name_scope, abs_max, abs_mean)
+                        with tf.name_scope(name_scope):
+                            monitor_discarded(identity_w)
+                    if end - 1 == side:
+                        add_side_output('block{}'.format(side), l)
+            return l
+
 
         with argscope(Conv2D, nl=tf.identity, use_bias=False,
                       W_init=variance_scaling_initializer(mode='FAN_OUT')), \
@@ -143,6 +244,9 @@ class Model(ModelDesc):
                       .BNReLU('bnlast')
                       .GlobalAvgPooling('gap')
                       .FullyConnected('linear', 1000, nl=tf.identity)())
+        if self.predict_only:
+            tf.nn.softmax(logits, name='output')
+            return
 
         loss = tf.nn.sparse_softmax_cross_entropy_with_logits(logits=logits, labels=label)
         loss = tf.reduce_mean(loss, name='xentropy-loss')
@@ -170,17 +274,29 @@ class Model(ModelDesc):
 
     def _get_optimizer(self):
         lr = get_scalar_var('learning_rate', 0.1, summary=True)
-        return tf.train.MomentumOptimizer(lr, 0.9, use_nesterov=True)
+        opt = tf.train.MomentumOptimizer(lr, 0.9, use_nesterov=True)
+        # the accumulated gradients are averaged across the workers once per
+        #   update, not at every micro-batch
+        opt = dataParallel.wrap_optimizer(opt)
+        if self.accum > 1:
+            opt = AccumGradOptimizer(opt, self.accum)
+        return opt
 
 
-def get_data(train_or_test, fake=False):
+def get_data(train_or_test, fake=False, shard=None):
     if fake:
         return FakeData([[64, 224, 224, 3], [64]], 1000, random=False, dtype='uint8')
     isTrain = train_or_test == 'train'
 
     datadir = args.data
+    # the val set is shuffled for the sequential evaluation
     ds = dataset.ILSVRC12(datadir, train_or_test,
-                          shuffle=True if isTrain else False, dir_structure='original')
+                          shuffle=isTrain or SEQUENTIAL is not None, dir_structure='original')
+    if shard is not None:
+        ds = parallelEval.shard_dataset(ds, *shard)
+    if isTrain:
+        # not seeded: the processes of PrefetchDataZMQ would produce the same datapoints
+        ds = dataParallel.shard_dataflow(ds, seed=None)
     if isTrain:
         class Resize(imgaug.ImageAugmentor):
             """
@@ -243,35 +359,64 @@ def get_config(fake=False, data_format='NCHW'):
     dataset_val = get_data('val', fake=fake)
     
     side_name = 'group2/side_output/block{}'.format(SIDE_POSITION)
+    if ASYNC_EVAL:
+        validation = AsyncValidation(EVAL_GPU)
+    else:
+        validation = InferenceRunner(dataset_val, [
+            # add callback for side supervision loss
+            ClassificationError('{}/incorrect_vector'.format(side_name),
+                '{}/val_error'.format(side_name)),
+            ClassificationError('wrong-top1', 'val-error-top1'),
+            ClassificationError('wrong-top5', 'val-error-top5')])
+    callbacks = [
+        validation,
+        ScheduledHyperParamSetter('learning_rate',
+                                  [(30, 1e-2), (60, 1e-3), (85, 1e-4), (95, 1e-5)]),
+        HumanHyperParamSetter('learning_rate'),
+    ]
+    saver = None
+    if ASYNC_SAVE:
+        # after the validation, to keep the checkpoints of the best val-error-top1
+        saver = AsyncModelSaver(imagenet_block_names(defs), val_stat='val-error-top1',
+                                keep_every=KEEP_EVERY)
+        callbacks.insert(1, saver)
+    else:
+        callbacks.insert(0, ModelSaver())
+    if AUTO_COMPRESS:
+        callbacks.insert(2, AutoCompressor(imagenet_block_names(defs),
+                                           val_stats=['val-error-top1', 'val-error-top5'],
+                                           saver=saver))
     return TrainConfig(
-        model=Model(data_format=data_format),
+        model=Model(data_format=data_format, recompute=RECOMPUTE, accum=ACCUM),
         dataflow=dataset_train,
-        callbacks=[
-            ModelSaver(),
-            InferenceRunner(dataset_val, [
-                # add callback for side supervision loss
-                ClassificationError('{}/incorrect_vector'.format(side_name),
-                    '{}/val_error'.format(side_name)),
-                ClassificationError('wrong-top1', 'val-error-top1'),
-                ClassificationError('wrong-top5', 'val-error-top5')]),
-            ScheduledHyperParamSetter('learning_rate',
-                                      [(30, 1e-2), (60, 1e-3), (85, 1e-4), (95, 1e-5)]),
-            HumanHyperParamSetter('learning_rate'),
-        ],
-        steps_per_epoch=5000,
+        callbacks=dataParallel.wrap_callbacks(callbacks),
+        session_config=dataParallel.session_config(),
+        # an epoch is still 5000 effective batches
+        steps_per_epoch=5000 * ACCUM,
         max_epoch=110,
     )
 
 
+# the predictor of the val set, or of its shard (rank, size)
+def get_predictor(model_file, shard=None, config=None):
+    return cached_dataset_predictor(
+        Model(data_format=DATA_FORMAT, predict_only=True), model_file, get_data('val', shard=shard),
+        ['input', 'label'], ['wrong-top1', 'wrong-top5'],
+        cache_dir=GRAPH_CACHE, script='imagenetEpsilonResnet', session_config=config,
+        depth=DEPTH, epsilon=EPSILON, num_class=1000, data_format=DATA_FORMAT)
+
 def eval_on_ILSVRC12(model_file, data_dir):
-    ds = get_data('val')
-    pred_config = PredictConfig(
-        model=Model(),
-        session_init=get_model_loader(model_file),
-        input_names=['input', 'label'],
-        output_names=['wrong-top1', 'wrong-top5']
-    )
-    pred = SimpleDatasetPredictor(pred_config, ds)
+    if EVAL_PROCS > 1 and SEQUENTIAL is None:
+        counts = parallelEval.parallel_counts(
+            lambda shard, config: parallelEval.count_errors(get_predictor(model_file, shard, config)),
+            EVAL_PROCS, EVAL_THREADS)
+        print("Top1 Error: {}".format(parallelEval.ratio(counts[0])))
+        print("Top5 Error: {}".format(parallelEval.ratio(counts[1])))
+        return
+    pred = get_predictor(model_file)
+    if SEQUENTIAL is not None:
+        sequentialEval.sequential_eval(pred, ['Top1 Error', 'Top5 Error'], **SEQUENTIAL)
+        return
     acc1, acc5 = RatioCounter(), RatioCounter()
     for o in pred.get_result():
         batch_size = o[0].shape[0]
@@ -280,24 +425,85 @@ def eval_on_ILSVRC12(model_file, data_dir):
     print("Top1 Error: {}".format(acc1.ratio))
     print("Top5 Error: {}".format(acc5.ratio))
 
+# the validation errors of a checkpoint, under the names of InferenceRunner
+def eval_stats(model_path):
+    side = 'group2/side_output/block{}'.format(SIDE_POSITION)
+    pred = cached_dataset_predictor(
+        Model(data_format=DATA_FORMAT), model_path, get_data('val'), ['input', 'label'],
+        ['wrong-top1', 'wrong-top5', side + '/incorrect_vector'],
+        cache_dir=GRAPH_CACHE, script='imagenetEpsilonResnet',
+        depth=DEPTH, epsilon=EPSILON, num_class=1000, data_format=DATA_FORMAT)
+    return error_stats(pred, ['val-error-top1', 'val-error-top5', side + '/val_error'])
+
+# the validation errors of a model compressed by compressModel.py
+def eval_compressed_stats(cfg_path):
+    depth, structure, discard_first_block, model_path = read_cfg(cfg_path)
+    structure = np.add(structure, discard_first_block)
+    channels = read_channels(cfg_path)
+    pred = cached_dataset_predictor(
+        imagenetCompressedResnet.Model(DATA_FORMAT, depth, structure, discard_first_block,
+                                       predict_only=True, channels=channels),
+        model_path, get_data('val'), ['input', 'label'], ['wrong-top1', 'wrong-top5'],
+        cache_dir=GRAPH_CACHE, script='imagenetCompressedResnet',
+        depth=depth, structure=structure, discard_first_block=discard_first_block,
+        num_class=1000, data_format=DATA_FORMAT, channels=channels)
+    return error_stats(pred, ['compressed/val-error-top1', 'compressed/val-error-top5'])
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
-    parser.add_argument('--gpu', help='comma separated list of GPU(s) to use.', required=True)
+    parser.add_argument('--gpu', help='comma separated list of GPU(s) to use.')
     parser.add_argument('--data', help='ILSVRC dataset dir')
     parser.add_argument('--load', help='load model')
     parser.add_argument('--fake', help='use fakedata to test or benchmark this model', action='store_true')
-    parser.add_argument('--data_format', help='specify NCHW or NHWC',
-                        type=str, default='NCHW')
+    parser.add_argument('--data_format', help='specify NCHW or NHWC, default: NCHW with GPU, NHWC without',
+                        type=str, choices=['NCHW', 'NHWC'])
     parser.add_argument('-d', '--depth', help='resnet depth',
                         type=int, default=18, choices=[18, 34, 50, 101,152])
     parser.add_argument('--eval', action='store_true')
     parser.add_argument('-e', '--epsilon', help='epsilon', 
                         type=float, default='2.0')
     parser.add_argument('--cfg',  help = 'eval compressed model based on cfg file')
+    parser.add_argument('--graph_cache', help='directory to cache the inference graphs of evaluation')
+    sequentialEval.add_arguments(parser)
+    parallelEval.add_arguments(parser)
+    parser.add_argument('--recompute', help='recompute activations in segments of this many blocks '
+                        'to save memory. 0 to disable. Needs TensorFlow >= 1.5',
+                        type=int, default=0)
+    parser.add_argument('--accum', help='accumulate the gradients of this many micro-batches '
+                        'per update, to keep the total batch size of 256 on fewer or smaller devices',
+                        type=int, default=1)
+    parser.add_argument('--async_save', help='save the checkpoints in the background and keep '
+                        'those where the discarded blocks changed or val-error-top1 was the best',
+                        action='store_true')
+    parser.add_argument('--keep_every', help='with --async_save, also keep the checkpoints of '
+                        'every this many epochs. 0 to disable', type=int, default=10)
+    parser.add_argument('--auto_compress', help='compress the checkpoint of every epoch '
+                        'in the background', action='store_true')
+    parser.add_argument('--async_eval', help='validate the checkpoints in another process '
+                        'instead of at the end of every epoch', action='store_true')
+    parser.add_argument('--eval_gpu', help='GPU(s) of the validation process of --async_eval, '
+                        'default: CPU')
+    parser.add_argument('--eval_watch', help='run as the validation process of --async_eval '
+                        'on this log dir')
+    dataParallel.add_arguments(parser)
     args = parser.parse_args()
+    # the validation process is not a data-parallel worker
+    worker = None if args.eval_watch else dataParallel.init_from_args(args)
 
     DEPTH = args.depth
+    ASYNC_SAVE = args.async_save
+    KEEP_EVERY = args.keep_every
+    AUTO_COMPRESS = args.auto_compress
+    ASYNC_EVAL = args.async_eval
+    EVAL_GPU = args.eval_gpu
+    EPSILON = args.epsilon
+    RECOMPUTE = args.recompute
+    ACCUM = args.accum
+    GRAPH_CACHE = args.graph_cache
+    SEQUENTIAL = sequentialEval.from_args(args)
+    EVAL_PROCS = args.eval_procs
+    EVAL_THREADS = args.eval_threads
     cfg = {
         18: ([2, 2, 2, 2]),
         34: ([3, 4, 6, 3]),
@@ -307,21 +513,40 @@ if __name__ == '__main__':
     }
     defs = cfg[DEPTH]
     # SIDE_POSITION: side supervision is placed after SIDE_POSITION-th block in group2
-    SIDE_POSITION = sum(defs)/2 - sum(defs[:2]) - 1
-    os.environ['CUDA_VISIBLE_DEVICES'] = args.gpu
+    SIDE_POSITION = side_position(defs)
+    if args.gpu:
+        os.environ['CUDA_VISIBLE_DEVICES'] = args.gpu
+    DATA_FORMAT = args.data_format or default_data_format()
 
     if args.eval:
         BATCH_SIZE = 128    # something that can run on one gpu
         eval_on_ILSVRC12(args.load, args.data)
         sys.exit()
+    if args.eval_watch:
+        BATCH_SIZE = 128
+        watch(args.eval_watch, eval_stats, eval_compressed_stats)
+        sys.exit()
 
-    NR_GPU = len(args.gpu.split(','))
-    BATCH_SIZE = TOTAL_BATCH_SIZE // NR_GPU
-
-    logger.auto_set_dir()
-    config = get_config(fake=args.fake, data_format=args.data_format)
+    NR_GPU = len(args.gpu.split(',')) if args.gpu else 1
+    NR_REPLICA = NR_GPU * dataParallel.world_size()
+    assert TOTAL_BATCH_SIZE % (NR_REPLICA * ACCUM) == 0, \
+        'total batch size {} is not divisible by {} devices x {} micro-batches'.format(
+            TOTAL_BATCH_SIZE, NR_REPLICA, ACCUM)
+    BATCH_SIZE = TOTAL_BATCH_SIZE // (NR_REPLICA * ACCUM)
+    logger.info('micro-batch size per device: {}, effective batch size: {}'.format(
+        BATCH_SIZE, BATCH_SIZE * NR_REPLICA * ACCUM))
+
+    if dataParallel.is_chief():
+        logger.auto_set_dir()
+    else:
+        logger.set_logger_dir(os.path.join(
+            'train_log', 'imagenetEpsilonResnet' + dataParallel.log_dir_suffix()))
+    config = get_config(fake=args.fake, data_format=DATA_FORMAT)
     if args.load:
         config.session_init = SaverRestore(args.load)
     config.nr_tower = NR_GPU
     
-    SyncMultiGPUTrainer(config).train()
+    if worker is not None:
+        QueueInputTrainer(config).train()
+    else:
+        SyncMultiGPUTrainer(config).train()
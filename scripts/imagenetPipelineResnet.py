@@ -0,0 +1,582 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+# File: imagenetPipelineResnet.py
+
+import argparse
+import multiprocessing
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+import numpy as np
+from six.moves import queue
+
+sys.path.append('../../tensorpack')
+from tensorpack import *
+from tensorpack.tfutils.symbolic_functions import *
+from tensorpack.tfutils.summary import *
+from tensorpack.tfutils.tower import TowerContext
+
+import tensorflow as tf
+from tensorflow.contrib.layers import variance_scaling_initializer
+
+from EpsilonResnetBase import *
+from AccumGradOptimizer import AccumGradOptimizer
+from graphCache import restore_variables, checkpoint_prefix
+from compressModel import cfg as depth_cfg
+import imagenetEpsilonResnet
+from imagenetEpsilonResnet import preprocess, residual_body, get_data
+
+"""
+Pipeline model parallelism of the ImageNet epsilon-ResNets (bottleneck blocks,
+depth 50, 101 or 152) across local processes, for CPU nodes on which the
+whole network doesn't fit a useful batch size.
+
+The network is cut into stages of consecutive units (conv0, the blocks,
+the classifier) with about the same FLOPs. Each stage runs in its own process
+and only holds its variables. A batch of TOTAL_BATCH_SIZE images is split
+into --micro_batches micro-batches streamed through the stages with the
+one-forward-one-backward schedule, so the stages work on different
+micro-batches at the same time. The gradients of the micro-batches are
+accumulated and applied once per batch (AccumGradOptimizer.py).
+
+A stage only keeps its input for the micro-batches in flight; the backward
+run recomputes the forward pass of the stage from it. The moving statistics
+of BatchNorm are updated by both runs of every micro-batch, 2 x
+--micro_batches times per batch: their decay is BN_DECAY ** (1 / (2 x
+micro_batches)), so that a batch decays them by BN_DECAY as without the
+pipeline.
+
+With --rebalance, the blocks discarded at every step of an epoch are replaced
+by their identity shortcut and the stages are re-cut by FLOPs, from the
+checkpoint of that epoch. The logs and checkpoints have the names of
+imagenetEpsilonResnet.py and can be compressed by compressModel.py.
+
+Usage:
+    python imagenetPipelineResnet.py -d 152 --stages 4 --micro_batches 8 --data {path_to_ilsvrc12_data}
+    python imagenetPipelineResnet.py -d 101 --stages 2 --fake --steps_per_epoch 10 --rebalance
+"""
+
+TOTAL_BATCH_SIZE = 256
+INPUT_SHAPE = 224
+EPSILON = 2.0
+SIDE_POSITION = None
+DATA_FORMAT = 'NHWC'
+STEM, HEAD = 'stem', 'head'
+FEATURES = [64, 128, 256, 512]
+# spatial size of the output of each group
+RESOLUTION = [56, 28, 14, 7]
+LR_SCHEDULE = [(30, 1e-2), (60, 1e-3), (85, 1e-4), (95, 1e-5)]
+
+
+# the sequential units of the network: STEM, (group, block) ..., HEAD
+def get_units(depth):
+    units = [STEM]
+    for g, count in enumerate(depth_cfg[depth]):
+        units += [(g, k) for k in range(count)]
+    return units + [HEAD]
+
+def block_name(unit):
+    return 'group{}/block{}'.format(*unit)
+
+def block_args(g, k):
+    if k > 0:
+        return 1, 'default'
+    return (1, 'no_preact') if g == 0 else (2, 'both_preact')
+
+# shape of the output of a unit, without the batch dimension
+def output_shape(unit, data_format):
+    if unit == STEM:
+        ch, size = FEATURES[0], RESOLUTION[0]
+    else:
+        ch, size = FEATURES[unit[0]] * 4, RESOLUTION[unit[0]]
+    return [ch, size, size] if data_format == 'NCHW' else [size, size, ch]
+
+# multiply-adds of a unit for one image
+def unit_flops(unit):
+    if unit == STEM:
+        return 112 * 112 * 7 * 7 * 3 * FEATURES[0]
+    if unit == HEAD:
+        return FEATURES[3] * 4 * 1000
+    g, k = unit
+    f, size = FEATURES[g], RESOLUTION[g]
+    stride, _ = block_args(g, k)
+    ch_in = f * 4 if k > 0 else (FEATURES[0] if g == 0 else FEATURES[g - 1] * 4)
+    flops = (size * stride) ** 2 * ch_in * f + size ** 2 * (9 * f * f + f * f * 4)
+    if ch_in != f * 4:
+        flops += size ** 2 * ch_in * f * 4
+    return flops
+
+# cut costs into nstages contiguous parts minimizing the cost of the largest
+#   return the boundaries [0, b1, ..., len(costs)]
+def partition(costs, nstages):
+    n = len(costs)
+    nstages = min(nstages, n)
+    prefix = np.cumsum([0] + list(costs))
+    best = np.full((nstages + 1, n + 1), np.inf)
+    cut = np.zeros((nstages + 1, n + 1), dtype=int)
+    best[0][0] = 0
+    for s in range(1, nstages + 1):
+        for j in range(s, n + 1):
+            for i in range(s - 1, j):
+                v = max(best[s - 1][i], prefix[j] - prefix[i])
+                if v < best[s][j]:
+                    best[s][j], cut[s][j] = v, i
+    bounds = [n]
+    for s in range(nstages, 0, -1):
+        bounds.append(cut[s][bounds[-1]])
+    return bounds[::-1]
+
+def lr_at(epoch):
+    lr = 0.1
+    for e, v in LR_SCHEDULE:
+        if epoch > e:
+            lr = v
+    return lr
+
+
+# build units in the default graph
+#   skipped: names of the discarded blocks replaced by their shortcut
+#   return the output, [(block name, is_discarded)] and the side output costs
+def build_units(l, label, units, skipped, data_format, side=True):
+    gates, side_cost = [], []
+    for unit in units:
+        if unit == STEM:
+            l = preprocess(l, data_format)
+            l = Conv2D('conv0', l, 64, 7, stride=2, nl=BNReLU)
+            l = MaxPooling('pool0', l, shape=3, stride=2, padding='SAME')
+        elif unit == HEAD:
+            l = BNReLU('bnlast', l)
+            l = GlobalAvgPooling('gap', l)
+            l = FullyConnected('linear', l, 1000, nl=tf.identity)
+        else:
+            g, k = unit
+            with tf.variable_scope('group{}'.format(g)):
+                if block_name(unit) not in skipped:
+                    with tf.variable_scope('block{}'.format(k)):
+                        stride, preact = block_args(g, k)
+                        c, short_cut = residual_body(l, FEATURES[g], stride, preact,
+                                                     False, data_format)
+                        identity_w = strict_identity(c, EPSILON, summary=False)
+                        l = identity_w * c + short_cut
+                    gates.append((block_name(unit), 1.0 - identity_w))
+                # add side supervision at the middle of the network
+                if side and g == 2 and k == SIDE_POSITION:
+                    side_cost.append(side_output('block{}'.format(k), l, label, 1000))
+    return l, gates, side_cost
+
+
+class Stage(object):
+    """
+    The graph and the session of one stage.
+    """
+    def __init__(self, units, in_shape, skipped, opts):
+        self.first = units[0] == STEM
+        self.last = units[-1] == HEAD
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            self._build(units, in_shape, skipped, opts)
+            config = tf.ConfigProto(allow_soft_placement=True)
+            config.intra_op_parallelism_threads = opts['threads']
+            config.inter_op_parallelism_threads = 2
+            self.sess = tf.Session(config=config)
+            if opts['load']:
+                restore_variables(self.sess, opts['load'])
+            else:
+                self.sess.run(tf.global_variables_initializer())
+
+    def _build(self, units, in_shape, skipped, opts):
+        data_format = opts['data_format']
+        self.label = tf.placeholder(tf.int32, [None], 'label')
+        if self.first:
+            self.input = tf.placeholder(tf.uint8, [None, INPUT_SHAPE, INPUT_SHAPE, 3], 'input')
+        else:
+            self.input = tf.placeholder(tf.float32, [None] + in_shape, 'input')
+        self.lr = tf.get_variable('learning_rate', [], trainable=False,
+                                  initializer=tf.constant_initializer(0.1))
+
+        # the moving statistics are updated by forward() and backward() of
+        #   every micro-batch
+        bn_decay = BN_DECAY ** (1.0 / (2 * opts['micro_batches']))
+        with argscope(Conv2D, nl=tf.identity, use_bias=False,
+                      W_init=variance_scaling_initializer(mode='FAN_OUT')), \
+                argscope([Conv2D, MaxPooling, GlobalAvgPooling, BatchNorm], data_format=data_format):
+            with TowerContext('', is_training=True), argscope(BatchNorm, decay=bn_decay):
+                out, gates, side_cost = build_units(
+                    self.input, self.label, units, skipped, data_format)
+                cost = [regularize_cost('.*/W', l2_regularizer(1e-4), name='l2_regularize_loss')]
+                cost += [tf.multiply(0.1, c) for c in side_cost]
+                self.stats = {}
+                if self.last:
+                    loss = tf.nn.sparse_softmax_cross_entropy_with_logits(logits=out, labels=self.label)
+                    loss = tf.reduce_mean(loss, name='xentropy-loss')
+                    cost.append(loss)
+                    self.stats = {
+                        'xentropy-loss': loss,
+                        'train-error-top1': tf.reduce_mean(prediction_incorrect(out, self.label, 1)),
+                        'train-error-top5': tf.reduce_mean(prediction_incorrect(out, self.label, 5))}
+                cost = tf.add_n(cost, name='cost')
+            with tf.variable_scope(tf.get_variable_scope(), reuse=True), \
+                    TowerContext('', is_training=False):
+                infer, _, _ = build_units(self.input, self.label, units, skipped,
+                                          data_format, side=False)
+                if self.last:
+                    infer = [tf.reduce_sum(prediction_incorrect(infer, self.label, k))
+                             for k in [1, 5]]
+        self.output, self.infer = out, infer
+        self.gate_names = [n for n, _ in gates]
+        self.gates = [d for _, d in gates]
+
+        var_list = tf.trainable_variables()
+        xs = var_list if self.first else var_list + [self.input]
+        if self.last:
+            grads = tf.gradients(cost, xs)
+        else:
+            self.grad_output = tf.placeholder(tf.float32, out.get_shape(), 'grad_output')
+            grads = tf.gradients([out, cost], xs, grad_ys=[self.grad_output, tf.ones_like(cost)])
+        self.input_grad = None if self.first else grads[-1]
+        var_grads = [(g if g is not None else tf.zeros_like(v), v)
+                     for g, v in zip(grads, var_list)]
+        opt = tf.train.MomentumOptimizer(self.lr, 0.9, use_nesterov=True)
+        opt = AccumGradOptimizer(opt, opts['micro_batches'])
+        with tf.control_dependencies(tf.get_collection(tf.GraphKeys.UPDATE_OPS)):
+            self.train_op = opt.apply_gradients(var_grads) if len(var_grads) else tf.no_op()
+
+    def set_lr(self, lr):
+        self.lr.load(lr, self.sess)
+
+    def forward(self, x, label):
+        return self.sess.run(self.output, {self.input: x, self.label: label})
+
+    def backward(self, x, label, grad_output=None):
+        feed = {self.input: x, self.label: label}
+        if grad_output is not None:
+            feed[self.grad_output] = grad_output
+        fetches = {'train': self.train_op}
+        if len(self.gates):
+            fetches['gates'] = self.gates
+        if len(self.stats):
+            fetches['stats'] = self.stats
+        if self.input_grad is not None:
+            fetches['input_grad'] = self.input_grad
+        return self.sess.run(fetches, feed)
+
+    def inference(self, x, label):
+        return self.sess.run(self.infer, {self.input: x, self.label: label})
+
+    def save(self, path):
+        with self.graph.as_default():
+            saver = tf.train.Saver(tf.global_variables())
+        return saver.save(self.sess, path, write_meta_graph=False)
+
+
+class AsyncSender(object):
+    """
+    Send on a connection from a background thread, so that a stage never
+    blocks on sending and the schedule can't deadlock.
+    """
+    def __init__(self, conn):
+        self.conn = conn
+        self.queue = queue.Queue()
+        t = threading.Thread(target=self._loop)
+        t.daemon = True
+        t.start()
+
+    def _loop(self):
+        while True:
+            self.conn.send(self.queue.get())
+
+    def send(self, msg):
+        self.queue.put(msg)
+
+    def recv(self):
+        return self.conn.recv()
+
+
+class StageWorker(object):
+    """
+    Run the schedule of one stage, in the process of the stage.
+    """
+    def __init__(self, idx, nstages, units, in_shape, skipped, prev_conn, next_conn, opts):
+        self.idx = idx
+        self.nstages = nstages
+        self.micro_batches = opts['micro_batches']
+        self.fake = opts['fake']
+        self.stage = Stage(units, in_shape, skipped, opts)
+        self.prev = AsyncSender(prev_conn) if prev_conn is not None else None
+        self.next = AsyncSender(next_conn) if next_conn is not None else None
+        self.data = None
+
+    def next_batch(self):
+        while True:
+            if self.data is None:
+                ds = get_data('train', fake=self.fake)
+                ds.reset_state()
+                self.data = ds.get_data()
+            try:
+                return next(self.data)
+            except StopIteration:
+                self.data = None
+
+    def forward(self):
+        if self.stage.first:
+            x, label = self.next_batch()
+        else:
+            _, x, label = self.prev.recv()
+        if not self.stage.last:
+            self.next.send(('fwd', self.stage.forward(x, label), label))
+        self.pending.append((x, label))
+
+    def backward(self):
+        x, label = self.pending.popleft()
+        grad = None if self.stage.last else self.next.recv()[1]
+        rst = self.stage.backward(x, label, grad)
+        if not self.stage.first:
+            self.prev.send(('bwd', rst['input_grad']))
+        self.micro_stats.append(rst)
+
+    # one batch: the one-forward-one-backward schedule over the micro-batches
+    def step(self):
+        M = self.micro_batches
+        warmup = min(self.nstages - self.idx - 1, M)
+        self.pending = deque()
+        self.micro_stats = []
+        for _ in range(warmup):
+            self.forward()
+        for _ in range(M - warmup):
+            self.forward()
+            self.backward()
+        for _ in range(warmup):
+            self.backward()
+        # a block is discarded for the batch if it is in all micro-batches
+        discarded = np.min([r['gates'] for r in self.micro_stats], axis=0) \
+            if len(self.stage.gates) else np.zeros([0])
+        stats = dict((k, np.mean([r['stats'][k] for r in self.micro_stats]))
+                     for k in self.stage.stats)
+        return discarded, stats
+
+    # return the mean of the statistics over the steps
+    def train(self, lr, steps):
+        self.stage.set_lr(lr)
+        discarded, stats = [], []
+        for _ in range(steps):
+            d, s = self.step()
+            discarded.append(d)
+            stats.append(s)
+        rst = dict((k, float(np.mean([s[k] for s in stats]))) for k in self.stage.stats)
+        discarded = np.asarray(discarded, dtype=np.float32)
+        for name, v in zip(self.stage.gate_names, np.mean(discarded, axis=0)):
+            rst[name + '/is_discarded'] = float(v)
+        rst['discarded_cnt'] = float(np.mean(np.sum(discarded, axis=1)))
+        return rst
+
+    def validate(self):
+        wrong, total = np.zeros(2), 0
+        if self.stage.first:
+            ds = get_data('val', fake=self.fake)
+            ds.reset_state()
+            batches = (('val', x, label) for x, label in ds.get_data())
+        else:
+            batches = iter(self.prev.recv, ('end',))
+        for _, x, label in batches:
+            out = self.stage.inference(x, label)
+            if self.stage.last:
+                wrong += out
+                total += len(label)
+            else:
+                self.next.send(('val', out, label))
+        if not self.stage.last:
+            self.next.send(('end',))
+            return {}
+        return {'val-error-top1': wrong[0] / max(total, 1),
+                'val-error-top5': wrong[1] / max(total, 1)}
+
+    def save(self, prefix):
+        return self.stage.save('{}-stage{}'.format(prefix, self.idx))
+
+
+def stage_main(idx, nstages, units, in_shape, skipped, prev_conn, next_conn, ctrl, opts):
+    try:
+        worker = StageWorker(idx, nstages, units, in_shape, skipped, prev_conn, next_conn, opts)
+        ctrl.send(('ok', None))
+        while True:
+            cmd = ctrl.recv()
+            if cmd[0] == 'stop':
+                ctrl.send(('ok', None))
+                return
+            ctrl.send(('ok', getattr(worker, cmd[0])(*cmd[1:])))
+    except Exception:
+        ctrl.send(('error', traceback.format_exc()))
+
+
+class Pipeline(object):
+    """
+    The stage processes, controlled from the main process.
+    """
+    def __init__(self, units, bounds, skipped, opts):
+        nstages = len(bounds) - 1
+        links = [multiprocessing.Pipe() for _ in range(nstages - 1)]
+        ctrls = [multiprocessing.Pipe() for _ in range(nstages)]
+        self.ctrls = [c[0] for c in ctrls]
+        self.procs = []
+        for i in range(nstages):
+            in_shape = None if i == 0 else output_shape(units[bounds[i] - 1], opts['data_format'])
+            p = multiprocessing.Process(target=stage_main, args=(
+                i, nstages, units[bounds[i]:bounds[i + 1]], in_shape, skipped,
+                links[i - 1][1] if i > 0 else None,
+                links[i][0] if i < nstages - 1 else None, ctrls[i][1], opts))
+            p.daemon = True
+            p.start()
+            self.procs.append(p)
+        self._wait()
+
+    def _wait(self):
+        rst = [None] * len(self.ctrls)
+        pending = list(range(len(self.ctrls)))
+        while len(pending):
+            for i in list(pending):
+                if self.ctrls[i].poll(1):
+                    status, rst[i] = self.ctrls[i].recv()
+                    if status == 'error':
+                        raise RuntimeError('stage {} failed:\n{}'.format(i, rst[i]))
+                    pending.remove(i)
+                elif not self.procs[i].is_alive():
+                    raise RuntimeError('stage {} exited'.format(i))
+        return rst
+
+    # run a method of StageWorker in all the stages
+    def call(self, *cmd):
+        for c in self.ctrls:
+            c.send(cmd)
+        return self._wait()
+
+    def stop(self):
+        self.call('stop')
+        for p in self.procs:
+            p.join()
+
+
+# merge the checkpoints of the stages into output, over the variables of base,
+#   e.g. those of the blocks which are skipped
+def merge_checkpoints(paths, base, output, global_step):
+    variables = {}
+    for path in ([base] if base else []) + paths:
+        for name, _ in tf.contrib.framework.list_variables(path):
+            variables[name] = tf.contrib.framework.load_variable(path, name)
+    dtype = variables['global_step'].dtype if 'global_step' in variables else np.int64
+    variables['global_step'] = np.asarray(global_step, dtype=dtype)
+    with tf.Graph().as_default(), tf.Session() as sess:
+        new_vars = [tf.Variable(v, name=name) for name, v in sorted(variables.items())]
+        sess.run(tf.global_variables_initializer())
+        tf.train.Saver(new_vars).save(sess, output)
+
+# in a new process, so that this process never creates a session before
+#   starting the stages
+def save_model(pipeline, log_dir, step, base):
+    if not os.path.isdir(os.path.join(log_dir, 'stages')):
+        os.makedirs(os.path.join(log_dir, 'stages'))
+    prefix = os.path.join(log_dir, 'stages', 'model-{}'.format(step))
+    paths = pipeline.call('save', prefix)
+    output = os.path.join(log_dir, 'model-{}'.format(step))
+    p = multiprocessing.Process(target=merge_checkpoints, args=(paths, base, output, step))
+    p.start()
+    p.join()
+    assert p.exitcode == 0, 'failed to merge the checkpoints of the stages'
+    return output
+
+def log_stage_costs(units, bounds, costs):
+    for i in range(len(bounds) - 1):
+        stage_units = units[bounds[i]:bounds[i + 1]]
+        names = [u if u in [STEM, HEAD] else block_name(u) for u in stage_units]
+        logger.info('[pipeline] stage {}: {} .. {}, {:.3f} GFLOPs per image'.format(
+            i, names[0], names[-1], sum(costs[bounds[i]:bounds[i + 1]]) / 1e9))
+
+
+def train(args):
+    logger.set_logger_dir(os.path.join('train_log', 'imagenetPipelineResnet'))
+    units = get_units(args.depth)
+    blocks = [u for u in units if u not in [STEM, HEAD]]
+    skipped = set()
+    opts = {'data_format': DATA_FORMAT, 'micro_batches': args.micro_batches,
+            'fake': args.fake, 'load': args.load,
+            'threads': max(1, multiprocessing.cpu_count() // args.stages)}
+    step = 0
+    if args.load:
+        opts['load'] = checkpoint_prefix(args.load)
+        reader = tf.train.NewCheckpointReader(opts['load'])
+        if reader.has_tensor('global_step'):
+            step = int(reader.get_tensor('global_step'))
+    pipeline = None
+    for epoch in range(step // args.steps_per_epoch + 1, args.max_epoch + 1):
+        if pipeline is None:
+            costs = [0 if u in blocks and block_name(u) in skipped else unit_flops(u)
+                     for u in units]
+            bounds = partition(costs, args.stages)
+            log_stage_costs(units, bounds, costs)
+            pipeline = Pipeline(units, bounds, skipped, opts)
+        start = time.time()
+        lr = lr_at(epoch)
+        stats = {'learning_rate': lr, 'discarded_cnt': float(len(skipped))}
+        for s in pipeline.call('train', lr, args.steps_per_epoch):
+            stats['discarded_cnt'] += s.pop('discarded_cnt')
+            stats.update(s)
+        for name in skipped:
+            stats[name + '/is_discarded'] = 1.0
+        stats['discarded_ratio'] = stats['discarded_cnt'] / len(blocks)
+        if args.data:
+            for s in pipeline.call('validate'):
+                stats.update(s)
+        step += args.steps_per_epoch
+        # the same lines as tensorpack, for compressModel.py
+        logger.info('Epoch {} (global_step {}) finished, time:{:.2f} sec.'.format(
+            epoch, step, time.time() - start))
+        for name in sorted(stats):
+            logger.info('{}: {:.5g}'.format(name, stats[name]))
+        opts['load'] = save_model(pipeline, logger.LOG_DIR, step, opts['load'])
+
+        if args.rebalance:
+            discarded = set(block_name(u) for u in blocks
+                            if u[1] > 0 and stats[block_name(u) + '/is_discarded'] == 1.0)
+            if len(discarded - skipped):
+                logger.info('[pipeline] skip {} and rebalance the stages'.format(
+                    ', '.join(sorted(discarded - skipped))))
+                skipped |= discarded
+                pipeline.stop()
+                pipeline = None
+    if pipeline is not None:
+        pipeline.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data', help='ILSVRC dataset dir')
+    parser.add_argument('--load', help='load model')
+    parser.add_argument('--fake', help='use fakedata to test or benchmark this model', action='store_true')
+    parser.add_argument('--data_format', help='specify NCHW or NHWC',
+                        type=str, choices=['NCHW', 'NHWC'], default='NHWC')
+    parser.add_argument('-d', '--depth', help='resnet depth',
+                        type=int, default=152, choices=[50, 101, 152])
+    parser.add_argument('-e', '--epsilon', help='epsilon',
+                        type=float, default=2.0)
+    parser.add_argument('--stages', help='number of pipeline stages', type=int, default=4)
+    parser.add_argument('--micro_batches', help='number of micro-batches in a batch of 256',
+                        type=int, default=8)
+    parser.add_argument('--rebalance', help='skip the blocks discarded during a whole epoch '
+                        'and re-cut the stages by FLOPs', action='store_true')
+    parser.add_argument('--steps_per_epoch', type=int, default=5000)
+    parser.add_argument('--max_epoch', type=int, default=110)
+    args = parser.parse_args()
+
+    assert TOTAL_BATCH_SIZE % args.micro_batches == 0
+    EPSILON = args.epsilon
+    defs = depth_cfg[args.depth]
+    # SIDE_POSITION: side supervision is placed after SIDE_POSITION-th block in group2
+    SIDE_POSITION = imagenetEpsilonResnet.side_position(defs)
+    # not default_data_format(): no device is initialized before starting the stages
+    DATA_FORMAT = args.data_format
+    # the dataflows of imagenetEpsilonResnet.py
+    imagenetEpsilonResnet.args = args
+    imagenetEpsilonResnet.BATCH_SIZE = TOTAL_BATCH_SIZE // args.micro_batches
+    train(args)
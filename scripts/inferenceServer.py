@@ -0,0 +1,460 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+# File: inferenceServer.py
+
+import argparse
+import glob
+import io
+import json
+import multiprocessing
+import os
+import re
+import threading
+import time
+from collections import deque
+import numpy as np
+
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn, UnixStreamServer
+    from Queue import Queue, Empty
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn, UnixStreamServer
+    from queue import Queue, Empty
+
+import sys
+sys.path.append('../../tensorpack')
+from tensorpack import *
+
+from compressModel import read_cfg, read_channels
+from EpsilonResnetBase import default_data_format
+from graphCache import load_inference_graph, GraphDatasetPredictor, checkpoint_prefix
+from benchmarkUtils import session_config
+
+import tensorflow as tf
+
+"""
+Serve a compressed model over HTTP, on a TCP port or a Unix socket.
+
+The model is loaded from the .cfg written by compressModel.py. Requests are
+queued and every replica, a session with cores / replicas intra-op threads,
+takes the requests waiting in the queue as one batch: a batch is run when it
+has --max_batch images or when its oldest request has waited --max_latency
+ms. With --watch <dir>, the newest compressed_model_{step}.cfg of the
+directory, e.g. <log dir>/compressed of --auto_compress, replaces the served
+model: the new model is loaded while the old one serves, the batches started
+before the swap finish on the old model, and no request is dropped.
+
+Endpoints:
+    POST /predict   body: .npy (application/x-npy) or json {"images": [...]}
+                    of images [N, H, W, 3] or one image [H, W, 3], in 0..255;
+                    the per-pixel mean of cifar and svhn is subtracted here.
+                    reply: {"classes": top-k classes, "scores": their
+                    probabilities, "step": step of the model}
+    POST /reload    body: json {"cfg": path}, or empty for the newest cfg of --watch
+    GET  /metrics   requests, images, batches, latency percentiles (ms),
+                    throughput (images/sec over the last minute), queue size
+    GET  /health
+
+Usage:
+    python inferenceServer.py --cfg train_log/x/compressed/compressed_model_1000.cfg \\
+        --dataset cifar10 --port 8500 --replicas 2 --watch train_log/x/compressed
+    curl -X POST --data-binary @images.npy http://localhost:8500/predict
+"""
+
+# the output of the models, before the softmax
+LOGITS = 'linear/output'
+# put into the queue to stop a replica
+STOP = None
+
+
+def cfg_step(cfg_path):
+    with open(cfg_path, 'r') as f:
+        for l in f:
+            if l.startswith('step: '):
+                return int(l.strip().split(' ')[1])
+    return int(re.search('(\d+)\.cfg$', cfg_path).group(1))
+
+def cfg_is_cifar(cfg_path):
+    with open(cfg_path, 'r') as f:
+        for l in f:
+            if l.startswith('is_cifar_model: '):
+                return l.strip().endswith('True')
+    return True
+
+# the newest compressed_model_{step}.cfg of a directory, or None
+def newest_cfg(cfg_dir):
+    cfgs = glob.glob(os.path.join(cfg_dir, 'compressed_model_*.cfg'))
+    return max(cfgs, key=cfg_step) if cfgs else None
+
+# the per-pixel mean subtracted from the images of the cifar and svhn models
+def per_pixel_mean(name):
+    if name == 'cifar10':
+        return dataset.Cifar10('test').get_per_pixel_mean()
+    if name == 'cifar100':
+        return dataset.Cifar100('test').get_per_pixel_mean()
+    if name == 'svhn':
+        return dataset.SVHNDigit.get_per_pixel_mean()
+    return None
+
+# the compressed model of a cfg, the arguments of its graph cache entry
+#   and the path of its variables
+def load_compressed(cfg_path, data_format):
+    n, structure, discard_first_block, model_path = read_cfg(cfg_path)
+    structure = list(np.add(structure, discard_first_block))
+    reader = tf.train.NewCheckpointReader(checkpoint_prefix(model_path))
+    num_class = reader.get_variable_to_shape_map()['linear/W'][1]
+    channels = read_channels(cfg_path)
+    arch = dict(structure=structure, discard_first_block=discard_first_block,
+                num_class=num_class, data_format=data_format, channels=channels)
+    if cfg_is_cifar(cfg_path):
+        import cifarCompressedResnet
+        model = cifarCompressedResnet.Model(num_class, structure, discard_first_block, n,
+                                            data_format=data_format, predict_only=True,
+                                            channels=channels)
+        return model, 'cifarCompressedResnet', arch, model_path
+    import imagenetCompressedResnet
+    model = imagenetCompressedResnet.Model(data_format, n, structure, discard_first_block,
+                                           predict_only=True, channels=channels)
+    arch['depth'] = n
+    return model, 'imagenetCompressedResnet', arch, model_path
+
+
+class ServedModel(object):
+    """ The replicas of a compressed model, one session each. """
+    def __init__(self, cfg_path, replicas, threads=None, data_format=None, graph_cache=None):
+        self.cfg = os.path.abspath(cfg_path)
+        self.step = cfg_step(cfg_path)
+        model, script, arch, model_path = load_compressed(cfg_path, data_format)
+        graph = load_inference_graph(model, script, graph_cache, **arch)
+        self.predictors = [GraphDatasetPredictor(graph, model_path, None, ['input'], [LOGITS],
+                                                 session_config(threads))
+                           for _ in range(replicas)]
+        x = self.predictors[0].inputs[0]
+        self.input_shape = tuple(x.get_shape().as_list()[1:])
+        self.input_dtype = x.dtype.as_numpy_dtype
+        # number of batches running on this model
+        self.users = 0
+
+    def close(self):
+        for p in self.predictors:
+            p.sess.close()
+
+
+class Request(object):
+    def __init__(self, images):
+        self.images = images
+        self.arrival = time.time()
+        self.done = threading.Event()
+        self.logits = None
+        self.step = None
+        self.error = None
+
+
+class Metrics(object):
+    """ Counters and recent latencies of the server. """
+    def __init__(self, window=60, max_samples=10000):
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.window = window
+        self.requests = self.images = self.batches = self.errors = self.swaps = 0
+        self.latencies = deque(maxlen=max_samples)
+        self.batch_sizes = deque(maxlen=max_samples)
+        # (time, images) of the batches of the last `window` seconds
+        self.recent = deque()
+
+    def add_batch(self, reqs, images):
+        now = time.time()
+        with self.lock:
+            self.batches += 1
+            self.requests += len(reqs)
+            self.images += images
+            self.batch_sizes.append(images)
+            self.latencies.extend(now - r.arrival for r in reqs)
+            self.recent.append((now, images))
+            while self.recent and self.recent[0][0] < now - self.window:
+                self.recent.popleft()
+
+    def add_error(self):
+        with self.lock:
+            self.errors += 1
+
+    def snapshot(self):
+        with self.lock:
+            now = time.time()
+            lat = np.asarray(self.latencies) * 1000
+            span = min(self.window, now - self.start)
+            r = {'uptime_s': now - self.start, 'requests': self.requests, 'images': self.images,
+                 'batches': self.batches, 'errors': self.errors, 'swaps': self.swaps,
+                 'mean_batch': float(np.mean(self.batch_sizes)) if self.batch_sizes else 0.0,
+                 'images_per_s': sum(n for t, n in self.recent if t >= now - span) / max(span, 1e-9)}
+            for p in [50, 90, 99]:
+                r['latency_p{}_ms'.format(p)] = float(np.percentile(lat, p)) if len(lat) else 0.0
+            return r
+
+
+class BatchingServer(object):
+    """
+    Queue the requests and run them in batches on the replicas of the
+    served model, which can be swapped while serving.
+    """
+    def __init__(self, model, mean=None, max_batch=64, max_latency=0.005, topk=5):
+        """
+        Args:
+            model (ServedModel): the model served first.
+            mean: per-pixel mean subtracted from the images, or None.
+            max_batch (int): images of a batch.
+            max_latency (float): seconds the oldest request of a batch waits for others.
+        """
+        self.model = model
+        self.mean = mean
+        self.max_batch = max_batch
+        self.max_latency = max_latency
+        self.topk = topk
+        self.queue = Queue()
+        self.metrics = Metrics()
+        self.cond = threading.Condition()
+        self.swap_lock = threading.Lock()
+        self.threads = [threading.Thread(target=self._replica_loop, args=(k,))
+                        for k in range(len(model.predictors))]
+        for t in self.threads:
+            t.daemon = True
+            t.start()
+
+    def predict(self, images):
+        images = np.asarray(images)
+        if images.ndim == 3:
+            images = images[np.newaxis]
+        shape = self.model.input_shape
+        if images.shape[1:] != shape:
+            raise ValueError('images of shape {} expected, got {}'.format(
+                list(shape), list(images.shape[1:])))
+        images = images.astype('float32')
+        if self.mean is not None:
+            images = images - self.mean
+        req = Request(images.astype(self.model.input_dtype))
+        self.queue.put(req)
+        req.done.wait()
+        if req.error is not None:
+            raise RuntimeError(req.error)
+        return self._top(req.logits), req.step
+
+    def _top(self, logits):
+        e = np.exp(logits - logits.max(axis=1, keepdims=True))
+        prob = e / e.sum(axis=1, keepdims=True)
+        classes = np.argsort(-prob, axis=1)[:, :self.topk]
+        return classes, prob[np.arange(len(prob))[:, None], classes]
+
+    # the requests of the next batch, waiting at most max_latency after the first one,
+    #   and the request taken from the queue which did not fit in, if any
+    def _next_batch(self, carry):
+        reqs = [carry] if carry is not None else [self.queue.get()]
+        if reqs[0] is STOP:
+            return None, None
+        n = len(reqs[0].images)
+        deadline = reqs[0].arrival + self.max_latency
+        while n < self.max_batch:
+            try:
+                r = self.queue.get(timeout=max(0, deadline - time.time()))
+            except Empty:
+                break
+            if r is STOP:
+                self.queue.put(STOP)
+                break
+            if n + len(r.images) > self.max_batch:
+                # run it in the next batch
+                return reqs, r
+            reqs.append(r)
+            n += len(r.images)
+        return reqs, None
+
+    def _replica_loop(self, k):
+        carry = None
+        while True:
+            reqs, carry = self._next_batch(carry)
+            if reqs is None:
+                break
+            with self.cond:
+                model = self.model
+                model.users += 1
+            try:
+                images = np.concatenate([r.images for r in reqs])
+                logits = model.predictors[k](images)[0]
+                start = 0
+                for r in reqs:
+                    r.logits = logits[start:start + len(r.images)]
+                    r.step = model.step
+                    start += len(r.images)
+                self.metrics.add_batch(reqs, len(images))
+            except Exception as e:
+                self.metrics.add_error()
+                for r in reqs:
+                    r.error = '{}: {}'.format(type(e).__name__, e)
+            finally:
+                with self.cond:
+                    model.users -= 1
+                    self.cond.notify_all()
+            for r in reqs:
+                r.done.set()
+
+    def swap(self, model):
+        """ Serve `model`; close the old one when its running batches are done. """
+        if len(model.predictors) != len(self.model.predictors):
+            raise ValueError('the new model has {} replicas instead of {}'.format(
+                len(model.predictors), len(self.model.predictors)))
+        with self.cond:
+            old, self.model = self.model, model
+            while old.users > 0:
+                self.cond.wait()
+        old.close()
+        with self.metrics.lock:
+            self.metrics.swaps += 1
+        logger.info('[inferenceServer] serving {} (step {})'.format(model.cfg, model.step))
+
+    def stop(self):
+        for _ in self.threads:
+            self.queue.put(STOP)
+        for t in self.threads:
+            t.join()
+        self.model.close()
+
+
+# load the cfg and swap it in, unless a newer model is served
+def reload_model(server, cfg_path, model_args):
+    with server.swap_lock:
+        if os.path.abspath(cfg_path) == server.model.cfg:
+            return server.model
+        server.swap(ServedModel(cfg_path, len(server.model.predictors), **model_args))
+        return server.model
+
+def watch_dir(server, cfg_dir, model_args, poll=10):
+    while True:
+        time.sleep(poll)
+        cfg = newest_cfg(cfg_dir)
+        if cfg is None or cfg_step(cfg) <= server.model.step:
+            continue
+        try:
+            reload_model(server, cfg, model_args)
+        except Exception as e:
+            logger.warn('[inferenceServer] failed to load {}: {}'.format(cfg, e))
+
+
+def make_handler(server, model_args, watch=None):
+    class Handler(BaseHTTPRequestHandler):
+        def _reply(self, code, obj):
+            body = json.dumps(obj).encode('utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _body(self):
+            return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+        def do_GET(self):
+            if self.path == '/metrics':
+                m = server.metrics.snapshot()
+                m.update({'queue': server.queue.qsize(), 'cfg': server.model.cfg,
+                          'step': server.model.step, 'replicas': len(server.model.predictors)})
+                self._reply(200, m)
+            elif self.path == '/health':
+                self._reply(200, {'status': 'ok', 'step': server.model.step})
+            else:
+                self._reply(404, {'error': 'unknown path {}'.format(self.path)})
+
+        def do_POST(self):
+            try:
+                if self.path == '/predict':
+                    body = self._body()
+                    if 'json' in (self.headers.get('Content-Type') or ''):
+                        images = np.asarray(json.loads(body.decode('utf-8'))['images'])
+                    else:
+                        images = np.load(io.BytesIO(body), allow_pickle=False)
+                    (classes, scores), step = server.predict(images)
+                    self._reply(200, {'classes': classes.tolist(), 'scores': scores.tolist(),
+                                      'step': step})
+                elif self.path == '/reload':
+                    body = self._body()
+                    cfg = json.loads(body.decode('utf-8')).get('cfg') if body else None
+                    cfg = cfg or (newest_cfg(watch) if watch else None)
+                    if cfg is None:
+                        self._reply(400, {'error': 'no cfg to load'})
+                        return
+                    model = reload_model(server, cfg, model_args)
+                    self._reply(200, {'cfg': model.cfg, 'step': model.step})
+                else:
+                    self._reply(404, {'error': 'unknown path {}'.format(self.path)})
+            except ValueError as e:
+                self._reply(400, {'error': str(e)})
+            except Exception as e:
+                self._reply(500, {'error': '{}: {}'.format(type(e).__name__, e)})
+
+        # the client address of a Unix socket is empty
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class ThreadingUnixServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cfg', help='cfg of the compressed model, default: the newest of --watch')
+    parser.add_argument('--dataset', help='the per-pixel mean of the cifar and svhn models',
+                        choices=['cifar10', 'cifar100', 'svhn', 'imagenet'], required=True)
+    parser.add_argument('--watch', help='serve the newest compressed_model_{step}.cfg of this dir')
+    parser.add_argument('--poll', help='seconds between the checks of --watch', type=float, default=10)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8500)
+    parser.add_argument('--unix', help='listen on this Unix socket instead of --port')
+    parser.add_argument('--replicas', help='sessions running batches in parallel', type=int, default=1)
+    parser.add_argument('--threads', help='intra-op threads of each replica, default: cores / replicas',
+                        type=int)
+    parser.add_argument('--max_batch', type=int, default=64)
+    parser.add_argument('--max_latency', help='ms the first request of a batch waits for others',
+                        type=float, default=5)
+    parser.add_argument('--topk', type=int, default=5)
+    parser.add_argument('--data_format', help='specify NCHW or NHWC, default: NCHW with GPU, NHWC without',
+                        type=str, choices=['NCHW', 'NHWC'])
+    parser.add_argument('--graph_cache', help='directory to cache the inference graphs')
+    parser.add_argument('--gpu', help='comma separated list of GPU(s) to use.')
+    args = parser.parse_args()
+    os.environ['CUDA_VISIBLE_DEVICES'] = args.gpu or ''
+
+    cfg = args.cfg or (newest_cfg(args.watch) if args.watch else None)
+    if cfg is None:
+        parser.error('no cfg to serve, give --cfg or --watch')
+    model_args = dict(threads=args.threads or max(1, multiprocessing.cpu_count() // args.replicas),
+                      data_format=args.data_format or default_data_format(),
+                      graph_cache=args.graph_cache)
+    server = BatchingServer(ServedModel(cfg, args.replicas, **model_args),
+                            mean=per_pixel_mean(args.dataset), max_batch=args.max_batch,
+                            max_latency=args.max_latency / 1000.0, topk=args.topk)
+    if args.watch:
+        t = threading.Thread(target=watch_dir, args=(server, args.watch, model_args, args.poll))
+        t.daemon = True
+        t.start()
+
+    handler = make_handler(server, model_args, args.watch)
+    if args.unix:
+        if os.path.exists(args.unix):
+            os.remove(args.unix)
+        httpd = ThreadingUnixServer(args.unix, handler)
+        logger.info('[inferenceServer] listening on {}'.format(args.unix))
+    else:
+        httpd = ThreadingHTTPServer((args.host, args.port), handler)
+        logger.info('[inferenceServer] listening on {}:{}'.format(args.host, args.port))
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    httpd.server_close()
+    server.stop()
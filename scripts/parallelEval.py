@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+# File: parallelEval.py
+
+import multiprocessing
+import numpy as np
+from six.moves.queue import Empty
+
+import sys
+sys.path.append('../../tensorpack')
+from tensorpack import *
+from benchmarkUtils import session_config, POLL_SECONDS
+
+"""
+Evaluate a model with several processes, each on its own shard of the test
+set, with its own predictor and a limited number of threads.
+
+The shards are taken before the images are decoded and augmented: the file
+list of dataset.ILSVRC12 is split, the in-memory datasets (Cifar10, Cifar100,
+SVHNDigit) are read in the same order by all the processes and every
+`size`-th image is kept. The workers return the number of wrong predictions
+and of images of each output, e.g. incorrect_vector or wrong-top1 and
+wrong-top5, and the counts are summed, so the errors are exactly those of a
+single predictor on the whole test set.
+
+The workers are forked: the parent must not have started the CUDA runtime,
+which default_data_format() of EpsilonResnetBase.py does not. A worker killed,
+e.g. by the OOM killer, makes the evaluation fail instead of waiting for it.
+"""
+
+# seed shared by the processes to read the in-memory datasets in the same order
+SHARD_SEED = 2017
+
+
+class EvalShard(ProxyDataFlow):
+    """
+    Every `size`-th datapoint of ds starting from the `rank`-th, without
+    dropping the remainder. ds.rng is re-seeded, so that a shuffled dataset
+    has the same order in all the processes.
+    """
+    def __init__(self, ds, rank, size):
+        super(EvalShard, self).__init__(ds)
+        self.rank = rank
+        self.world_size = size
+
+    def reset_state(self):
+        super(EvalShard, self).reset_state()
+        if hasattr(self.ds, 'rng'):
+            self.ds.rng = np.random.RandomState(SHARD_SEED)
+
+    def size(self):
+        return len(range(self.rank, self.ds.size(), self.world_size))
+
+    def get_data(self):
+        for k, dp in enumerate(self.ds.get_data()):
+            if k % self.world_size == self.rank:
+                yield dp
+
+# the shard (rank, size) of a test dataset, before the augmentation
+def shard_dataset(ds, rank, size):
+    if hasattr(ds, 'imglist'):
+        # ILSVRC12 reads the images in get_data, skip the others
+        ds.imglist = ds.imglist[rank::size]
+        return ds
+    return EvalShard(ds, rank, size)
+
+# the number of wrong predictions and of images of each 0/1 output of pred
+def count_errors(pred):
+    counts = None
+    for o in pred.get_result():
+        if counts is None:
+            counts = [[0, 0] for _ in o]
+        for c, v in zip(counts, o):
+            c[0] += int(v.sum())
+            c[1] += int(v.shape[0])
+    return counts or []
+
+def ratio(count):
+    return float(count[0]) / max(count[1], 1)
+
+def _worker(fn, rank, size, threads, queue):
+    try:
+        queue.put((rank, fn((rank, size), session_config(threads))))
+    except Exception as e:
+        queue.put((rank, '{}: {}'.format(type(e).__name__, e)))
+
+def parallel_counts(fn, nr_proc, threads=None):
+    """
+    Args:
+        fn: function(shard, session_config) -> counts of count_errors on
+            the shard (rank, size) of the test set.
+        nr_proc (int): number of processes.
+        threads (int): intra-op threads of each process, default: cores / nr_proc.
+    Returns:
+        the counts summed over the shards.
+    """
+    threads = threads or max(1, multiprocessing.cpu_count() // nr_proc)
+    queue = multiprocessing.Queue()
+    procs = [multiprocessing.Process(target=_worker, args=(fn, rank, nr_proc, threads, queue))
+             for rank in range(nr_proc)]
+    for p in procs:
+        p.start()
+    results = {}
+    while len(results) < nr_proc:
+        try:
+            rank, r = queue.get(timeout=POLL_SECONDS)
+            results[rank] = r
+        except Empty:
+            # a worker which exited normally has put its result
+            for rank, p in enumerate(procs):
+                if rank not in results and not p.is_alive() and p.exitcode != 0:
+                    results[rank] = 'worker {} killed: {}'.format(rank, p.exitcode)
+    for p in procs:
+        p.join()
+    errors = [r for r in results.values() if isinstance(r, str)]
+    if errors:
+        raise RuntimeError('parallel evaluation failed: {}'.format('; '.join(errors)))
+    counts = [r for r in results.values() if len(r)]
+    if not counts:
+        raise RuntimeError('parallel evaluation failed: no image in the {} shards'.format(nr_proc))
+    return [[sum(c[k][i] for c in counts) for i in range(2)] for k in range(len(counts[0]))]
+
+
+def add_arguments(parser):
+    parser.add_argument('--eval_procs', help='evaluate with this many processes, each on '
+                        'a shard of the test set', type=int, default=1)
+    parser.add_argument('--eval_threads', help='intra-op threads of each process of '
+                        '--eval_procs, default: cores / processes', type=int)
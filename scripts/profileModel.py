@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+# File: profileModel.py
+
+import argparse
+import json
+import os
+import re
+import numpy as np
+
+import sys
+sys.path.append('../../tensorpack')
+from tensorpack import *
+
+from compressModel import read_cfg, get_discarded_block, cfg as depth_cfg
+from EpsilonResnetBase import default_data_format
+from graphCache import load_inference_graph
+from evalModels import get_model
+from benchmarkUtils import session_config, fake_feed, print_table
+
+import tensorflow as tf
+
+"""
+The cost of every block of an epsilon-ResNet checkpoint or of a compressed
+model, and what the compression saves.
+
+The predict-only graph of the model is built and, for every block,
+res{g}.{k} of cifar and svhn or group{g}/block{k} of imagenet, and for the
+rest of the network (`other`: conv0, bnlast, linear, ...):
+  - mflops: the multiply-adds of Conv2D and MatMul, x2, per image;
+  - params: the number of trainable parameters;
+  - activation_mb: the size of the feature maps materialized in the block,
+    the outputs of its Conv2D, batch norm, Relu, Add and pooling ops, per
+    image; Identity aliases and the intermediates of the batch norms are
+    not counted;
+  - cpu_ms: the CPU time of its ops at --batch, from the step stats of
+    --steps traced runs, averaged.
+The variables are initialized rather than restored, the costs do not depend
+on their values.
+
+The totals are given before and after the compression. For a checkpoint
+train_log/x/model-{step}, the blocks discarded at that step are read from the
+log.log next to it, as compressModel.py does, or given by --discarded, and
+`after` is the total of the kept blocks. For a .cfg, `before` is the model of
+the same depth without any discarded block or pruned channel.
+
+Usage:
+    python profileModel.py --model train_log/cifarEpsilonResnet/model-1000 --dataset cifar10 -n 18 -e 2.5
+    python profileModel.py --model x/compressed_model_550000.cfg --dataset imagenet --output profile.json
+"""
+
+re_BLOCK = '^(res\d+\.\d+|group\d+/block\d+)/'
+COST_KEYS = ['mflops', 'params', 'activation_mb', 'cpu_ms']
+# the ops whose outputs are the feature maps kept in memory. The batch norm of
+#   tf.nn.batch_normalization ends with an Add, its Mul is an intermediate
+ACTIVATION_OPS = ['Conv2D', 'FusedBatchNorm', 'FusedBatchNormV2', 'Relu', 'Add', 'AddV2',
+                  'MaxPool', 'AvgPool']
+
+
+def block_of(name):
+    rst = re.match(re_BLOCK, name)
+    return rst.group(1) if rst else 'other'
+
+# the multiply-adds x2 of an op for one image, 0 for the ops other than
+#   Conv2D and MatMul
+def op_flops(op):
+    if op.type == 'Conv2D':
+        out = op.outputs[0].get_shape().as_list()[1:]
+        kernel = op.inputs[1].get_shape().as_list()
+        return 2 * int(np.prod(out)) * kernel[0] * kernel[1] * kernel[2]
+    if op.type == 'MatMul':
+        w = op.inputs[1].get_shape().as_list()
+        return 2 * w[0] * w[1]
+    return 0
+
+# the bytes of the feature maps of an op for one image, 0 for the ops other
+#   than ACTIVATION_OPS
+def op_activation_bytes(op):
+    if op.type not in ACTIVATION_OPS:
+        return 0
+    # the first output, FusedBatchNorm also outputs the batch statistics
+    t = op.outputs[0]
+    shape = t.get_shape()
+    if shape.ndims != 4 or not shape[1:].is_fully_defined():
+        return 0
+    return int(np.prod(shape.as_list()[1:])) * t.dtype.size
+
+# the CPU time of the ops in micro seconds, summed by block, of `steps` traced runs
+def traced_micros(sess, fetches, feed_dict, steps):
+    micros = {}
+    options = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
+    sess.run(fetches, feed_dict=feed_dict)
+    for _ in range(steps):
+        meta = tf.RunMetadata()
+        sess.run(fetches, feed_dict=feed_dict, options=options, run_metadata=meta)
+        for dev in meta.step_stats.dev_stats:
+            for node in dev.node_stats:
+                blk = block_of(node.node_name)
+                micros[blk] = micros.get(blk, 0) + node.all_end_rel_micros
+    return micros
+
+def profile_graph(graph, model, num_class, args):
+    """
+    Returns:
+        list: a dict of the costs of each block, in the order of the graph,
+        and of `other`.
+    """
+    costs = {}
+    order = []
+    def row(blk):
+        if blk not in costs:
+            costs[blk] = dict((k, 0) for k in COST_KEYS)
+            costs[blk]['block'] = blk
+            order.append(blk)
+        return costs[blk]
+    with graph.as_default():
+        for op in graph.get_operations():
+            r = row(block_of(op.name))
+            r['mflops'] += op_flops(op) / 1e6
+            r['activation_mb'] += op_activation_bytes(op) / 1024.0 / 1024.0
+        for v in tf.trainable_variables():
+            row(block_of(v.op.name))['params'] += int(np.prod(v.get_shape().as_list()))
+        feed = fake_feed(model, args.batch, num_class)
+        feed_dict = dict((graph.get_tensor_by_name(k + ':0'), v) for k, v in feed.items())
+        with tf.Session(config=session_config(args.threads)) as sess:
+            sess.run(tf.global_variables_initializer())
+            micros = traced_micros(sess, graph.get_tensor_by_name('output:0'), feed_dict, args.steps)
+    for blk, m in micros.items():
+        if blk in costs:
+            costs[blk]['cpu_ms'] = m / 1000.0 / args.steps
+    # `other` last
+    order.sort(key=lambda b: b == 'other')
+    return [costs[b] for b in order]
+
+def totals(rows):
+    return dict((k, sum(r[k] for r in rows)) for k in COST_KEYS)
+
+# the uncompressed model of the same depth as a cfg
+def uncompressed_model(cfg_path, args):
+    n, _, _, _ = read_cfg(cfg_path)
+    data_format = args.data_format
+    if args.dataset == 'imagenet':
+        import imagenetCompressedResnet
+        structure, discard_first_block = list(depth_cfg[n]), [0] * 4
+        model = imagenetCompressedResnet.Model(data_format, n, structure, discard_first_block,
+                                               predict_only=True, channels={})
+        return model, 'imagenetCompressedResnet', dict(
+            depth=n, structure=structure, discard_first_block=discard_first_block,
+            num_class=1000, data_format=data_format, channels=None)
+    import cifarCompressedResnet
+    num_class = 100 if args.dataset == 'cifar100' else 10
+    structure, discard_first_block = [n] * 3, [0] * 3
+    model = cifarCompressedResnet.Model(num_class, structure, discard_first_block, n,
+                                        data_format=data_format, predict_only=True)
+    return model, 'cifarCompressedResnet', dict(
+        structure=structure, discard_first_block=discard_first_block,
+        num_class=num_class, data_format=data_format, channels=None)
+
+# the blocks discarded at the step of a checkpoint, from the log.log next to it
+def discarded_blocks(model_path):
+    log_path = os.path.join(os.path.dirname(model_path), 'log.log')
+    rst = re.search('model-(\d+)$', model_path)
+    if not rst or not os.path.exists(log_path):
+        logger.warn('[profileModel] no log.log for {}, no block is discarded'.format(model_path))
+        return []
+    return get_discarded_block(log_path, int(rst.group(1)))[2]
+
+def profile(args):
+    num_class = {'cifar10': 10, 'cifar100': 100, 'svhn': 10, 'imagenet': 1000}[args.dataset]
+    model, script, arch, _ = get_model(args.model, args)
+    graph = load_inference_graph(model, script, args.graph_cache, **arch)
+    rows = profile_graph(graph, model, num_class, args)
+    report = {'model': os.path.abspath(args.model), 'dataset': args.dataset,
+              'batch': args.batch, 'data_format': args.data_format, 'blocks': rows}
+    if args.model.endswith('.cfg'):
+        model, script, arch = uncompressed_model(args.model, args)
+        graph = load_inference_graph(model, script, args.graph_cache, **arch)
+        report['before'] = totals(profile_graph(graph, model, num_class, args))
+        report['after'] = totals(rows)
+    else:
+        discarded = args.discarded.split(',') if args.discarded is not None \
+            else discarded_blocks(args.model)
+        for r in rows:
+            r['discarded'] = r['block'] in discarded
+        report['before'] = totals(rows)
+        report['after'] = totals([r for r in rows if not r['discarded']])
+    report['saved'] = dict((k, 1.0 - float(report['after'][k]) / report['before'][k])
+                           for k in COST_KEYS if report['before'][k])
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', help='checkpoint of an epsilon-ResNet, train_log/x/model-{step}, '
+                        'or .cfg of a compressed model', required=True)
+    parser.add_argument('--dataset', help='the dataset of the model', default='cifar10',
+                        choices=['cifar10', 'cifar100', 'svhn', 'imagenet'])
+    parser.add_argument('-n', '--num_units', help='units per stage of the cifar and svhn checkpoints',
+                        type=int, default=18)
+    parser.add_argument('-d', '--depth', help='depth of the imagenet checkpoints',
+                        type=int, default=50, choices=[18, 34, 50, 101, 152])
+    parser.add_argument('-e', '--epsilon', help='epsilon of the checkpoints', type=float, default=2.5)
+    parser.add_argument('--discarded', help='comma separated discarded blocks of the checkpoint, '
+                        'default: from its log.log')
+    parser.add_argument('--batch', help='batch size of the traced runs', type=int, default=1)
+    parser.add_argument('--steps', help='traced runs', type=int, default=10)
+    parser.add_argument('--data_format', help='specify NCHW or NHWC, default: NHWC',
+                        type=str, choices=['NCHW', 'NHWC'])
+    parser.add_argument('--threads', help='intra-op threads, default: all cores', type=int)
+    parser.add_argument('--graph_cache', help='directory to cache the inference graphs')
+    parser.add_argument('--output', help='save the report as json')
+    args = parser.parse_args()
+    # the latency is measured on CPU
+    os.environ['CUDA_VISIBLE_DEVICES'] = ''
+    args.data_format = args.data_format or default_data_format()
+
+    report = profile(args)
+    keys = ['block'] + COST_KEYS + ([] if args.model.endswith('.cfg') else ['discarded'])
+    print_table(report['blocks'], keys)
+    rows = [dict(report[k], block=k) for k in ['before', 'after']]
+    rows.append(dict(report['saved'], block='saved'))
+    print_table(rows, ['block'] + COST_KEYS)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
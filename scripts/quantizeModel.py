@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+# File: quantizeModel.py
+
+import argparse
+import json
+import os
+import time
+import numpy as np
+
+import sys
+sys.path.append('../../tensorpack')
+from tensorpack import *
+
+from EpsilonResnetBase import default_data_format
+from graphCache import errors_from_logits
+from exportModel import freeze, simplify, const_value, add_const, load_frozen, fake_images, \
+    INPUT, OUTPUTS
+from evalModels import get_script_data, CIFAR_OUTPUTS, IMAGENET_OUTPUTS
+from benchmarkUtils import session_config, time_steps, percentile, run_isolated, print_table
+
+import tensorflow as tf
+
+"""
+Post-training INT8 quantization of a compressed model.
+
+The model is frozen and simplified as by exportModel.py, so the batch norms
+are folded into the convolutions when the graph transforms are available.
+Then:
+  - the kernels of every Conv2D and of the fully-connected layer are
+    quantized to int8 with one scale per output channel, max|W| / 127, and
+    stored as int8 constants followed by a Cast and a Mul by the scales;
+  - the range of the activation entering each of them is calibrated on
+    --calib_batches batches of get_data('train') of the training script, as
+    the mean of the per-batch min and max, and the activation is quantized to
+    8 bits with FakeQuantWithMinMaxArgs.
+The int8 graph runs on CPU with the standard kernels and gives the accuracy
+of int8 inference; TensorFlow has no per-channel int8 convolution on CPU, so
+the kernels are dequantized at run time and the latency is not expected to
+improve, only the size of the model. The report compares the errors on the
+test set, the size, the latency at batch 1 and the throughput at --batch of
+the fp32 and the int8 graphs.
+
+Usage:
+    python quantizeModel.py --cfg train_log/x/compressed/compressed_model_1000.cfg --dataset cifar10
+    python quantizeModel.py --cfg x/compressed_model_550000.cfg --dataset imagenet --data /path/to/ilsvrc12
+"""
+
+QUANTIZED_OPS = ['Conv2D', 'MatMul']
+
+
+def _tensor_name(ref):
+    return ref if ':' in ref else ref + ':0'
+
+def _write_graph(graph_def, path):
+    with open(path, 'wb') as f:
+        f.write(graph_def.SerializeToString())
+
+# the Conv2D and MatMul nodes with constant weights
+def quantized_nodes(graph_def):
+    nodes = dict((n.name, n) for n in graph_def.node)
+    return [n for n in graph_def.node
+            if n.op in QUANTIZED_OPS and const_value(nodes, n.input[1]) is not None]
+
+def calibrate(graph_def, ds, batches, threads=None):
+    """
+    Returns:
+        dict: node name -> [min, max] of its input activation, the means of
+        the per-batch min and max over `batches` batches of ds.
+    """
+    names = [n.name for n in quantized_nodes(graph_def)]
+    refs = [_tensor_name(n.input[0]) for n in quantized_nodes(graph_def)]
+    graph = tf.Graph()
+    with graph.as_default():
+        tf.import_graph_def(graph_def, name='')
+        # only the min and max of each activation are fetched
+        ranges = [tf.stack([tf.reduce_min(t), tf.reduce_max(t)])
+                  for t in [graph.get_tensor_by_name(r) for r in refs]]
+    x = graph.get_tensor_by_name(INPUT + ':0')
+    sums = np.zeros((len(names), 2))
+    count = 0
+    ds.reset_state()
+    with tf.Session(graph=graph, config=session_config(threads)) as sess:
+        for dp in ds.get_data():
+            if count >= batches:
+                break
+            sums += sess.run(ranges, feed_dict={x: dp[0]})
+            count += 1
+    logger.info('[quantizeModel] calibrated {} activations on {} batches'.format(len(names), count))
+    return dict((name, list(s / max(count, 1))) for name, s in zip(names, sums))
+
+def _add_node(graph_def, op, name, inputs, **attrs):
+    node = graph_def.node.add()
+    node.op = op
+    node.name = name
+    node.input.extend(inputs)
+    for k, v in attrs.items():
+        if isinstance(v, tf.DType):
+            node.attr[k].type = v.as_datatype_enum
+        elif isinstance(v, bool):
+            node.attr[k].b = v
+        elif isinstance(v, int):
+            node.attr[k].i = v
+        else:
+            node.attr[k].f = v
+    return name
+
+# int8 weights with one scale per output channel, the last axis of the
+#   HWIO kernels and of the [in, out] matrices
+def quantize_weights(w):
+    scale = np.abs(w).max(axis=tuple(range(w.ndim - 1))) / 127.0
+    scale[scale == 0] = 1.0
+    q = np.clip(np.round(w / scale), -127, 127).astype(np.int8)
+    return q, scale.astype(np.float32)
+
+def quantize(graph_def, ranges):
+    """
+    Returns:
+        the graph_def with int8 weights and 8-bit activations, see the module doc.
+    """
+    graph_def = tf.GraphDef.FromString(graph_def.SerializeToString())
+    nodes = dict((n.name, n) for n in graph_def.node)
+    for node in quantized_nodes(graph_def):
+        q, scale = quantize_weights(const_value(nodes, node.input[1]))
+        w = _add_node(graph_def, 'Cast', node.name + '/W_int8/cast',
+                      [add_const(graph_def, node.name + '/W_int8', q)],
+                      SrcT=tf.int8, DstT=tf.float32)
+        node.input[1] = _add_node(graph_def, 'Mul', node.name + '/W_int8/dequantize',
+                                  [w, add_const(graph_def, node.name + '/W_scale', scale)],
+                                  T=tf.float32)
+        lo, hi = ranges[node.name]
+        # the range must contain 0
+        node.input[0] = _add_node(graph_def, 'FakeQuantWithMinMaxArgs', node.name + '/act_int8',
+                                  [node.input[0]], min=float(min(lo, 0.0)), max=float(max(hi, 0.0)),
+                                  num_bits=8, narrow_range=False)
+    return tf.graph_util.extract_sub_graph(graph_def, OUTPUTS)
+
+# freeze the fp32 model, calibrate and write the int8 one
+def export_int8(args, fp32_path):
+    fp32, _ = simplify(freeze(args.cfg, args.data_format, args.graph_cache))
+    _write_graph(fp32, fp32_path)
+    start = time.time()
+    ranges = calibrate(fp32, get_script_data(args, train=True), args.calib_batches, args.threads)
+    _write_graph(quantize(fp32, ranges), args.out)
+    info = {'cfg': os.path.abspath(args.cfg), 'calib_batches': args.calib_batches,
+            'calib_seconds': time.time() - start, 'ranges': ranges}
+    with open(os.path.splitext(args.out)[0] + '.json', 'w') as f:
+        json.dump(info, f, indent=2)
+    logger.info('[quantizeModel] int8 model written to {}'.format(args.out))
+    return info
+
+
+# the errors of a frozen graph on the test set
+def evaluate(path, args):
+    outputs = IMAGENET_OUTPUTS if args.dataset == 'imagenet' else CIFAR_OUTPUTS
+    topk = [1, 5] if args.dataset == 'imagenet' else [1]
+    sess, x, _ = load_frozen(path, args.threads)
+    logits = sess.graph.get_tensor_by_name(OUTPUTS[1] + ':0')
+    wrong = np.zeros(len(topk))
+    total = 0
+    ds = get_script_data(args)
+    ds.reset_state()
+    with sess:
+        for dp in ds.get_data():
+            v = sess.run(logits, feed_dict={x: dp[0]})
+            wrong += [errors_from_logits(v, dp[1], k).sum() for k in topk]
+            total += len(dp[1])
+    return dict((name, float(w) / max(total, 1)) for (_, name), w in zip(outputs, wrong))
+
+def benchmark(path, args):
+    r = evaluate(path, args) if not args.no_eval else {}
+    sess, x, y = load_frozen(path, args.threads)
+    with sess:
+        latency = time_steps(sess, y, {x: fake_images(x, 1)}, args.steps)
+        batch = time_steps(sess, y, {x: fake_images(x, args.batch)}, max(args.steps // 5, 3))
+    r.update({'size_mb': os.path.getsize(path) / 1024.0 / 1024.0,
+              'latency_ms_p50': percentile(latency, 50) * 1000,
+              'latency_ms_p90': percentile(latency, 90) * 1000,
+              'images_per_s': args.batch / np.mean(batch)})
+    return r
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cfg', help='cfg of the compressed model', required=True)
+    parser.add_argument('--dataset', help='calibration and test data', default='cifar10',
+                        choices=['cifar10', 'cifar100', 'svhn', 'imagenet'])
+    parser.add_argument('--data', help='ILSVRC dataset dir')
+    parser.add_argument('--out', help='the int8 graph, default: the cfg with .int8.pb')
+    parser.add_argument('--calib_batches', help='batches of the training data to calibrate '
+                        'the activation ranges', type=int, default=200)
+    parser.add_argument('--data_format', help='specify NCHW or NHWC, default: NCHW with GPU, NHWC without',
+                        type=str, choices=['NCHW', 'NHWC'])
+    parser.add_argument('--graph_cache', help='directory to cache the inference graphs')
+    parser.add_argument('--batch', help='batch size of the data and of the throughput',
+                        type=int, default=128)
+    parser.add_argument('--steps', help='runs at batch 1', type=int, default=50)
+    parser.add_argument('--threads', help='intra-op threads, default: all cores', type=int)
+    parser.add_argument('--no_eval', help='skip the errors on the test set', action='store_true')
+    parser.add_argument('--gpu', help='comma separated list of GPU(s) to use.')
+    parser.add_argument('--output', help='save the report as json')
+    args = parser.parse_args()
+    # the int8 model is meant for CPU
+    os.environ['CUDA_VISIBLE_DEVICES'] = args.gpu or ''
+    args.data_format = args.data_format or default_data_format()
+    prefix = args.cfg[:-len('.cfg')]
+    args.out = args.out or prefix + '.int8.pb'
+    fp32_path = prefix + '.pb'
+
+    # TensorFlow can't fork once a session exists: no session in this process
+    info = run_isolated(export_int8, args, fp32_path)
+    if 'failure' in info:
+        logger.error('[quantizeModel] quantization failed: {}'.format(info['failure']))
+        sys.exit(1)
+
+    rows = []
+    for name, path in [('fp32', fp32_path), ('int8', args.out)]:
+        r = run_isolated(benchmark, path, args)
+        r['model'] = name
+        rows.append(r)
+    errors = [name for _, name in (IMAGENET_OUTPUTS if args.dataset == 'imagenet' else CIFAR_OUTPUTS)]
+    keys = ['model'] + ([] if args.no_eval else errors) + \
+        ['size_mb', 'latency_ms_p50', 'latency_ms_p90', 'images_per_s', 'peak_rss_mb', 'failure']
+    print_table(rows, keys)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(rows, f, indent=2)
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+# File: sequentialEval.py
+
+import math
+
+import sys
+sys.path.append('../../tensorpack')
+from tensorpack import *
+from tensorpack.utils.stats import RatioCounter
+
+"""
+Evaluate a model on a part of the test set, as long as needed to know its
+error well enough.
+
+sequential_eval() streams the batches of a shuffled test set and keeps a Wilson
+score interval on the error. It stops when the interval is narrower than
+`width`, or when its lower bound is above `best`, the error of the best
+candidate so far, i.e. the model is clearly worse. The interval is checked
+after every batch, so the confidence holds for each check, not for the whole
+sequence; use a higher confidence, e.g. 0.99, when many candidates are ranked.
+
+The dataflow must be shuffled: dataset.Cifar10, Cifar100 and SVHNDigit are by
+default, the ILSVRC12 val set is shuffled by the scripts with --sequential.
+"""
+
+# the z value of a two-sided confidence, by bisection on erf
+def z_value(confidence):
+    lo, hi = 0.0, 10.0
+    for _ in range(100):
+        mid = (lo + hi) / 2
+        if math.erf(mid / math.sqrt(2)) < confidence:
+            lo = mid
+        else:
+            hi = mid
+    return (lo + hi) / 2
+
+# the Wilson score interval of the error rate of wrong / total
+def wilson_interval(wrong, total, z):
+    if total == 0:
+        return 0.0, 1.0
+    p = float(wrong) / total
+    denom = 1 + z * z / total
+    center = (p + z * z / (2 * total)) / denom
+    half = z * math.sqrt(p * (1 - p) / total + z * z / (4 * total * total)) / denom
+    return max(0.0, center - half), min(1.0, center + half)
+
+
+class SequentialError(object):
+    """ The error rate of the samples seen so far, with its confidence interval. """
+    def __init__(self, confidence=0.95):
+        self.z = z_value(confidence)
+        self.wrong = 0
+        self.total = 0
+
+    def feed(self, wrong, n):
+        self.wrong += int(wrong)
+        self.total += int(n)
+
+    @property
+    def error(self):
+        return float(self.wrong) / max(self.total, 1)
+
+    def interval(self):
+        return wilson_interval(self.wrong, self.total, self.z)
+
+    # the reason to stop, or None
+    def stop_reason(self, width, best=None, min_samples=0):
+        if self.total < min_samples:
+            return None
+        lo, hi = self.interval()
+        if best is not None and lo > best:
+            return 'worse than the best error {}'.format(best)
+        if hi - lo < width:
+            return 'interval narrower than {}'.format(width)
+        return None
+
+
+def sequential_eval(pred, names, width=0.005, best=None, confidence=0.95, min_samples=500):
+    """
+    Args:
+        pred: a dataset predictor whose outputs are 0/1 vectors, e.g. incorrect_vector.
+        names: the names of the outputs in the report. The first output
+            decides when to stop, the errors of the others are also reported.
+    Returns:
+        a dict of the errors, the interval of the first one and the samples used.
+    """
+    est = SequentialError(confidence)
+    others = [RatioCounter() for _ in names[1:]]
+    reason = 'end of the test set'
+    for o in pred.get_result():
+        est.feed(o[0].sum(), o[0].shape[0])
+        for c, v in zip(others, o[1:]):
+            c.feed(v.sum(), v.shape[0])
+        r = est.stop_reason(width, best, min_samples)
+        if r is not None:
+            reason = r
+            break
+    lo, hi = est.interval()
+    print("{}: {} ({:.0%} interval [{:.5f}, {:.5f}])".format(names[0], est.error, confidence, lo, hi))
+    for name, c in zip(names[1:], others):
+        print("{}: {}".format(name, c.ratio))
+    print("Samples used: {} ({})".format(est.total, reason))
+    result = dict((name, c.ratio) for name, c in zip(names[1:], others))
+    result.update({names[0]: est.error, 'interval': (lo, hi), 'samples': est.total,
+                   'reason': reason})
+    return result
+
+
+def add_arguments(parser):
+    parser.add_argument('--sequential', help='evaluate on shuffled batches until the error '
+                        'is known well enough', action='store_true')
+    parser.add_argument('--ci_width', help='with --sequential, stop when the confidence '
+                        'interval of the error is narrower than this', type=float, default=0.005)
+    parser.add_argument('--best_error', help='with --sequential, stop when the error is '
+                        'surely above this error of the best candidate', type=float)
+    parser.add_argument('--confidence', help='confidence of the interval with --sequential',
+                        type=float, default=0.95)
+
+# the arguments of sequential_eval from the command line, or None without --sequential
+def from_args(args):
+    if not args.sequential:
+        return None
+    return dict(width=args.ci_width, best=args.best_error, confidence=args.confidence)
@@ -16,8 +16,12 @@ from tensorpack.utils.stats import RatioCounter
 from tensorpack.tfutils.symbolic_functions import *
 from tensorpack.tfutils.summary import *
 
-from compressModel import read_cfg
+from compressModel import read_cfg, read_channels
+from graphCache import cached_dataset_predictor
+import sequentialEval
+import parallelEval
 from cifarCompressedResnet import Model
+from EpsilonResnetBase import default_data_format
 
 import tensorflow as tf
 from tensorflow.contrib.layers import variance_scaling_initializer
@@ -25,12 +29,21 @@ from tensorflow.contrib.layers import variance_scaling_initializer
 BATCH_SIZE = 128
 NUM_UNITS = None
 OUTDIR = ''
+GRAPH_CACHE = None
+DATA_FORMAT = 'NCHW'
+# the arguments of sequentialEval.sequential_eval with --sequential
+SEQUENTIAL = None
+# processes and threads of each process of the evaluation, see parallelEval.py
+EVAL_PROCS = 1
+EVAL_THREADS = None
 NUM_CLASS = 10
 
 structure = []
 discard_first_block = []
+# the pruned channels of the blocks, see compressModel.prune_channels
+block_channels = None
 
-def get_data(train_or_test):
+def get_data(train_or_test, shard=None):
     isTrain = train_or_test == 'train'
     pp_mean = dataset.SVHNDigit.get_per_pixel_mean()
     if isTrain:
@@ -39,6 +52,8 @@ def get_data(train_or_test):
         ds = RandomMixData([d1, d2])
     else:
         ds = dataset.SVHNDigit('test')
+    if shard is not None:
+        ds = parallelEval.shard_dataset(ds, *shard)
 
     if isTrain:
         augmentors = [
@@ -62,7 +77,7 @@ def get_data(train_or_test):
     return ds
 
 def get_config():
-    logger.set_logger_dir('train_log.' + out_dir)
+    logger.set_logger_dir('train_log.' + OUTDIR)
     dataset_train = get_data('train')
     dataset_test = get_data('test')
     MAX_EPOCH = 200
@@ -75,22 +90,35 @@ def get_config():
             ScheduledHyperParamSetter('learning_rate',
                 [(1, 0.1), (20, 0.01), (28, 0.001), (50, 0.0001)])
         ],
-        model=Model(NUM_CLASS, structure, discard_first_block, n=NUM_UNITS),
+        model=Model(NUM_CLASS, structure, discard_first_block, n=NUM_UNITS,
+                    data_format=DATA_FORMAT, channels=block_channels),
         max_epoch = MAX_EPOCH,
     )
 
 
+# the predictor of the test set, or of its shard (rank, size)
+def get_predictor(model_file, shard=None, config=None):
+    return cached_dataset_predictor(
+        Model(NUM_CLASS, structure, discard_first_block, NUM_UNITS, data_format=DATA_FORMAT,
+              predict_only=True, channels=block_channels),
+        model_file, get_data('test', shard), ['input', 'label'], ['incorrect_vector'],
+        cache_dir=GRAPH_CACHE, script='svhnCompressedResnet', session_config=config,
+        structure=structure, discard_first_block=discard_first_block,
+        num_class=NUM_CLASS, data_format=DATA_FORMAT, channels=block_channels)
+
 def eval_on_cifar(model_file):
     print('structure: {}'.format(structure))
-    ds = get_data('test')
-    pred_config = PredictConfig(
-        model=Model(
-            NUM_CLASS, structure, discard_first_block, NUM_UNITS),
-        session_init=get_model_loader(model_file),
-        input_names = ['input', 'label'],
-        output_names = ['incorrect_vector']
-    )
-    pred = SimpleDatasetPredictor(pred_config, ds)
+    if EVAL_PROCS > 1 and SEQUENTIAL is None:
+        counts = parallelEval.parallel_counts(
+            lambda shard, config: parallelEval.count_errors(get_predictor(model_file, shard, config)),
+            EVAL_PROCS, EVAL_THREADS)
+        print("Error: {}".format(parallelEval.ratio(counts[0])))
+        return
+    pred = get_predictor(model_file)
+    if SEQUENTIAL is not None:
+        # the test set of tensorpack is shuffled
+        sequentialEval.sequential_eval(pred, ['Error'], **SEQUENTIAL)
+        return
     acc = RatioCounter()
     for o in pred.get_result():
         batch_size = o[0].shape[0]
@@ -99,12 +127,17 @@ def eval_on_cifar(model_file):
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
-    parser.add_argument('--gpu', help='comma separated list of GPU(s) to use.', required = True)
+    parser.add_argument('--gpu', help='comma separated list of GPU(s) to use.')
     parser.add_argument('-n', '--num_units',
             help='number of units in each stage',
             type=int, default=18)
     parser.add_argument('-o', '--output', help='output', type=str)
     parser.add_argument('--cfg', help = 'config of compressed model', required = True)
+    parser.add_argument('--data_format', help='specify NCHW or NHWC, default: NCHW with GPU, NHWC without',
+                        type=str, choices=['NCHW', 'NHWC'])
+    parser.add_argument('--graph_cache', help='directory to cache the inference graphs of evaluation')
+    sequentialEval.add_arguments(parser)
+    parallelEval.add_arguments(parser)
 
     args = parser.parse_args()
     NUM_UNITS = args.num_units
@@ -112,9 +145,15 @@ if __name__ == '__main__':
         os.environ['CUDA_VISIBLE_DEVICES'] = args.gpu
     if args.output:
         OUTDIR = "." + args.output
+    GRAPH_CACHE = args.graph_cache
+    SEQUENTIAL = sequentialEval.from_args(args)
+    EVAL_PROCS = args.eval_procs
+    EVAL_THREADS = args.eval_threads
+    DATA_FORMAT = args.data_format or default_data_format()
     if args.cfg:
         NUM_UNITS, structure, discard_first_block, model_path = read_cfg(args.cfg)
         structure = np.add(structure, discard_first_block)
+        block_channels = read_channels(args.cfg)
         print(model_path)
     else:
         structure = [NUM_UNITS] * 3
@@ -19,8 +19,16 @@ from tensorpack.tfutils.summary import *
 from tensorpack.tfutils.gradproc import SummaryGradient
 
 from EpsilonResnetBase import *
-from compressModel import read_cfg
+from compressModel import read_cfg, read_channels
+import dataParallel
+from adaptiveBatch import ResizableBatchData, BatchSizeGrowth
+from earlyStop import ConvergenceStopper, cifar_block_names
+from asyncCheckpoint import AsyncModelSaver
+from autoCompress import AutoCompressor
+from asyncEval import AsyncValidation, watch, error_stats
 from cifarEpsilonResnet import Model
+from cifarCompressedResnet import Model as CompressedModel
+from graphCache import cached_dataset_predictor
 
 import tensorflow as tf
 from tensorflow.contrib.layers import variance_scaling_initializer
@@ -29,16 +37,49 @@ BATCH_SIZE = 128
 EPSILON = 1.5
 NUM_UNITS = None
 NUM_CLASS = 10
+RECOMPUTE = 0
+NR_TOWER = 1
+SCALE_LR = False
+WARMUP_EPOCHS = 5
+GROW_BATCH = False
+MAX_BATCH = 1024
+MEMORY_LIMIT = None
+EARLY_STOP = 0
+STOP_TOLERANCE = 0.001
+ASYNC_SAVE = False
+KEEP_EVERY = 50
+AUTO_COMPRESS = False
+ASYNC_EVAL = False
+EVAL_GPU = None
+GRAPH_CACHE = None
+LOOP = False
+# the schedules of LearningRateSetter, UPDATED_LR_SCHEDULE is followed from the
+#   epoch where discarded_cnt increased by LR_THRESHOLD
+LR_SCHEDULE = [(1, 0.1), (20, 0.01), (28, 0.001), (50, 0.0001)]
+UPDATED_LR_SCHEDULE = [(1, 0.1), (10, 0.01), (14, 0.001), (25, 0.0001)]
+LR_THRESHOLD = 1
+# (fraction of the training set, fraction of the test set, seed) of
+#   dataParallel.subsample, set by timeToAccuracy.py
+SUBSAMPLE = None
+# callbacks run after the others, e.g. by timeToAccuracy.py
+EXTRA_CALLBACKS = []
+DATA_FORMAT = 'NCHW'
 
 def get_data(train_or_test):
     isTrain = train_or_test == 'train'
     pp_mean = dataset.SVHNDigit.get_per_pixel_mean()
     if isTrain:
-        d1 = dataset.SVHNDigit('train')
-        d2 = dataset.SVHNDigit('extra')
+        # shard each of the datasets, RandomMixData has its own rng
+        d1, d2 = dataset.SVHNDigit('train'), dataset.SVHNDigit('extra')
+        if SUBSAMPLE is not None:
+            d1, d2 = [dataParallel.subsample(d, SUBSAMPLE[0], SUBSAMPLE[2]) for d in [d1, d2]]
+        d1 = dataParallel.shard_dataflow(d1)
+        d2 = dataParallel.shard_dataflow(d2)
         ds = RandomMixData([d1, d2])
     else:
         ds = dataset.SVHNDigit('test')
+        if SUBSAMPLE is not None:
+            ds = dataParallel.subsample(ds, SUBSAMPLE[1], SUBSAMPLE[2])
 
     if isTrain:
         augmentors = [
@@ -56,14 +97,18 @@ def get_data(train_or_test):
             imgaug.MapImage(lambda x: x - pp_mean)
         ]
     ds = AugmentImageComponent(ds, augmentors)
-    ds = BatchData(ds, BATCH_SIZE, remainder=not isTrain)
+    if isTrain and GROW_BATCH:
+        ds = ResizableBatchData(ds, BATCH_SIZE)
+    else:
+        ds = BatchData(ds, BATCH_SIZE, remainder=not isTrain)
     if isTrain:
-        ds = PrefetchData(ds, 5, 5)
+        # the prefetch processes of a worker would produce the same shard
+        ds = PrefetchData(ds, 5, 5 if dataParallel.get_worker() is None else 1)
     return ds
 
 def get_config(out_dir):
     print("outdir: %s"%out_dir)
-    logger.set_logger_dir('train_log.' + out_dir)
+    logger.set_logger_dir('train_log.' + out_dir + dataParallel.log_dir_suffix())
     dataset_train = get_data('train')
     dataset_test = get_data('test')
     MAX_EPOCH = 200
@@ -72,20 +117,70 @@ def get_config(out_dir):
     side_inferences = [ClassificationError(x+ "/incorrect_vector",\
             x + "/val_error") for x in side_prediction_name]
     inferences = side_inferences + [ScalarStats('cost'), ClassificationError()]
+    lr_scaling = {}
+    if SCALE_LR:
+        # the schedules were tuned for one tower of BATCH_SIZE
+        lr_scaling = dict(batch_size=BATCH_SIZE * NR_TOWER * dataParallel.world_size(),
+                          base_batch_size=BATCH_SIZE,
+                          warmup_steps=int(WARMUP_EPOCHS * dataset_train.size()))
+    lr_setter = LearningRateSetter('learning_rate','discarded_cnt',
+                                   LR_SCHEDULE, UPDATED_LR_SCHEDULE,
+                                   LR_THRESHOLD, 1, **lr_scaling)
+    if ASYNC_EVAL:
+        validation = AsyncValidation(EVAL_GPU)
+    else:
+        validation = InferenceRunner(dataset_test, inferences)
+    saver = None
+    if ASYNC_SAVE:
+        # after the validation, to keep the checkpoints of the best val_error
+        saver = AsyncModelSaver(cifar_block_names(NUM_UNITS), keep_every=KEEP_EVERY)
+        callbacks = [validation, saver, lr_setter]
+    else:
+        callbacks = [ModelSaver(), validation, lr_setter]
+    if AUTO_COMPRESS:
+        callbacks.append(AutoCompressor(cifar_block_names(NUM_UNITS), saver=saver))
+    if GROW_BATCH:
+        callbacks.append(BatchSizeGrowth(dataset_train, lr_setter, max_batch_size=MAX_BATCH,
+                                         memory_limit_mb=MEMORY_LIMIT))
+    if EARLY_STOP > 0:
+        callbacks.append(ConvergenceStopper(lr_setter, cifar_block_names(NUM_UNITS),
+                                            patience=EARLY_STOP, tolerance=STOP_TOLERANCE,
+                                            async_saver=saver))
+    callbacks.extend(EXTRA_CALLBACKS)
     return TrainConfig(
         dataflow=dataset_train,
-        callbacks=[
-            ModelSaver(),
-            InferenceRunner(dataset_test, inferences),
-            LearningRateSetter('learning_rate','discarded_cnt',
-                [(1, 0.1), (20, 0.01), (28, 0.001), (50, 0.0001)],
-                [(1, 0.1), (10, 0.01), (14, 0.001), (25, 0.0001)],
-                1,1),
-        ],
-        model=Model(EPSILON, NUM_CLASS, NUM_UNITS),
+        callbacks=dataParallel.wrap_callbacks(callbacks),
+        session_config=dataParallel.session_config(),
+        model=Model(EPSILON, NUM_CLASS, NUM_UNITS, recompute=RECOMPUTE, loop=LOOP,
+                    data_format=DATA_FORMAT),
         max_epoch = MAX_EPOCH,
     )
 
+# the validation errors of a checkpoint, under the names of InferenceRunner
+def eval_stats(model_path):
+    side = 'side_output/res2.{}'.format(NUM_UNITS/2)
+    pred = cached_dataset_predictor(
+        Model(EPSILON, NUM_CLASS, NUM_UNITS, loop=LOOP, data_format=DATA_FORMAT),
+        model_path, get_data('test'), ['input', 'label'],
+        ['incorrect_vector', side + '/incorrect_vector'],
+        cache_dir=GRAPH_CACHE, script='svhnEpsilonResnet', n=NUM_UNITS, epsilon=EPSILON,
+        loop=LOOP, num_class=NUM_CLASS, data_format=DATA_FORMAT)
+    return error_stats(pred, ['val_error', side + '/val_error'])
+
+# the validation error of a model compressed by compressModel.py
+def eval_compressed_stats(cfg_path):
+    n, structure, discard_first_block, model_path = read_cfg(cfg_path)
+    structure = np.add(structure, discard_first_block)
+    channels = read_channels(cfg_path)
+    pred = cached_dataset_predictor(
+        CompressedModel(NUM_CLASS, structure, discard_first_block, n, data_format=DATA_FORMAT,
+                        predict_only=True, channels=channels),
+        model_path, get_data('test'), ['input', 'label'], ['incorrect_vector'],
+        cache_dir=GRAPH_CACHE, script='svhnCompressedResnet',
+        structure=structure, discard_first_block=discard_first_block,
+        num_class=NUM_CLASS, data_format=DATA_FORMAT, channels=channels)
+    return error_stats(pred, ['compressed/val_error'])
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--gpu', help='comma separated list of GPU(s) to use.')
@@ -95,20 +190,82 @@ if __name__ == '__main__':
     parser.add_argument('--load', help='load model')
     parser.add_argument('-e', '--epsilon', help='set epsilon')
     parser.add_argument('-o', '--output', help='output')
+    parser.add_argument('--recompute', help='recompute activations in segments of this many blocks '
+                        'to save memory, e.g. sqrt(n). 0 to disable. Needs TensorFlow >= 1.5',
+                        type=int, default=0)
+    parser.add_argument('--data_format', help='specify NCHW or NHWC, default: NCHW with GPU, NHWC without',
+                        type=str, choices=['NCHW', 'NHWC'])
+    parser.add_argument('--loop', help='build the identical blocks of each group with a while_loop '
+                        'over stacked weights', action='store_true')
+    parser.add_argument('--scale_lr', help='scale the learning rate by the number of GPUs, '
+                        'with a linear warm-up', action='store_true')
+    parser.add_argument('--warmup', help='epochs of learning rate warm-up with --scale_lr',
+                        type=float, default=5)
 
+    parser.add_argument('--grow_batch', help='grow the batch size when blocks are discarded '
+                        'and the memory allows it', action='store_true')
+    parser.add_argument('--max_batch', help='maximal batch size with --grow_batch',
+                        type=int, default=1024)
+    parser.add_argument('--memory_limit', help='memory in MB for --grow_batch, '
+                        'default: GPU memory or physical memory', type=float)
+    parser.add_argument('--early_stop', help='stop when the discarded blocks and val_error '
+                        'have not changed in this many epochs at the final learning rate. 0 to disable',
+                        type=int, default=0)
+    parser.add_argument('--stop_tolerance', help='minimal improvement of val_error with --early_stop',
+                        type=float, default=0.001)
+    parser.add_argument('--async_save', help='save the checkpoints in the background and keep '
+                        'those where the discarded blocks changed or val_error was the best',
+                        action='store_true')
+    parser.add_argument('--keep_every', help='with --async_save, also keep the checkpoints of '
+                        'every this many epochs. 0 to disable', type=int, default=50)
+    parser.add_argument('--auto_compress', help='compress the checkpoint of every epoch '
+                        'in the background', action='store_true')
+    parser.add_argument('--async_eval', help='validate the checkpoints in another process '
+                        'instead of at the end of every epoch', action='store_true')
+    parser.add_argument('--eval_gpu', help='GPU(s) of the validation process of --async_eval, '
+                        'default: CPU')
+    parser.add_argument('--eval_watch', help='run as the validation process of --async_eval '
+                        'on this log dir')
+    dataParallel.add_arguments(parser)
     args = parser.parse_args()
+    # the validation process is not a data-parallel worker
+    worker = None if args.eval_watch else dataParallel.init_from_args(args)
     NUM_UNITS = args.num_units
+    RECOMPUTE = args.recompute
+    LOOP = args.loop
+    SCALE_LR = args.scale_lr
+    WARMUP_EPOCHS = args.warmup
+    GROW_BATCH = args.grow_batch
+    MAX_BATCH = args.max_batch
+    MEMORY_LIMIT = args.memory_limit
+    EARLY_STOP = args.early_stop
+    STOP_TOLERANCE = args.stop_tolerance
+    ASYNC_SAVE = args.async_save
+    KEEP_EVERY = args.keep_every
+    AUTO_COMPRESS = args.auto_compress
+    ASYNC_EVAL = args.async_eval
+    EVAL_GPU = args.eval_gpu
+    # the workers would grow their batches at different epochs
+    assert worker is None or not GROW_BATCH, '--grow_batch is not supported with data parallelism'
     if args.gpu:
         os.environ['CUDA_VISIBLE_DEVICES'] = args.gpu
+    DATA_FORMAT = args.data_format or default_data_format()
     if args.epsilon:
         EPSILON = float(args.epsilon)
     out_dir = ""
     if args.output:
         out_dir = "." + args.output
     print('epsilon = %f' % EPSILON)
+    if args.gpu:
+        NR_TOWER = len(args.gpu.split(','))
+    if args.eval_watch:
+        watch(args.eval_watch, eval_stats, eval_compressed_stats)
+        sys.exit()
     config = get_config(out_dir)
     if args.load:
         config.session_init = SaverRestore(args.load)
-    if args.gpu:
-        config.nr_tower = len(args.gpu.split(','))
-    SyncMultiGPUTrainer(config).train()
+    config.nr_tower = NR_TOWER
+    if worker is not None:
+        QueueInputTrainer(config).train()
+    else:
+        SyncMultiGPUTrainer(config).train()
@@ -0,0 +1,316 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+# File: sweep.py
+
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import re
+import shlex
+import shutil
+import sqlite3
+import subprocess
+import sys
+import time
+from distutils.spawn import find_executable
+
+"""
+Run a grid of trainings of cifarEpsilonResnet.py or svhnEpsilonResnet.py on
+this machine and keep their statistics in a SQLite database.
+
+    python sweep.py run --db sweep.db --script cifar --dataset cifar10 -n 18,33 -e 2.0,2.5 \\
+        --cores 8 --memory 6000
+    python sweep.py query --db sweep.db
+    python sweep.py compress --db sweep.db --run cifar-cifar10-n18-e2.5 --step best
+
+run: every combination of -n and -e is a run with the key
+  {script}-{dataset}-n{n}-e{epsilon}, trained with `-o {key}` on CPU in
+  train_log..{key}. A run reserves --cores cores, which it is pinned to with
+  taskset when available, and --memory MB; the runs are started in order as
+  long as the reserved cores and memory fit in --total_cores and
+  --total_memory, a smaller run may start before a bigger one waiting for
+  resources. The runs already done in the database are skipped, the log dir
+  of the others is removed before they start.
+ingest: the statistics printed at the end of every epoch in log.log, parsed
+  from where the previous ingestion stopped, are stored in the table epochs:
+  discarded_cnt, discarded_ratio, val_error, the val_error of the side
+  output, learning_rate, the blocks discarded and all the statistics as json.
+  `run` ingests the logs of its runs while they train; `ingest --log_dirs`
+  adds existing log dirs.
+query: the best val_error and the last discarded_cnt of every run, or the
+  rows of --sql.
+compress: compressModel.compress_step for the checkpoint of a step of a run,
+  `best` (of val_error) or `last`, with its discarded blocks and val_error
+  read from the database instead of log.log. The checkpoint of the step must
+  still be in the log dir, ModelSaver keeps the last ones.
+"""
+
+SCRIPTS = {'cifar': 'cifarEpsilonResnet.py', 'svhn': 'svhnEpsilonResnet.py'}
+# the directory of the training scripts, which they are run from
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id TEXT PRIMARY KEY, script TEXT, dataset TEXT, n INTEGER, epsilon REAL,
+    command TEXT, log_dir TEXT, status TEXT, cores INTEGER, memory_mb REAL,
+    started REAL, finished REAL, returncode INTEGER, peak_rss_mb REAL,
+    log_offset INTEGER DEFAULT 0);
+CREATE TABLE IF NOT EXISTS epochs (
+    run_id TEXT, epoch INTEGER, global_step INTEGER, discarded_cnt REAL,
+    discarded_ratio REAL, val_error REAL, side_val_error REAL, learning_rate REAL,
+    discarded_blocks TEXT, stats TEXT, PRIMARY KEY (run_id, epoch));
+CREATE INDEX IF NOT EXISTS epochs_val_error ON epochs (val_error);
+CREATE INDEX IF NOT EXISTS epochs_discarded ON epochs (discarded_cnt);
+CREATE INDEX IF NOT EXISTS runs_grid ON runs (script, dataset, n, epsilon);
+"""
+
+# the end of an epoch in log.log, followed by its statistics
+re_EPOCH = 'Epoch (\d+) \(global_step (\d+)\)'
+re_STAT = '([\w\-\./]+): (-?\d+(\.\d*)?(e[-+]?\d+)?)$'
+
+
+def connect(path):
+    db = sqlite3.connect(path)
+    db.row_factory = sqlite3.Row
+    db.execute('PRAGMA journal_mode=WAL')
+    db.executescript(SCHEMA)
+    return db
+
+# the record of an epoch of the statistics in log.log
+def epoch_record(epoch, step, stats):
+    side = [v for k, v in stats.items() if k.startswith('side_output/') and k.endswith('/val_error')]
+    return {'epoch': epoch, 'global_step': step,
+            'discarded_cnt': stats.get('discarded_cnt'),
+            'discarded_ratio': stats.get('discarded_ratio'),
+            'val_error': stats.get('val_error'),
+            'side_val_error': side[0] if side else None,
+            'learning_rate': stats.get('learning_rate'),
+            'discarded_blocks': json.dumps(sorted(
+                k[:-len('/is_discarded')] for k, v in stats.items()
+                if k.endswith('/is_discarded') and v == 1.0)),
+            'stats': json.dumps(stats)}
+
+def parse_log(path, offset, final=False):
+    """
+    Returns:
+        the records of the epochs of log.log complete after `offset`, and the
+        offset of the first incomplete one. The last epoch is complete when
+        the next one starts, or with `final` when the training is over.
+    """
+    records = []
+    current = None
+    with open(path, 'r') as f:
+        f.seek(offset)
+        while True:
+            pos = f.tell()
+            l = f.readline()
+            if not l:
+                break
+            if not l.endswith('\n') and not final:
+                # being written
+                break
+            rst = re.search(re_EPOCH, l)
+            if rst:
+                if current is not None:
+                    records.append(epoch_record(*current))
+                current = (int(rst.group(1)), int(rst.group(2)), {})
+                offset = pos
+            elif current is not None:
+                stat = re.search(re_STAT, l.strip())
+                if stat:
+                    current[2][stat.group(1)] = float(stat.group(2))
+        if final:
+            if current is not None:
+                records.append(epoch_record(*current))
+            offset = f.tell()
+    return records, offset
+
+def ingest(db, run_id, final=False):
+    run = db.execute('SELECT log_dir, log_offset FROM runs WHERE id = ?', (run_id,)).fetchone()
+    path = os.path.join(run['log_dir'], 'log.log')
+    if not os.path.exists(path):
+        return 0
+    records, offset = parse_log(path, run['log_offset'], final)
+    with db:
+        for r in records:
+            keys = ['run_id'] + sorted(r.keys())
+            db.execute('INSERT OR REPLACE INTO epochs ({}) VALUES ({})'.format(
+                ', '.join(keys), ', '.join('?' * len(keys))),
+                [run_id] + [r[k] for k in keys[1:]])
+        db.execute('UPDATE runs SET log_offset = ? WHERE id = ?', (offset, run_id))
+    return len(records)
+
+
+# the runs of the grid
+def grid(args):
+    runs = []
+    for n, epsilon in itertools.product(args.num_units, args.epsilons):
+        key = '{}-{}-n{}-e{}'.format(args.script, args.dataset, n, epsilon)
+        command = [sys.executable, SCRIPTS[args.script], '-n', str(n), '-e', str(epsilon), '-o', key]
+        if args.script == 'cifar':
+            command.append('--cifar10' if args.dataset == 'cifar10' else '--cifar100')
+        command += shlex.split(args.extra)
+        runs.append({'id': key, 'script': args.script, 'dataset': args.dataset, 'n': n,
+                     'epsilon': epsilon, 'command': command,
+                     # the log dir of the scripts is 'train_log.' + '.' + output
+                     'log_dir': os.path.join(SCRIPT_DIR, 'train_log..' + key),
+                     'cores': args.cores, 'memory_mb': args.memory})
+    return runs
+
+def launch(run, cores, out_dir):
+    command = run['command']
+    if find_executable('taskset'):
+        command = ['taskset', '-c', ','.join(str(c) for c in cores)] + command
+    env = dict(os.environ, CUDA_VISIBLE_DEVICES='', OMP_NUM_THREADS=str(len(cores)))
+    if os.path.isdir(run['log_dir']):
+        shutil.rmtree(run['log_dir'])
+    out = open(os.path.join(out_dir, run['id'] + '.out'), 'w')
+    p = subprocess.Popen(command, cwd=SCRIPT_DIR, env=env, stdout=out, stderr=subprocess.STDOUT,
+                         stdin=open(os.devnull, 'r'))
+    print('[sweep] {} started on cores {}: {}'.format(run['id'], cores, ' '.join(command)))
+    return p
+
+def run_grid(db, args):
+    total_cores = args.total_cores or multiprocessing.cpu_count()
+    total_memory = args.total_memory or \
+        os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 1024.0 / 1024.0
+    assert args.cores <= total_cores and args.memory <= total_memory, \
+        'a run needs more than --total_cores or --total_memory'
+    done = set(r['id'] for r in db.execute("SELECT id FROM runs WHERE status = 'done'"))
+    pending = [r for r in grid(args) if r['id'] not in done]
+    with db:
+        for r in pending:
+            db.execute('INSERT OR REPLACE INTO runs (id, script, dataset, n, epsilon, command, '
+                       'log_dir, status, cores, memory_mb, log_offset) '
+                       "VALUES (?, ?, ?, ?, ?, ?, ?, 'pending', ?, ?, 0)",
+                       (r['id'], r['script'], r['dataset'], r['n'], r['epsilon'],
+                        ' '.join(r['command']), r['log_dir'], r['cores'], r['memory_mb']))
+        db.execute('DELETE FROM epochs WHERE run_id IN ({})'.format(
+            ', '.join('?' * len(pending))), [r['id'] for r in pending])
+    free_cores = list(range(total_cores))
+    used_memory = 0.0
+    running = {}
+    while pending or running:
+        for r in list(pending):
+            if len(free_cores) >= r['cores'] and used_memory + r['memory_mb'] <= total_memory:
+                cores, free_cores = free_cores[:r['cores']], free_cores[r['cores']:]
+                used_memory += r['memory_mb']
+                p = launch(r, cores, args.out_dir)
+                running[p.pid] = (r, p, cores)
+                pending.remove(r)
+                with db:
+                    db.execute("UPDATE runs SET status = 'running', started = ? WHERE id = ?",
+                               (time.time(), r['id']))
+        time.sleep(args.poll)
+        for pid in list(running.keys()):
+            r, p, cores = running[pid]
+            # wait4 gives the peak memory of the run
+            exited, status, usage = os.wait4(pid, os.WNOHANG)
+            if exited == 0:
+                ingest(db, r['id'])
+                continue
+            del running[pid]
+            free_cores = sorted(free_cores + cores)
+            used_memory -= r['memory_mb']
+            code = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+            with db:
+                db.execute('UPDATE runs SET status = ?, finished = ?, returncode = ?, '
+                           'peak_rss_mb = ? WHERE id = ?',
+                           ('done' if code == 0 else 'failed', time.time(), code,
+                            usage.ru_maxrss / 1024.0, r['id']))
+            print('[sweep] {} finished with code {}, {} epochs'.format(
+                r['id'], code, ingest(db, r['id'], final=True)))
+
+# add existing log dirs to the database, the id of a run is its log dir
+def ingest_dirs(db, log_dirs):
+    for log_dir in log_dirs:
+        log_dir = os.path.abspath(log_dir)
+        with open(os.path.join(log_dir, 'log.log'), 'r') as f:
+            header = f.readline()
+        n = re.search('-n ?(\d+)', header)
+        epsilon = re.search('-e ?(\d+(\.\d*)?)', header)
+        with db:
+            db.execute('INSERT OR IGNORE INTO runs (id, script, n, epsilon, command, log_dir, status, '
+                       "log_offset) VALUES (?, ?, ?, ?, ?, ?, 'ingested', 0)",
+                       (os.path.basename(log_dir), 'svhn' if 'svhn' in header else 'cifar',
+                        int(n.group(1)) if n else None,
+                        float(epsilon.group(1)) if epsilon else None, header.strip(), log_dir))
+        print('[sweep] {}: {} epochs'.format(log_dir, ingest(db, os.path.basename(log_dir), final=True)))
+
+def query(db, args):
+    sql = args.sql or """
+        SELECT r.id, r.status, r.n, r.epsilon, r.peak_rss_mb,
+            (SELECT COUNT(*) FROM epochs e WHERE e.run_id = r.id) AS epochs,
+            (SELECT MIN(val_error) FROM epochs e WHERE e.run_id = r.id) AS best_val_error,
+            (SELECT discarded_cnt FROM epochs e WHERE e.run_id = r.id
+                ORDER BY epoch DESC LIMIT 1) AS discarded_cnt,
+            (SELECT discarded_ratio FROM epochs e WHERE e.run_id = r.id
+                ORDER BY epoch DESC LIMIT 1) AS discarded_ratio
+        FROM runs r ORDER BY r.script, r.dataset, r.n, r.epsilon"""
+    rows = db.execute(sql).fetchall()
+    if rows:
+        print('\t'.join(rows[0].keys()))
+    for r in rows:
+        print('\t'.join('{:.4g}'.format(v) if isinstance(v, float) else str(v) for v in r))
+    return rows
+
+# the epoch of a run to compress: `best` val_error, `last` or a global step
+def select_epoch(db, run_id, step):
+    order = {'best': 'val_error IS NULL, val_error ASC', 'last': 'epoch DESC'}
+    if step in order:
+        return db.execute('SELECT * FROM epochs WHERE run_id = ? ORDER BY {} LIMIT 1'.format(
+            order[step]), (run_id,)).fetchone()
+    return db.execute('SELECT * FROM epochs WHERE run_id = ? AND global_step = ?',
+                      (run_id, int(step))).fetchone()
+
+def compress(db, args):
+    from compressModel import compress_step
+    run = db.execute('SELECT log_dir FROM runs WHERE id = ?', (args.run,)).fetchone()
+    epoch = select_epoch(db, args.run, args.step)
+    assert run is not None and epoch is not None, 'no such run or step in the database'
+    compress_step(run['log_dir'], epoch['global_step'], json.loads(epoch['discarded_blocks']),
+                  [epoch['val_error']], args.out_dir)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', choices=['run', 'ingest', 'query', 'compress'])
+    parser.add_argument('--db', help='the SQLite database', default='sweep.db')
+    parser.add_argument('--script', choices=['cifar', 'svhn'], default='cifar')
+    parser.add_argument('--dataset', choices=['cifar10', 'cifar100', 'svhn'], default='cifar10')
+    parser.add_argument('-n', '--num_units', help='comma separated units per stage', default='18')
+    parser.add_argument('-e', '--epsilons', help='comma separated epsilons', default='2.5')
+    parser.add_argument('--extra', help='more arguments of the training script', default='')
+    parser.add_argument('--cores', help='cores of each run', type=int, default=4)
+    parser.add_argument('--memory', help='MB of memory of each run', type=float, default=4096)
+    parser.add_argument('--total_cores', help='default: all the cores', type=int)
+    parser.add_argument('--total_memory', help='MB, default: the physical memory', type=float)
+    parser.add_argument('--poll', help='seconds between the checks of the runs', type=float, default=10)
+    parser.add_argument('--out_dir', help='the output of the runs with run, the compressed '
+                        'model with compress, default: the log dir', default=None)
+    parser.add_argument('--log_dirs', help='comma separated log dirs to ingest', default='')
+    parser.add_argument('--sql', help='the query of query')
+    parser.add_argument('--run', help='the run to compress')
+    parser.add_argument('--step', help='the step to compress: best, last or a global step',
+                        default='best')
+    args = parser.parse_args()
+    args.num_units = [int(n) for n in args.num_units.split(',') if n]
+    args.epsilons = [float(e) for e in args.epsilons.split(',') if e]
+    if args.script == 'svhn':
+        args.dataset = 'svhn'
+
+    db = connect(args.db)
+    if args.command == 'run':
+        args.out_dir = args.out_dir or os.path.splitext(os.path.abspath(args.db))[0] + '.out'
+        if not os.path.isdir(args.out_dir):
+            os.makedirs(args.out_dir)
+        run_grid(db, args)
+        query(db, args)
+    elif args.command == 'ingest':
+        ingest_dirs(db, [d for d in args.log_dirs.split(',') if d])
+    elif args.command == 'query':
+        query(db, args)
+    else:
+        compress(db, args)
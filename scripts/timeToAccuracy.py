@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+# File: timeToAccuracy.py
+
+import argparse
+import itertools
+import json
+import math
+import os
+import shutil
+import time
+import numpy as np
+
+import sys
+sys.path.append('../../tensorpack')
+from tensorpack import *
+from tensorpack.train.base import StopTraining
+
+from earlyStop import latest_stat
+from benchmarkUtils import run_isolated, print_table
+
+import tensorflow as tf
+
+"""
+Time-to-accuracy of the learning rate schedules of the epsilon-ResNets.
+
+LearningRateSetter follows LR_SCHEDULE of the training script and switches
+to UPDATED_LR_SCHEDULE when discarded_cnt increases. This harness trains
+short, seeded runs of cifarEpsilonResnet.py or svhnEpsilonResnet.py on CPU,
+on a fixed random subset of the data (dataParallel.subsample), for every
+combination of -n, --epsilons and --schedules:
+  - adaptive: the schedules of the script, with the switch;
+  - fixed: LR_SCHEDULE alone, never switched;
+  - updated: UPDATED_LR_SCHEDULE from the start, never switched.
+The epochs of the schedules are multiplied by --epoch_scale to fit the
+short runs, rounded up and at least one epoch after the previous stage, so
+that every stage of the schedule still runs. Each run is in its own process and records, at every epoch,
+the wall time since the start of the training, val_error and
+discarded_ratio, and the first epoch and time where val_error <=
+--target_error and where discarded_ratio >= --target_ratio. A run stops when
+both targets are reached or after --max_epoch epochs.
+
+The report has a row per run with the speedup of the time to the target
+error over the --reference schedule of the same n and epsilon.
+
+Usage:
+    python timeToAccuracy.py --dataset cifar10 -n 5 --epsilons 2.0,2.5 --subsample 0.1 \\
+        --target_error 0.3 --target_ratio 0.2 --output tta.json
+"""
+
+SEED = 2017
+SCHEDULES = ['adaptive', 'fixed', 'updated']
+
+
+class TimeToTarget(Callback):
+    """
+    Record the statistics of every epoch and when the targets are reached,
+    and stop the training when both are. Put it after InferenceRunner.
+    """
+    def __init__(self, target_error, target_ratio, stop=True,
+                 val_stat='val_error', ratio_stat='discarded_ratio'):
+        self.targets = {'error': (val_stat, lambda v: v <= target_error),
+                        'ratio': (ratio_stat, lambda v: v >= target_ratio)}
+        self.stop = stop
+        self.history = []
+        self.reached = {}
+
+    def _before_train(self):
+        self.start = time.time()
+
+    def _trigger_epoch(self):
+        seconds = time.time() - self.start
+        stats = {'epoch': self.epoch_num, 'seconds': seconds,
+                 'learning_rate': latest_stat(self.trainer, 'learning_rate')}
+        for name, (stat, reached) in self.targets.items():
+            v = latest_stat(self.trainer, stat)
+            stats[stat] = v
+            if name not in self.reached and v is not None and reached(v):
+                self.reached[name] = {'epoch': self.epoch_num, 'seconds': seconds}
+                logger.info('[TimeToTarget] {} reached at epoch {}, {:.0f} sec'.format(
+                    stat, self.epoch_num, seconds))
+        self.history.append(stats)
+        with open(os.path.join(logger.LOG_DIR, 'time_to_accuracy.json'), 'w') as f:
+            json.dump({'history': self.history, 'reached': self.reached}, f, indent=2)
+        if self.stop and len(self.reached) == len(self.targets):
+            raise StopTraining()
+
+
+# the epochs of a schedule multiplied by epoch_scale, except the first one,
+#   kept strictly increasing so that no stage is merged with the previous one
+def scale_schedule(schedule, epoch_scale):
+    scaled = []
+    for k, (e, lr) in enumerate(schedule):
+        if k:
+            e = max(scaled[-1][0] + 1, int(math.ceil(e * epoch_scale)))
+        scaled.append((e, lr))
+    return scaled
+
+# the (init, updated, threshold) of LearningRateSetter for a schedule of the script
+def schedules(script, name, epoch_scale):
+    init = scale_schedule(script.LR_SCHEDULE, epoch_scale)
+    updated = scale_schedule(script.UPDATED_LR_SCHEDULE, epoch_scale)
+    if name == 'adaptive':
+        return init, updated, script.LR_THRESHOLD
+    if name == 'fixed':
+        return init, init, float('inf')
+    return updated, updated, float('inf')
+
+def train(spec, args):
+    start = time.time()
+    tf.set_random_seed(SEED + spec['seed'])
+    np.random.seed(SEED + spec['seed'])
+    if args.dataset == 'svhn':
+        import svhnEpsilonResnet as script
+    else:
+        import cifarEpsilonResnet as script
+        script.IS_CIFAR10 = args.dataset == 'cifar10'
+        script.NUM_CLASS = 10 if script.IS_CIFAR10 else 100
+    script.NUM_UNITS = spec['n']
+    script.EPSILON = spec['epsilon']
+    script.BATCH_SIZE = args.batch
+    script.DATA_FORMAT = 'NHWC'
+    script.LR_SCHEDULE, script.UPDATED_LR_SCHEDULE, script.LR_THRESHOLD = schedules(
+        script, spec['schedule'], args.epoch_scale)
+    script.SUBSAMPLE = (args.subsample, args.val_subsample, SEED)
+    recorder = TimeToTarget(args.target_error, args.target_ratio, stop=not args.no_stop)
+    script.EXTRA_CALLBACKS = [recorder]
+    # the log dir of the script is train_log.{out_dir}
+    out_dir = 'tta.{}'.format(spec['key'])
+    if os.path.isdir('train_log.' + out_dir):
+        shutil.rmtree('train_log.' + out_dir)
+    config = script.get_config(out_dir)
+    config.max_epoch = args.max_epoch
+    QueueInputTrainer(config).train()
+    last = recorder.history[-1] if recorder.history else {}
+    rst = {'epochs': last.get('epoch'), 'train_s': last.get('seconds'),
+           'startup_s': recorder.start - start,
+           'val_error': last.get('val_error'), 'discarded_ratio': last.get('discarded_ratio'),
+           'history': recorder.history}
+    for name in ['error', 'ratio']:
+        reached = recorder.reached.get(name, {})
+        rst['epochs_to_' + name] = reached.get('epoch')
+        rst['seconds_to_' + name] = reached.get('seconds')
+    return rst
+
+# the speedup of the time to the target error of each run over the reference
+#   schedule with the same n, epsilon and seed
+def add_speedups(rows, reference):
+    ref = dict(((r['n'], r['epsilon'], r['seed']), r.get('seconds_to_error'))
+               for r in rows if r['schedule'] == reference)
+    for r in rows:
+        base = ref.get((r['n'], r['epsilon'], r['seed']))
+        if base and r.get('seconds_to_error'):
+            r['speedup'] = base / r['seconds_to_error']
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataset', default='cifar10', choices=['cifar10', 'cifar100', 'svhn'])
+    parser.add_argument('-n', '--num_units', help='comma separated units per stage', default='5')
+    parser.add_argument('--epsilons', help='comma separated epsilons', default='2.5')
+    parser.add_argument('--schedules', help='comma separated schedules among {}'.format(
+                        ', '.join(SCHEDULES)), default=','.join(SCHEDULES))
+    parser.add_argument('--reference', help='the schedule of the speedups', default='fixed',
+                        choices=SCHEDULES)
+    parser.add_argument('--seeds', help='runs of each combination', type=int, default=1)
+    parser.add_argument('--subsample', help='fraction of the training set', type=float, default=0.1)
+    parser.add_argument('--val_subsample', help='fraction of the test set', type=float, default=0.2)
+    parser.add_argument('--epoch_scale', help='multiply the epochs of the schedules', type=float,
+                        default=0.1)
+    parser.add_argument('--max_epoch', type=int, default=40)
+    parser.add_argument('--target_error', help='target val_error', type=float, default=0.3)
+    parser.add_argument('--target_ratio', help='target discarded_ratio', type=float, default=0.2)
+    parser.add_argument('--no_stop', help='run --max_epoch epochs even when the targets are reached',
+                        action='store_true')
+    parser.add_argument('--batch', type=int, default=128)
+    parser.add_argument('--output', help='save the report as json')
+    args = parser.parse_args()
+    os.environ['CUDA_VISIBLE_DEVICES'] = ''
+
+    rows = []
+    for n, epsilon, schedule, seed in itertools.product(
+            [int(n) for n in args.num_units.split(',')],
+            [float(e) for e in args.epsilons.split(',')],
+            args.schedules.split(','), range(args.seeds)):
+        spec = {'n': n, 'epsilon': epsilon, 'schedule': schedule, 'seed': seed,
+                'key': '{}-n{}-e{}-{}-s{}'.format(args.dataset, n, epsilon, schedule, seed)}
+        r = run_isolated(train, spec, args)
+        r.update(spec)
+        rows.append(r)
+    add_speedups(rows, args.reference)
+    print_table(rows, ['key', 'epochs_to_error', 'seconds_to_error', 'epochs_to_ratio',
+                       'seconds_to_ratio', 'epochs', 'train_s', 'val_error', 'discarded_ratio',
+                       'speedup', 'failure'])
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'dataset': args.dataset, 'subsample': args.subsample,
+                       'val_subsample': args.val_subsample, 'epoch_scale': args.epoch_scale,
+                       'target_error': args.target_error, 'target_ratio': args.target_ratio,
+                       'reference': args.reference, 'runs': rows}, f, indent=2)